@@ -1,160 +1,3890 @@
+import asyncio
+import bisect
+import ctypes
+import gzip
+import hashlib
+import heapq
+import itertools
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import queue
+import shutil
+import signal
+import sqlite3
 import subprocess
 import tempfile
 import json
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import struct
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, Optional
+
+import numpy as np
+import orjson
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter as MetricCounter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, Response, WebSocket
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 import uvicorn
 
-# --- Configuration ---
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+try:
+    import zstandard
+except ImportError:  # zstd responses are only offered when the package is installed
+    zstandard = None
+
+# --- Configuration ---
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Define paths for the model and the whisper.cpp shared library
+MODEL_PATH = os.environ.get("WHISPER_MODEL_PATH", "/app/models/ggml-base.bin")
+WHISPER_LIBRARY_PATH = os.environ.get("WHISPER_LIBRARY_PATH", "/app/whisper.cpp/build/src/libwhisper.so")
+
+# Other models in MODELS_DIR (ggml-<name>.bin) are loaded on request; WHISPER_MODEL_PATH is the default and stays loaded
+MODELS_DIR = os.environ.get("WHISPER_MODELS_DIR", os.path.dirname(MODEL_PATH))
+# Estimated as model file size x workers per model; least recently used models are unloaded to stay within it.
+# Every loaded model runs its own pool of worker processes, each holding a copy of the model: WHISPER_WORKERS
+# for the default model, MODEL_WORKERS (WHISPER_WORKERS if unset) for the others
+MODEL_MEMORY_BUDGET = int(os.environ.get("MODEL_MEMORY_BUDGET", str(8 * 1024 ** 3)))
+MODEL_WORKERS = int(os.environ.get("MODEL_WORKERS", os.environ.get("WHISPER_WORKERS", "2")))
+MODEL_IDLE_SECONDS = float(os.environ.get("MODEL_IDLE_SECONDS", "900"))
+
+# Transcription worker pool
+WORKER_COUNT = int(os.environ.get("WHISPER_WORKERS", "2"))
+WORKER_THREADS = int(os.environ.get("WHISPER_THREADS", "4"))
+
+# Per-job thread/processor allocation; with ADAPTIVE_THREADS=0 every job gets WHISPER_THREADS
+ADAPTIVE_THREADS = os.environ.get("ADAPTIVE_THREADS", "1") == "1"
+AVAILABLE_CORES = int(os.environ.get("WHISPER_CORES", "0")) or (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+)
+MAX_THREADS_PER_JOB = int(os.environ.get("MAX_THREADS_PER_JOB", "8"))
+SHORT_JOB_SECONDS = float(os.environ.get("SHORT_JOB_SECONDS", "30"))
+SHORT_JOB_MAX_THREADS = int(os.environ.get("SHORT_JOB_MAX_THREADS", "2"))
+MAX_PROCESSORS_PER_JOB = int(os.environ.get("MAX_PROCESSORS_PER_JOB", "4"))
+PROCESSORS_MIN_SECONDS = float(os.environ.get("PROCESSORS_MIN_SECONDS", "300"))
+WORKER_START_TIMEOUT = float(os.environ.get("WHISPER_WORKER_START_TIMEOUT", "120"))
+# How often idle workers are checked, so one that crashed is replaced before a job is sent to it
+WORKER_CHECK_SECONDS = float(os.environ.get("WHISPER_WORKER_CHECK_SECONDS", "5"))
+# A worker call may take TIMEOUT_RTF_FACTOR times what its model's measured speed predicts for its audio and
+# thread allocation (realtime until the model has been measured), but at least TRANSCRIBE_TIMEOUT_MIN and,
+# if set, at most WHISPER_TRANSCRIBE_TIMEOUT seconds.
+# Timed-out or cancelled calls are aborted through whisper's abort callback, or the worker is killed after
+# ABORT_GRACE_SECONDS.
+TRANSCRIBE_TIMEOUT = float(os.environ.get("WHISPER_TRANSCRIBE_TIMEOUT", "0"))
+TRANSCRIBE_TIMEOUT_MIN = float(os.environ.get("WHISPER_TRANSCRIBE_TIMEOUT_MIN", "60"))
+TIMEOUT_RTF_FACTOR = float(os.environ.get("TIMEOUT_RTF_FACTOR", "5"))
+ABORT_GRACE_SECONDS = float(os.environ.get("ABORT_GRACE_SECONDS", "10"))
+# How often to check whether the client of a running request is still connected
+DISCONNECT_POLL_SECONDS = float(os.environ.get("DISCONNECT_POLL_SECONDS", "0.5"))
+
+# Per-stage concurrency limits. Requests go through a staged pipeline: a small pool of CONVERT_WORKERS decodes
+# upcoming uploads while the transcription slots are busy, but only while less than PIPELINE_QUEUE_SECONDS of
+# decoded audio is waiting for a slot. Uploads of at most PIPELINE_BYPASS_BYTES are cheap to decode and are never
+# held back. ffmpeg runs at nice level CONVERT_NICE so that it yields the cores to whisper.
+CONVERT_WORKERS = int(os.environ.get("CONVERT_WORKERS", os.environ.get("FFMPEG_CONCURRENCY", "2")))
+CONVERT_NICE = int(os.environ.get("CONVERT_NICE", "10"))
+FFMPEG_TIMEOUT = float(os.environ.get("FFMPEG_TIMEOUT", "180"))
+TRANSCRIBE_CONCURRENCY = int(os.environ.get("TRANSCRIBE_CONCURRENCY", str(WORKER_COUNT)))
+PIPELINE_QUEUE_SECONDS = float(os.environ.get("PIPELINE_QUEUE_SECONDS", str(300 * TRANSCRIBE_CONCURRENCY)))
+PIPELINE_BYPASS_BYTES = int(os.environ.get("PIPELINE_BYPASS_BYTES", str(1024 * 1024)))
+# Stage utilisation in /queue is averaged over this many seconds
+UTILISATION_WINDOW_SECONDS = float(os.environ.get("UTILISATION_WINDOW_SECONDS", "60"))
+
+# Admission control: audio-seconds that may be queued or running before new jobs are turned away
+MAX_QUEUED_AUDIO_SECONDS = float(os.environ.get("MAX_QUEUED_AUDIO_SECONDS", "7200"))
+INITIAL_REALTIME_FACTOR = float(os.environ.get("INITIAL_REALTIME_FACTOR", "0.5"))
+
+# Worker slots are handed out shortest-job-first; waiting jobs age so long ones are not starved.
+# Jobs shorter than SHORT_LANE_SECONDS form the short lane, which keeps SHORT_LANE_RESERVED slots to itself.
+SJF_AGING_RATE = float(os.environ.get("SJF_AGING_RATE", "10"))
+SHORT_LANE_SECONDS = float(os.environ.get("SHORT_LANE_SECONDS", "60"))
+SHORT_LANE_RESERVED = int(os.environ.get("SHORT_LANE_RESERVED", "1" if TRANSCRIBE_CONCURRENCY > 1 else "0"))
+
+# Audio decoding: "pipe" streams the upload through ffmpeg without temp files,
+# "file" writes it to disk first (needed by some containers, which pipe mode falls back to)
+AUDIO_DECODE_MODE = os.environ.get("AUDIO_DECODE_MODE", "pipe")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Upload and decoded-audio limits
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(2 * 1024 ** 3)))
+MAX_AUDIO_SECONDS = float(os.environ.get("MAX_AUDIO_SECONDS", str(4 * 3600)))
+PCM_MEMORY_BUDGET = int(os.environ.get("PCM_MEMORY_BUDGET", str(2 * 1024 ** 3)))
+
+# Transcription result cache: an in-memory LRU, plus an on-disk tier when RESULT_CACHE_DIR is set
+RESULT_CACHE_ENTRIES = int(os.environ.get("RESULT_CACHE_ENTRIES", "256"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", str(1024 ** 3)))
+RESULT_CACHE_MAX_AGE = float(os.environ.get("RESULT_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+
+# Responses larger than this are compressed when the client accepts zstd or gzip
+RESPONSE_COMPRESSION = os.environ.get("RESPONSE_COMPRESSION", "1") == "1"
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+
+# /detect-language only decodes and encodes the start of each clip (whisper looks at one 30 s window at most)
+LANGUAGE_DETECT_SECONDS = float(os.environ.get("LANGUAGE_DETECT_SECONDS", "30"))
+
+# Cascade: segments of a first pass that miss any of these are re-run on the larger cascade model
+CASCADE_MIN_TOKEN_PROB = float(os.environ.get("CASCADE_MIN_TOKEN_PROB", "0.5"))
+CASCADE_MAX_NO_SPEECH_PROB = float(os.environ.get("CASCADE_MAX_NO_SPEECH_PROB", "0.6"))
+CASCADE_MAX_COMPRESSION_RATIO = float(os.environ.get("CASCADE_MAX_COMPRESSION_RATIO", "2.4"))
+CASCADE_PADDING_SECONDS = float(os.environ.get("CASCADE_PADDING_SECONDS", "0.5"))
+
+# Short clips can be encoded with a reduced audio context instead of the full 30 s window (1500 positions of 20 ms).
+# Opt-in per request with short_audio_ctx, or for every request with SHORT_AUDIO_CTX=1. The context is rounded up
+# to one of AUDIO_CTX_BUCKETS so the encoder only ever sees a few graph sizes; longer clips keep the full window.
+SHORT_AUDIO_CTX = os.environ.get("SHORT_AUDIO_CTX", "0") == "1"
+AUDIO_CTX_BUCKETS = sorted(int(n) for n in os.environ.get("AUDIO_CTX_BUCKETS", "256,384,512,768,1024").split(","))
+AUDIO_CTX_MARGIN_SECONDS = float(os.environ.get("AUDIO_CTX_MARGIN_SECONDS", "1"))
+
+# /transcribe/batch packs short clips, separated by PACK_GAP_SECONDS of silence, into shared windows of up to
+# PACK_WINDOW_SECONDS that each take a single encoder pass. Clips longer than PACK_MAX_CLIP_SECONDS run on their own.
+PACK_WINDOW_SECONDS = float(os.environ.get("PACK_WINDOW_SECONDS", "30"))
+PACK_GAP_SECONDS = float(os.environ.get("PACK_GAP_SECONDS", "1"))
+PACK_MAX_CLIP_SECONDS = float(os.environ.get("PACK_MAX_CLIP_SECONDS", "15"))
+
+# Optional VAD pre-pass with the Silero model (models/download-vad-model.sh): only the speech regions are
+# transcribed, joined VAD_GAP_MS of silence apart. On per request with vad=true, or by default with VAD=1.
+VAD_MODEL_PATH = os.environ.get("VAD_MODEL_PATH", os.path.join(MODELS_DIR, "ggml-silero-v5.1.2.bin"))
+VAD_DEFAULT = os.environ.get("VAD", "0") == "1"
+VAD_THRESHOLD = float(os.environ.get("VAD_THRESHOLD", "0.5"))
+VAD_MIN_SPEECH_MS = int(os.environ.get("VAD_MIN_SPEECH_MS", "250"))
+VAD_MIN_SILENCE_MS = int(os.environ.get("VAD_MIN_SILENCE_MS", "100"))
+VAD_SPEECH_PAD_MS = int(os.environ.get("VAD_SPEECH_PAD_MS", "30"))
+VAD_GAP_MS = int(os.environ.get("VAD_GAP_MS", "200"))
+
+# Long recordings are split at quiet points into overlapping windows that are transcribed in parallel
+LONG_AUDIO_SECONDS = float(os.environ.get("LONG_AUDIO_SECONDS", "600"))
+CHUNK_SECONDS = float(os.environ.get("CHUNK_SECONDS", "120"))
+CHUNK_OVERLAP_SECONDS = float(os.environ.get("CHUNK_OVERLAP_SECONDS", "2"))
+CHUNK_SEARCH_SECONDS = float(os.environ.get("CHUNK_SEARCH_SECONDS", "10"))
+
+# Live streams: sliding-window decoding as in examples/stream (a new hypothesis every step, over up to length of audio)
+LIVE_STEP_MS = int(os.environ.get("LIVE_STEP_MS", "3000"))
+LIVE_LENGTH_MS = int(os.environ.get("LIVE_LENGTH_MS", "10000"))
+LIVE_KEEP_MS = int(os.environ.get("LIVE_KEEP_MS", "200"))
+# Audio that piles up beyond this while a step is decoding is dropped, oldest first, to keep latency bounded
+LIVE_MAX_BACKLOG_MS = int(os.environ.get("LIVE_MAX_BACKLOG_MS", "10000"))
+MAX_LIVE_STREAMS = int(os.environ.get("MAX_LIVE_STREAMS", "32"))
+
+# Per-request trace records (JSON lines) for offline analysis of slow requests; disabled when empty
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", "")
+TRACE_LOG_MAX_BYTES = int(os.environ.get("TRACE_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_LOG_BACKUPS = int(os.environ.get("TRACE_LOG_BACKUPS", "5"))
+
+# Batch jobs: uploads are kept under JOBS_DIR and journaled in SQLite until they are done
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "/app/data/jobs.sqlite3")
+JOBS_DIR = os.environ.get("JOBS_DIR", "/app/data/jobs")
+JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY", str(TRANSCRIBE_CONCURRENCY)))
+# A job waits out 429/503 responses (as told by their Retry-After) for at most this long before it fails
+JOB_RETRY_SECONDS = float(os.environ.get("JOB_RETRY_SECONDS", "3600"))
+
+# Plain PCM WAV uploads are decoded (and if needed resampled/down-mixed) in-process instead of by ffmpeg
+WAV_FAST_PATH = os.environ.get("WAV_FAST_PATH", "1") == "1"
+
+WHISPER_SAMPLE_RATE = 16000
+
+
+# --- whisper.cpp C API bindings ---
+# These mirror the structs in include/whisper.h and must be kept in sync with it.
+
+class WhisperAheads(ctypes.Structure):
+    _fields_ = [
+        ("n_heads", ctypes.c_size_t),
+        ("heads", ctypes.c_void_p),
+    ]
+
+
+class WhisperContextParams(ctypes.Structure):
+    _fields_ = [
+        ("use_gpu", ctypes.c_bool),
+        ("flash_attn", ctypes.c_bool),
+        ("gpu_device", ctypes.c_int),
+        ("dtw_token_timestamps", ctypes.c_bool),
+        ("dtw_aheads_preset", ctypes.c_int),
+        ("dtw_n_top", ctypes.c_int),
+        ("dtw_aheads", WhisperAheads),
+        ("dtw_mem_size", ctypes.c_size_t),
+    ]
+
+
+class WhisperVadParams(ctypes.Structure):
+    _fields_ = [
+        ("threshold", ctypes.c_float),
+        ("min_speech_duration_ms", ctypes.c_int),
+        ("min_silence_duration_ms", ctypes.c_int),
+        ("max_speech_duration_s", ctypes.c_float),
+        ("speech_pad_ms", ctypes.c_int),
+        ("samples_overlap", ctypes.c_float),
+    ]
+
+
+class WhisperVadContextParams(ctypes.Structure):
+    _fields_ = [
+        ("n_threads", ctypes.c_int),
+        ("use_gpu", ctypes.c_bool),
+        ("gpu_device", ctypes.c_int),
+    ]
+
+
+class WhisperGreedyParams(ctypes.Structure):
+    _fields_ = [("best_of", ctypes.c_int)]
+
+
+class WhisperBeamSearchParams(ctypes.Structure):
+    _fields_ = [
+        ("beam_size", ctypes.c_int),
+        ("patience", ctypes.c_float),
+    ]
+
+
+class WhisperTokenData(ctypes.Structure):
+    _fields_ = [
+        ("id", ctypes.c_int),
+        ("tid", ctypes.c_int),
+        ("p", ctypes.c_float),
+        ("plog", ctypes.c_float),
+        ("pt", ctypes.c_float),
+        ("ptsum", ctypes.c_float),
+        ("t0", ctypes.c_int64),
+        ("t1", ctypes.c_int64),
+        ("t_dtw", ctypes.c_int64),
+        ("vlen", ctypes.c_float),
+    ]
+
+
+class WhisperFullParams(ctypes.Structure):
+    _fields_ = [
+        ("strategy", ctypes.c_int),
+        ("n_threads", ctypes.c_int),
+        ("n_max_text_ctx", ctypes.c_int),
+        ("offset_ms", ctypes.c_int),
+        ("duration_ms", ctypes.c_int),
+        ("translate", ctypes.c_bool),
+        ("no_context", ctypes.c_bool),
+        ("no_timestamps", ctypes.c_bool),
+        ("single_segment", ctypes.c_bool),
+        ("print_special", ctypes.c_bool),
+        ("print_progress", ctypes.c_bool),
+        ("print_realtime", ctypes.c_bool),
+        ("print_timestamps", ctypes.c_bool),
+        ("token_timestamps", ctypes.c_bool),
+        ("thold_pt", ctypes.c_float),
+        ("thold_ptsum", ctypes.c_float),
+        ("max_len", ctypes.c_int),
+        ("split_on_word", ctypes.c_bool),
+        ("max_tokens", ctypes.c_int),
+        ("debug_mode", ctypes.c_bool),
+        ("audio_ctx", ctypes.c_int),
+        ("tdrz_enable", ctypes.c_bool),
+        ("suppress_regex", ctypes.c_char_p),
+        ("initial_prompt", ctypes.c_char_p),
+        ("prompt_tokens", ctypes.c_void_p),
+        ("prompt_n_tokens", ctypes.c_int),
+        ("language", ctypes.c_char_p),
+        ("detect_language", ctypes.c_bool),
+        ("suppress_blank", ctypes.c_bool),
+        ("suppress_nst", ctypes.c_bool),
+        ("temperature", ctypes.c_float),
+        ("max_initial_ts", ctypes.c_float),
+        ("length_penalty", ctypes.c_float),
+        ("temperature_inc", ctypes.c_float),
+        ("entropy_thold", ctypes.c_float),
+        ("logprob_thold", ctypes.c_float),
+        ("no_speech_thold", ctypes.c_float),
+        ("greedy", WhisperGreedyParams),
+        ("beam_search", WhisperBeamSearchParams),
+        ("new_segment_callback", ctypes.c_void_p),
+        ("new_segment_callback_user_data", ctypes.c_void_p),
+        ("progress_callback", ctypes.c_void_p),
+        ("progress_callback_user_data", ctypes.c_void_p),
+        ("encoder_begin_callback", ctypes.c_void_p),
+        ("encoder_begin_callback_user_data", ctypes.c_void_p),
+        ("abort_callback", ctypes.c_void_p),
+        ("abort_callback_user_data", ctypes.c_void_p),
+        ("logits_filter_callback", ctypes.c_void_p),
+        ("logits_filter_callback_user_data", ctypes.c_void_p),
+        ("grammar_rules", ctypes.c_void_p),
+        ("n_grammar_rules", ctypes.c_size_t),
+        ("i_start_rule", ctypes.c_size_t),
+        ("grammar_penalty", ctypes.c_float),
+        ("vad", ctypes.c_bool),
+        ("vad_model_path", ctypes.c_char_p),
+        ("vad_params", WhisperVadParams),
+    ]
+
+
+WHISPER_SAMPLING_GREEDY = 0
+
+# The structures above mirror include/whisper.h of this release; a libwhisper built from other sources may lay them
+# out differently, which ctypes can't detect and which corrupts memory instead of failing.
+WHISPER_HEADER_VERSION = "1.7.6"
+
+# void (*)(struct whisper_context * ctx, struct whisper_state * state, int n_new, void * user_data)
+WHISPER_NEW_SEGMENT_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+
+# bool (*)(void * user_data)
+GGML_ABORT_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.c_void_p)
+# void (*)(enum ggml_log_level level, const char * text, void * user_data)
+GGML_LOG_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)
+
+# Lines of whisper_print_timings, e.g. "whisper_print_timings:   encode time =   123.45 ms /     1 runs (...)"
+WHISPER_TIMING_RE = re.compile(r"(\w+) time = +([\d.]+) ms")
+WHISPER_FALLBACKS_RE = re.compile(r"fallbacks = +(\d+) p / +(\d+) h")
+
+
+def _load_whisper_library(path):
+    """Load libwhisper and declare the signatures of the functions we call."""
+    lib = ctypes.CDLL(path)
+
+    lib.whisper_context_default_params.argtypes = []
+    lib.whisper_context_default_params.restype = WhisperContextParams
+    lib.whisper_init_from_file_with_params.argtypes = [ctypes.c_char_p, WhisperContextParams]
+    lib.whisper_init_from_file_with_params.restype = ctypes.c_void_p
+    lib.whisper_free.argtypes = [ctypes.c_void_p]
+    lib.whisper_free.restype = None
+
+    lib.whisper_full_default_params.argtypes = [ctypes.c_int]
+    lib.whisper_full_default_params.restype = WhisperFullParams
+    lib.whisper_full.argtypes = [ctypes.c_void_p, WhisperFullParams, ctypes.POINTER(ctypes.c_float), ctypes.c_int]
+    lib.whisper_full.restype = ctypes.c_int
+    lib.whisper_full_parallel.argtypes = [
+        ctypes.c_void_p, WhisperFullParams, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.c_int
+    ]
+    lib.whisper_full_parallel.restype = ctypes.c_int
+
+    lib.whisper_full_n_segments.argtypes = [ctypes.c_void_p]
+    lib.whisper_full_n_segments.restype = ctypes.c_int
+    lib.whisper_full_get_segment_t0.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_full_get_segment_t0.restype = ctypes.c_int64
+    lib.whisper_full_get_segment_t1.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_full_get_segment_t1.restype = ctypes.c_int64
+    lib.whisper_full_get_segment_text.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_full_get_segment_text.restype = ctypes.c_char_p
+    lib.whisper_full_n_tokens.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_full_n_tokens.restype = ctypes.c_int
+    lib.whisper_full_get_token_text.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    lib.whisper_full_get_token_text.restype = ctypes.c_char_p
+    lib.whisper_full_get_token_data.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    lib.whisper_full_get_token_data.restype = WhisperTokenData
+    lib.whisper_full_get_segment_no_speech_prob.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_full_get_segment_no_speech_prob.restype = ctypes.c_float
+    lib.whisper_token_eot.argtypes = [ctypes.c_void_p]
+    lib.whisper_token_eot.restype = ctypes.c_int
+    lib.whisper_pcm_to_mel.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.c_int]
+    lib.whisper_pcm_to_mel.restype = ctypes.c_int
+    lib.whisper_lang_auto_detect.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_float)]
+    lib.whisper_lang_auto_detect.restype = ctypes.c_int
+    lib.whisper_lang_max_id.argtypes = []
+    lib.whisper_lang_max_id.restype = ctypes.c_int
+    lib.whisper_lang_str_full.argtypes = [ctypes.c_int]
+    lib.whisper_lang_str_full.restype = ctypes.c_char_p
+    lib.whisper_full_lang_id.argtypes = [ctypes.c_void_p]
+    lib.whisper_full_lang_id.restype = ctypes.c_int
+    lib.whisper_lang_str.argtypes = [ctypes.c_int]
+    lib.whisper_lang_str.restype = ctypes.c_char_p
+
+    lib.whisper_model_type_readable.argtypes = [ctypes.c_void_p]
+    lib.whisper_model_type_readable.restype = ctypes.c_char_p
+    lib.whisper_is_multilingual.argtypes = [ctypes.c_void_p]
+    lib.whisper_is_multilingual.restype = ctypes.c_int
+
+    lib.whisper_vad_default_params.argtypes = []
+    lib.whisper_vad_default_params.restype = WhisperVadParams
+    lib.whisper_vad_default_context_params.argtypes = []
+    lib.whisper_vad_default_context_params.restype = WhisperVadContextParams
+    lib.whisper_vad_init_from_file_with_params.argtypes = [ctypes.c_char_p, WhisperVadContextParams]
+    lib.whisper_vad_init_from_file_with_params.restype = ctypes.c_void_p
+    lib.whisper_vad_segments_from_samples.argtypes = [
+        ctypes.c_void_p, WhisperVadParams, ctypes.POINTER(ctypes.c_float), ctypes.c_int
+    ]
+    lib.whisper_vad_segments_from_samples.restype = ctypes.c_void_p
+    lib.whisper_vad_segments_n_segments.argtypes = [ctypes.c_void_p]
+    lib.whisper_vad_segments_n_segments.restype = ctypes.c_int
+    lib.whisper_vad_segments_get_segment_t0.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_vad_segments_get_segment_t0.restype = ctypes.c_float
+    lib.whisper_vad_segments_get_segment_t1.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.whisper_vad_segments_get_segment_t1.restype = ctypes.c_float
+    lib.whisper_vad_free_segments.argtypes = [ctypes.c_void_p]
+    lib.whisper_vad_free_segments.restype = None
+    lib.whisper_vad_free.argtypes = [ctypes.c_void_p]
+    lib.whisper_vad_free.restype = None
+
+    lib.whisper_print_timings.argtypes = [ctypes.c_void_p]
+    lib.whisper_print_timings.restype = None
+    lib.whisper_reset_timings.argtypes = [ctypes.c_void_p]
+    lib.whisper_reset_timings.restype = None
+    lib.whisper_log_set.argtypes = [GGML_LOG_CALLBACK, ctypes.c_void_p]
+    lib.whisper_log_set.restype = None
+
+    lib.whisper_version.argtypes = []
+    lib.whisper_version.restype = ctypes.c_char_p
+    lib.whisper_context_default_params_by_ref.argtypes = []
+    lib.whisper_context_default_params_by_ref.restype = ctypes.POINTER(WhisperContextParams)
+    lib.whisper_free_context_params.argtypes = [ctypes.POINTER(WhisperContextParams)]
+    lib.whisper_free_context_params.restype = None
+    lib.whisper_full_default_params_by_ref.argtypes = [ctypes.c_int]
+    lib.whisper_full_default_params_by_ref.restype = ctypes.POINTER(WhisperFullParams)
+    lib.whisper_free_params.argtypes = [ctypes.POINTER(WhisperFullParams)]
+    lib.whisper_free_params.restype = None
+
+    _check_whisper_abi(lib, path)
+    return lib
+
+
+def _check_whisper_abi(lib, path):
+    """
+    Fail fast if libwhisper doesn't match the structures declared here: the version must be the one they were
+    copied from, and the defaults the library fills in must read back where we expect them. The defaults are read
+    through the *_by_ref variants so that a larger struct on the library side can't overrun ours.
+    """
+    version = lib.whisper_version().decode()
+    if version != WHISPER_HEADER_VERSION:
+        raise RuntimeError(f"{path} is whisper.cpp {version}, but the bindings were written for {WHISPER_HEADER_VERSION}")
+
+    context = lib.whisper_context_default_params_by_ref()
+    try:
+        c = context.contents
+        context_ok = c.dtw_n_top == -1 and c.dtw_mem_size == 128 * 1024 * 1024
+    finally:
+        lib.whisper_free_context_params(context)
+    full = lib.whisper_full_default_params_by_ref(WHISPER_SAMPLING_GREEDY)
+    try:
+        f = full.contents
+        full_ok = (
+            f.n_max_text_ctx == 16384
+            and f.greedy.best_of == 5
+            and f.beam_search.beam_size == -1
+            and f.grammar_penalty == 100.0
+            and f.vad_params.min_speech_duration_ms == 250
+            and f.vad_params.speech_pad_ms == 30
+        )
+    finally:
+        lib.whisper_free_params(full)
+    if not (context_ok and full_ok):
+        raise RuntimeError(f"{path} does not match the whisper.h {WHISPER_HEADER_VERSION} structure layout")
+
+
+def _format_timestamp(t):
+    """Format a whisper timestamp (in units of 10 ms) the way whisper-cli does in its JSON output."""
+    msec = t * 10
+    hours, msec = divmod(msec, 3600 * 1000)
+    minutes, msec = divmod(msec, 60 * 1000)
+    seconds, msec = divmod(msec, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{msec:03d}"
+
+
+class WhisperEngine:
+    """A whisper.cpp context loaded once and reused for every transcription."""
+
+    def __init__(self, library_path, model_path):
+        self.lib = _load_whisper_library(library_path)
+        self.model_path = model_path
+
+        # Route whisper/ggml logging through us so the timings report can be captured instead of printed
+        self._log_capture = None
+        self._log_callback = GGML_LOG_CALLBACK(self._log)
+        # Cumulative fallback count of the state as of the last timings() call
+        self._fallbacks = 0
+        self.lib.whisper_log_set(self._log_callback, None)
+
+        self.ctx = self.lib.whisper_init_from_file_with_params(
+            model_path.encode("utf-8"), self.lib.whisper_context_default_params()
+        )
+        if not self.ctx:
+            raise RuntimeError(f"Failed to load model from {model_path}")
+
+        # Loaded on first use by detect_speech
+        self.vad_ctx = None
+        self.vad_model_path = None
+
+    def _log(self, level, text, user_data):
+        text = text.decode("utf-8", errors="replace") if text else ""
+        if self._log_capture is not None:
+            self._log_capture.append(text)
+        else:
+            os.write(2, text.encode("utf-8"))
+
+    def timings(self):
+        """
+        Stage times in seconds of the last transcription, taken from whisper_print_timings
+        (whisper_get_timings only reports per-run averages): mel, sample, encode, decode, batchd, prompt,
+        plus the number of temperature fallbacks.
+
+        whisper_reset_timings doesn't reset the fallback counters of the state, so the count is reported
+        relative to the previous call. With n_processors > 1 it only covers the first part of the audio:
+        whisper_full_parallel adds the timings of its extra states to the context's state but not their
+        fallback counters, and frees those states before returning.
+        """
+        self._log_capture = []
+        try:
+            self.lib.whisper_print_timings(self.ctx)
+            report = "".join(self._log_capture)
+        finally:
+            self._log_capture = None
+
+        timings = {
+            stage: float(ms) / 1000 for stage, ms in WHISPER_TIMING_RE.findall(report)
+            if stage not in ("load", "total")
+        }
+        fallbacks = WHISPER_FALLBACKS_RE.search(report)
+        total = int(fallbacks.group(1)) + int(fallbacks.group(2)) if fallbacks else self._fallbacks
+        timings["fallbacks"] = max(0, total - self._fallbacks)
+        self._fallbacks = total
+        return timings
+
+    def _tokens(self, i):
+        """Tokens of segment i, shaped like the ones written by `whisper-cli -ojf`."""
+        tokens = []
+        for j in range(self.lib.whisper_full_n_tokens(self.ctx, i)):
+            data = self.lib.whisper_full_get_token_data(self.ctx, i, j)
+            tokens.append({
+                "text": self.lib.whisper_full_get_token_text(self.ctx, i, j).decode("utf-8", errors="replace"),
+                "timestamps": {"from": _format_timestamp(data.t0), "to": _format_timestamp(data.t1)},
+                "offsets": {"from": data.t0 * 10, "to": data.t1 * 10},
+                "id": data.id,
+                "p": round(data.p, 6),
+            })
+        return tokens
+
+    def _confidence(self, i):
+        """Average probability of the text tokens of segment i (special tokens excluded) and its no-speech probability."""
+        eot = self.lib.whisper_token_eot(self.ctx)
+        probs = []
+        for j in range(self.lib.whisper_full_n_tokens(self.ctx, i)):
+            data = self.lib.whisper_full_get_token_data(self.ctx, i, j)
+            if data.id < eot:
+                probs.append(data.p)
+        return {
+            "avg_token_p": round(sum(probs) / len(probs), 4) if probs else 0.0,
+            "no_speech_prob": round(self.lib.whisper_full_get_segment_no_speech_prob(self.ctx, i), 4),
+        }
+
+    def _segment(self, i, tokens=False, confidence=False):
+        t0 = self.lib.whisper_full_get_segment_t0(self.ctx, i)
+        t1 = self.lib.whisper_full_get_segment_t1(self.ctx, i)
+        segment = {
+            "timestamps": {"from": _format_timestamp(t0), "to": _format_timestamp(t1)},
+            "offsets": {"from": t0 * 10, "to": t1 * 10},
+            "text": self.lib.whisper_full_get_segment_text(self.ctx, i).decode("utf-8", errors="replace"),
+        }
+        if tokens:
+            segment["tokens"] = self._tokens(i)
+        if confidence:
+            segment["confidence"] = self._confidence(i)
+        return segment
+
+    def transcribe(self, samples, options, on_segment=None, abort=None):
+        """
+        Run whisper_full (or whisper_full_parallel for n_processors > 1) on 16 kHz mono float32 samples.
+        Returns a dict shaped like the JSON written by `whisper-cli -oj`.
+        If on_segment is given it is called with each segment as soon as it is decoded.
+        abort is a shared boolean (see WorkerPool); once it is set, whisper_full stops at the next graph node.
+        """
+        language = options.get("language", "auto")
+        translate = options.get("translate", False)
+
+        params = self.lib.whisper_full_default_params(WHISPER_SAMPLING_GREEDY)
+        params.n_threads = options.get("n_threads", WORKER_THREADS)
+        params.language = language.encode("utf-8")
+        params.translate = translate
+        params.print_progress = False
+        params.print_realtime = False
+        params.print_timestamps = False
+        params.single_segment = options.get("single_segment", False)
+        params.no_timestamps = options.get("no_timestamps", False)
+        params.no_context = options.get("no_context", True)
+        params.audio_ctx = options.get("audio_ctx", 0)
+        tokens = options.get("tokens", False)
+        confidence = options.get("confidence", False)
+        params.token_timestamps = tokens
+
+        callback = None
+        if on_segment is not None:
+            def new_segment(ctx, state, n_new, user_data):
+                n_segments = self.lib.whisper_full_n_segments(self.ctx)
+                for i in range(n_segments - n_new, n_segments):
+                    on_segment(self._segment(i, tokens, confidence))
+
+            # Must stay referenced until whisper_full returns
+            callback = WHISPER_NEW_SEGMENT_CALLBACK(new_segment)
+            params.new_segment_callback = ctypes.cast(callback, ctypes.c_void_p)
+
+        abort_callback = None
+        if abort is not None:
+            abort_callback = GGML_ABORT_CALLBACK(lambda user_data: abort.value)
+            params.abort_callback = ctypes.cast(abort_callback, ctypes.c_void_p)
+
+        samples = np.ascontiguousarray(samples, dtype=np.float32)
+        self.lib.whisper_reset_timings(self.ctx)
+        data = samples.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+        n_processors = options.get("n_processors", 1)
+        if n_processors > 1:
+            ret = self.lib.whisper_full_parallel(self.ctx, params, data, len(samples), n_processors)
+        else:
+            ret = self.lib.whisper_full(self.ctx, params, data, len(samples))
+        if ret != 0:
+            raise RuntimeError(f"whisper_full failed with code {ret}")
+
+        segments = [self._segment(i, tokens, confidence) for i in range(self.lib.whisper_full_n_segments(self.ctx))]
+
+        return {
+            "model": {
+                "type": self.lib.whisper_model_type_readable(self.ctx).decode("utf-8"),
+                "multilingual": bool(self.lib.whisper_is_multilingual(self.ctx)),
+            },
+            "params": {"model": self.model_path, "language": language, "translate": translate},
+            "result": {"language": self.lib.whisper_lang_str(self.lib.whisper_full_lang_id(self.ctx)).decode("utf-8")},
+            "transcription": segments,
+        }
+
+    def detect_language(self, samples, options):
+        """
+        Run only the mel spectrogram, the encoder and the language-ID decoder step on the first 30 s of samples.
+        Returns the detected language and the probabilities of all languages, most likely first.
+        """
+        if not self.lib.whisper_is_multilingual(self.ctx):
+            raise RuntimeError(f"{self.model_path} is an English-only model and cannot detect languages")
+        n_threads = options.get("n_threads", WORKER_THREADS)
+
+        samples = np.ascontiguousarray(samples, dtype=np.float32)
+        self.lib.whisper_reset_timings(self.ctx)
+        data = samples.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+        ret = self.lib.whisper_pcm_to_mel(self.ctx, data, len(samples), n_threads)
+        if ret != 0:
+            raise RuntimeError(f"whisper_pcm_to_mel failed with code {ret}")
+
+        probs = (ctypes.c_float * (self.lib.whisper_lang_max_id() + 1))()
+        lang_id = self.lib.whisper_lang_auto_detect(self.ctx, 0, n_threads, probs)
+        if lang_id < 0:
+            raise RuntimeError(f"whisper_lang_auto_detect failed with code {lang_id}")
+
+        ranked = sorted(range(len(probs)), key=lambda i: probs[i], reverse=True)
+        return {
+            "language": self.lib.whisper_lang_str(lang_id).decode("utf-8"),
+            "probabilities": [
+                {
+                    "language": self.lib.whisper_lang_str(i).decode("utf-8"),
+                    "name": self.lib.whisper_lang_str_full(i).decode("utf-8"),
+                    "probability": round(probs[i], 6),
+                }
+                for i in ranked
+            ],
+        }
+
+    def detect_speech(self, samples, options):
+        """
+        Speech regions of samples as [from, to] in ms, found by the Silero VAD model at options["vad_model"]
+        with the thresholds in options["vad"].
+        """
+        if self.vad_model_path != options["vad_model"]:
+            self._free_vad()
+            ctx_params = self.lib.whisper_vad_default_context_params()
+            ctx_params.n_threads = options.get("n_threads", WORKER_THREADS)
+            self.vad_ctx = self.lib.whisper_vad_init_from_file_with_params(
+                options["vad_model"].encode("utf-8"), ctx_params
+            )
+            if not self.vad_ctx:
+                raise RuntimeError(f"Failed to load VAD model from {options['vad_model']}")
+            self.vad_model_path = options["vad_model"]
+
+        vad = options["vad"]
+        params = self.lib.whisper_vad_default_params()
+        params.threshold = vad["threshold"]
+        params.min_speech_duration_ms = vad["min_speech_ms"]
+        params.min_silence_duration_ms = vad["min_silence_ms"]
+        params.speech_pad_ms = vad["speech_pad_ms"]
+
+        samples = np.ascontiguousarray(samples, dtype=np.float32)
+        data = samples.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+        segments = self.lib.whisper_vad_segments_from_samples(self.vad_ctx, params, data, len(samples))
+        if not segments:
+            raise RuntimeError("whisper_vad_segments_from_samples failed")
+        try:
+            # The VAD reports centiseconds
+            return [
+                [
+                    round(self.lib.whisper_vad_segments_get_segment_t0(segments, i) * 10),
+                    round(self.lib.whisper_vad_segments_get_segment_t1(segments, i) * 10),
+                ]
+                for i in range(self.lib.whisper_vad_segments_n_segments(segments))
+            ]
+        finally:
+            self.lib.whisper_vad_free_segments(segments)
+
+    def _free_vad(self):
+        if self.vad_ctx:
+            self.lib.whisper_vad_free(self.vad_ctx)
+            self.vad_ctx = None
+            self.vad_model_path = None
+
+    def close(self):
+        self._free_vad()
+        if self.ctx:
+            self.lib.whisper_free(self.ctx)
+            self.ctx = None
+
+
+# --- Worker processes ---
+
+class WorkerError(RuntimeError):
+    """A transcription worker failed, crashed or timed out."""
+
+
+def _worker_main(conn, library_path, model_path, abort):
+    """
+    Entry point of a worker process: load the model once, then serve jobs from the pipe.
+    The parent sets the shared abort flag to stop the transcription in progress.
+    """
+    # Shutdown is driven by the parent; don't die half-way through a job on Ctrl+C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    started = time.monotonic()
+    try:
+        engine = WhisperEngine(library_path, model_path)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ready", {"pid": os.getpid(), "load_seconds": time.monotonic() - started}))
+
+    while True:
+        try:
+            options = conn.recv()
+            samples = np.frombuffer(conn.recv_bytes(), dtype=np.float32)
+        except EOFError:
+            break
+        on_segment = None
+        if options.get("stream_segments"):
+            def on_segment(segment):
+                conn.send(("segment", segment))
+        try:
+            started = time.monotonic()
+            if options.get("task") == "detect_language":
+                result = engine.detect_language(samples, options)
+                timings = engine.timings()
+            elif options.get("task") == "vad":
+                result = engine.detect_speech(samples, options)
+                # Not part of whisper's own timings
+                timings = {"vad": time.monotonic() - started}
+            else:
+                result = engine.transcribe(samples, options, on_segment, abort)
+                timings = engine.timings()
+            conn.send(("timings", timings))
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+    engine.close()
+
+
+class TranscriptionCancelled(Exception):
+    """The caller went away and the transcription was aborted."""
+
+
+class _Worker:
+    def __init__(self, index, process, conn, abort):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.abort = abort
+
+
+class WorkerPool:
+    """
+    A fixed set of long-lived worker processes, each holding its own loaded whisper context.
+    Jobs go to whichever worker is idle; workers that crash or hang are replaced.
+    """
+
+    def __init__(self, size, library_path, model_path):
+        self.size = size
+        self.library_path = library_path
+        self.model_path = model_path
+        self._mp = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self):
+        for index in range(self.size):
+            self._idle.put(self._spawn(index))
+        logging.info(f"Started {self.size} transcription workers for model {self.model_path}")
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            self._terminate(worker)
+
+    @property
+    def ready_workers(self):
+        with self._lock:
+            return sum(1 for worker in self._workers.values() if worker.process.is_alive())
+
+    def _spawn(self, index):
+        parent_conn, child_conn = self._mp.Pipe()
+        abort = self._mp.RawValue(ctypes.c_bool, False)
+        process = self._mp.Process(
+            target=_worker_main,
+            args=(child_conn, self.library_path, self.model_path, abort),
+            name=f"whisper-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        worker = _Worker(index, process, parent_conn, abort)
+        try:
+            if not parent_conn.poll(WORKER_START_TIMEOUT):
+                raise WorkerError(f"Worker {index} did not load the model within {WORKER_START_TIMEOUT}s")
+            status, payload = parent_conn.recv()
+        except EOFError:
+            self._terminate(worker)
+            raise WorkerError(f"Worker {index} exited while loading the model")
+        except WorkerError:
+            self._terminate(worker)
+            raise
+        if status != "ready":
+            self._terminate(worker)
+            raise WorkerError(f"Worker {index} failed to start: {payload}")
+
+        with self._lock:
+            self._workers[index] = worker
+        STAGE_SECONDS.labels("load").observe(payload["load_seconds"])
+        logging.info(f"Worker {index} ready (pid {payload['pid']}, model loaded in {payload['load_seconds']:.2f}s)")
+        return worker
+
+    def _terminate(self, worker):
+        worker.conn.close()
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(timeout=5)
+
+    def replace_dead(self):
+        """Restart the idle workers that have exited. Busy ones are replaced by the job that finds them dead."""
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        dead = [worker for worker in idle if not worker.process.is_alive()]
+        for worker in idle:
+            if worker.process.is_alive():
+                self._idle.put(worker)
+        for worker in dead:
+            if self._stopped:
+                break
+            logging.warning(f"Worker {worker.index} exited while idle (exit code {worker.process.exitcode})")
+            self._idle.put(self._restart(worker))
+
+    def _restart(self, worker):
+        """Replace a dead or stuck worker. Returns the old worker if a new one cannot be started."""
+        logging.warning(f"Restarting worker {worker.index}")
+        REQUEST_ERRORS.labels("worker_restart").inc()
+        self._terminate(worker)
+        try:
+            return self._spawn(worker.index)
+        except WorkerError as e:
+            logging.error(f"Failed to restart worker {worker.index}: {e}")
+            return worker
+
+    def transcribe(self, samples, options, timeout=TRANSCRIBE_TIMEOUT_MIN, on_segment=None, stats=None, cancel=None):
+        """
+        Run a transcription on the next idle worker. Blocks until a worker is free and the job is done.
+        With on_segment, segments are passed to it (on this thread) as the worker decodes them.
+        stats, if given, is updated with the engine's stage timings.
+        Setting the cancel event (or running past timeout) aborts the job and raises TranscriptionCancelled
+        (or TimeoutError); a worker that does not stop within ABORT_GRACE_SECONDS is replaced.
+        """
+        if on_segment is not None:
+            options = {**options, "stream_segments": True}
+        worker = self._idle.get()
+        try:
+            if not worker.process.is_alive():
+                worker = self._restart(worker)
+                if not worker.process.is_alive():
+                    raise WorkerError("No transcription worker available")
+
+            aborted = None
+            try:
+                worker.abort.value = False
+                worker.conn.send(options)
+                worker.conn.send_bytes(np.ascontiguousarray(samples, dtype=np.float32))
+                deadline = time.monotonic() + timeout
+                while True:
+                    now = time.monotonic()
+                    wait = max(0, deadline - now)
+                    if cancel is not None and aborted is None:
+                        wait = min(wait, DISCONNECT_POLL_SECONDS)
+                    if not worker.conn.poll(wait):
+                        now = time.monotonic()
+                        if aborted is None and (now >= deadline or cancel is not None and cancel.is_set()):
+                            aborted = "timeout" if now >= deadline else "cancelled"
+                            worker.abort.value = True
+                            deadline = now + ABORT_GRACE_SECONDS
+                        elif now >= deadline:
+                            logging.warning(
+                                f"Worker {worker.index} did not stop within {ABORT_GRACE_SECONDS}s of the abort"
+                            )
+                            worker = self._restart(worker)
+                            break
+                        continue
+                    status, payload = worker.conn.recv()
+                    if status == "segment":
+                        if on_segment is not None:
+                            on_segment(payload)
+                    elif status == "timings":
+                        if stats is not None:
+                            stats.update(payload)
+                    else:
+                        break
+            except (EOFError, OSError) as e:
+                exitcode = worker.process.exitcode
+                worker = self._restart(worker)
+                raise WorkerError(f"Worker crashed during transcription (exit code {exitcode}): {e}")
+
+            if aborted == "timeout":
+                raise TimeoutError(f"Transcription timed out after {timeout:.0f}s")
+            if aborted == "cancelled":
+                raise TranscriptionCancelled("Transcription cancelled")
+            if status != "ok":
+                raise WorkerError(payload)
+            return payload
+        finally:
+            self._idle.put(worker)
+
+
+# --- Model registry ---
+
+class ModelUnavailableError(Exception):
+    """A model cannot be loaded right now, e.g. because the memory budget is taken by models in use."""
+
+
+class ModelTooLargeError(ModelUnavailableError):
+    """A model can never be loaded: it doesn't fit in the memory budget next to the default model."""
+
+
+def _model_name(path):
+    """ggml-large-v3-turbo-q5_0.bin -> large-v3-turbo-q5_0"""
+    name = os.path.basename(path)
+    if name.endswith(".bin"):
+        name = name[:-len(".bin")]
+    if name.startswith("ggml-"):
+        name = name[len("ggml-"):]
+    return name
+
+
+class _LoadedModel:
+    def __init__(self, pool, memory):
+        self.pool = pool
+        self.memory = memory
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class ModelRegistry:
+    """
+    The whisper models found in a directory, each served by its own WorkerPool once it is loaded.
+    Models are loaded on first use and kept resident within memory_budget, unloading the least recently used
+    idle model to make room, and unloaded after idle_seconds without requests. The default model is never unloaded.
+    """
+
+    def __init__(self, models_dir, default_path, memory_budget, idle_seconds, pool_size, other_pool_size=None):
+        self.models_dir = models_dir
+        self.default = _model_name(default_path)
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+        self.pool_size = pool_size
+        # Workers for models other than the default
+        self.other_pool_size = pool_size if other_pool_size is None else other_pool_size
+        self.paths = {}
+        self.loaded = OrderedDict()  # name -> _LoadedModel, least recently used first
+        self._load_lock = asyncio.Lock()
+        self.scan()
+        self.paths[self.default] = default_path
+
+    def scan(self):
+        """Pick up the model files in models_dir (VAD models are skipped)."""
+        try:
+            names = os.listdir(self.models_dir)
+        except OSError:
+            names = []
+        for name in sorted(names):
+            if name.endswith(".bin") and "silero" not in name and "vad" not in name:
+                self.paths.setdefault(_model_name(name), os.path.join(self.models_dir, name))
+
+    def resolve(self, name):
+        """Map a requested model name (None for the default) to a known model, or raise KeyError."""
+        if not name:
+            return self.default
+        if name not in self.paths:
+            self.scan()
+        if name not in self.paths:
+            raise KeyError(name)
+        return name
+
+    @property
+    def memory_used(self):
+        return sum(model.memory for model in self.loaded.values())
+
+    def _pool_size(self, name):
+        return self.pool_size if name == self.default else self.other_pool_size
+
+    def _estimate_memory(self, name):
+        try:
+            return os.path.getsize(self.paths[name]) * self._pool_size(name)
+        except OSError:
+            return 0  # the workers report the missing file
+
+    def _make_room(self, needed):
+        """
+        Unload idle models, least recently used first, until needed bytes fit. Returns the pools to stop.
+        Raises ModelTooLargeError if they can never fit beside the default model, which is never unloaded,
+        and ModelUnavailableError if they only don't fit while other models are in use.
+        """
+        evicted = []
+        for name in list(self.loaded):
+            if self.memory_used + needed <= self.memory_budget:
+                break
+            model = self.loaded[name]
+            if name == self.default or model.users:
+                continue
+            logging.info(f"Unloading model {name} to make room ({model.memory} bytes)")
+            evicted.append(self.loaded.pop(name).pool)
+        # A model larger than the whole budget can still be loaded on its own
+        if self.memory_used + needed > self.memory_budget and self.loaded:
+            pinned = self.loaded[self.default].memory if self.default in self.loaded else 0
+            if pinned + needed > self.memory_budget:
+                raise ModelTooLargeError(
+                    f"Not enough model memory: {needed} bytes needed, {self.memory_budget - pinned} of "
+                    f"MODEL_MEMORY_BUDGET ({self.memory_budget}) left beside the default model"
+                )
+            raise ModelUnavailableError(
+                f"Not enough model memory: {needed} bytes needed, {self.memory_used} of {self.memory_budget} in use"
+            )
+        return evicted
+
+    async def load(self, name):
+        """Start the worker pool of a model unless it is already loaded."""
+        async with self._load_lock:
+            if name not in self.loaded:
+                await self._load(name)
+
+    async def _load(self, name):
+        loop = asyncio.get_running_loop()
+        needed = self._estimate_memory(name)
+        evicted = []
+        try:
+            evicted = self._make_room(needed)
+        finally:
+            for pool in evicted:
+                await loop.run_in_executor(None, pool.stop)
+
+        pool = WorkerPool(self._pool_size(name), WHISPER_LIBRARY_PATH, self.paths[name])
+        started = time.monotonic()
+        try:
+            # Loading the model in every worker takes a while; keep the loop responsive meanwhile
+            await loop.run_in_executor(None, pool.start)
+        except WorkerError:
+            await loop.run_in_executor(None, pool.stop)
+            raise
+        logging.info(f"Loaded model {name} in {time.monotonic() - started:.1f}s ({needed} bytes estimated)")
+        self.loaded[name] = _LoadedModel(pool, needed)
+
+    async def acquire(self, name, trace=None):
+        """Return the worker pool of a model, loading it first if needed. Pair with release()."""
+        if name not in self.loaded:
+            started = time.monotonic()
+            await self.load(name)
+            if trace is not None:
+                trace.add("load", time.monotonic() - started)
+        model = self.loaded[name]
+        self.loaded.move_to_end(name)
+        model.users += 1
+        model.last_used = time.monotonic()
+        return model.pool
+
+    def release(self, name):
+        model = self.loaded.get(name)
+        if model is not None:
+            model.users -= 1
+            model.last_used = time.monotonic()
+
+    async def unload_idle(self):
+        """Unload models that have not been used for idle_seconds."""
+        now = time.monotonic()
+        for name, model in list(self.loaded.items()):
+            if name != self.default and not model.users and now - model.last_used > self.idle_seconds:
+                logging.info(f"Unloading model {name} after {now - model.last_used:.0f}s idle")
+                del self.loaded[name]
+                await asyncio.get_running_loop().run_in_executor(None, model.pool.stop)
+
+    @property
+    def ready_workers(self):
+        return sum(model.pool.ready_workers for model in self.loaded.values())
+
+    def status(self):
+        now = time.monotonic()
+        return {
+            "default": self.default,
+            "available": sorted(self.paths),
+            "loaded": [
+                {
+                    "name": name,
+                    "path": self.paths[name],
+                    "workers_ready": model.pool.ready_workers,
+                    "in_use": model.users,
+                    "idle_seconds": round(now - model.last_used, 1),
+                    "memory_bytes": model.memory,
+                }
+                for name, model in self.loaded.items()
+            ],
+            "memory_used": self.memory_used,
+            "memory_budget": self.memory_budget,
+        }
+
+    def stop(self):
+        for model in self.loaded.values():
+            model.pool.stop()
+        self.loaded.clear()
+
+
+# --- Metrics ---
+
+STAGE_SECONDS = Histogram(
+    "whisper_stage_seconds",
+    "Time spent per request in each stage: upload, convert (audio decoding), queue, load (model), "
+    "whisper's own mel, encode, decode, batchd, prompt and sample, and the vad pre-pass",
+    ["stage"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+REQUEST_ERRORS = MetricCounter("whisper_errors", "Failed requests and worker failures by type", ["type"])
+VAD_AUDIO_SECONDS = MetricCounter(
+    "whisper_vad_audio_seconds", "Audio run through the VAD pre-pass, by whether it was transcribed (speech) or skipped",
+    ["kind"],
+)
+VAD_SKIPPED_RATIO = Histogram(
+    "whisper_vad_skipped_ratio", "Fraction of each request's audio skipped by the VAD pre-pass",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95),
+)
+
+trace_log = logging.getLogger("whisper.trace")
+trace_log.propagate = False
+
+
+class RequestTrace:
+    """
+    Timing breakdown of one request, sent back in the Server-Timing header and written to the trace log.
+    Stages that run more than once (the windows of a long recording) are summed.
+    """
+
+    # Always reported, so a missing stage reads as zero rather than as a gap in the header
+    STAGES = ("upload", "convert-wait", "convert", "queue-wait", "load", "mel", "encode", "decode", "serialize")
+
+    def __init__(self, endpoint, filename, upload_seconds=0.0):
+        self.started = time.monotonic()
+        self.stages = dict.fromkeys(self.STAGES, 0.0)
+        self.stages["upload"] = upload_seconds
+        self.info = {"endpoint": endpoint, "filename": filename, "model": None, "fallbacks": 0}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_engine_stats(self, stats):
+        """Fold in the stage timings reported by a worker (see WhisperEngine.timings)."""
+        self.add("mel", stats.get("mel", 0.0))
+        self.add("encode", stats.get("encode", 0.0))
+        # The decoder loop: single and batched decoding, prompt processing and sampling
+        self.add("decode", sum(stats.get(stage, 0.0) for stage in ("decode", "batchd", "prompt", "sample")))
+        if "vad" in stats:
+            self.add("vad", stats["vad"])
+        self.info["fallbacks"] += stats.get("fallbacks", 0)
+
+    def server_timing(self):
+        total = self.stages["upload"] + time.monotonic() - self.started
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        return ", ".join(entries + [f"total;dur={total * 1000:.1f}"])
+
+    def write(self, status_code):
+        if not trace_log.handlers:
+            return
+        record = {
+            "time": time.time(),
+            "status": status_code,
+            **self.info,
+            "total_ms": round((self.stages["upload"] + time.monotonic() - self.started) * 1000, 1),
+            **{f"{stage}_ms": round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+        }
+        trace_log.info(json.dumps(record))
+
+
+class _ServiceCollector:
+    """Exports the state the service already tracks (queue, workers, cache) at scrape time."""
+
+    def collect(self):
+        yield GaugeMetricFamily("whisper_realtime_factor", "Smoothed processing time per second of audio", value=admission.rtf)
+        yield GaugeMetricFamily("whisper_queue_depth", "Transcription jobs waiting for a worker slot", value=thread_scheduler.waiting)
+        yield GaugeMetricFamily("whisper_queued_audio_seconds", "Seconds of audio admitted and not yet done", value=admission.queued_seconds)
+        yield GaugeMetricFamily("whisper_active_workers", "Workers busy with a transcription", value=thread_scheduler.running)
+        yield GaugeMetricFamily(
+            "whisper_ready_workers", "Worker processes with the model loaded",
+            value=model_registry.ready_workers if model_registry is not None else 0,
+        )
+        yield GaugeMetricFamily(
+            "whisper_loaded_models", "Models with a running worker pool",
+            value=len(model_registry.loaded) if model_registry is not None else 0,
+        )
+        yield GaugeMetricFamily("whisper_live_streams", "Open live transcription streams", value=live_streams)
+        busy = CounterMetricFamily(
+            "whisper_pipeline_busy_seconds", "Slot-seconds each pipeline stage spent busy; divide its rate by capacity",
+            labels=["stage"],
+        )
+        capacity = GaugeMetricFamily("whisper_pipeline_capacity", "Concurrent jobs each pipeline stage can run", labels=["stage"])
+        utilisation = GaugeMetricFamily(
+            "whisper_pipeline_utilisation", f"Busy fraction of each pipeline stage over the last {UTILISATION_WINDOW_SECONDS:.0f}s",
+            labels=["stage"],
+        )
+        waiting = GaugeMetricFamily("whisper_pipeline_waiting", "Jobs waiting to enter each pipeline stage", labels=["stage"])
+        for stage in (convert_stage, transcribe_stage):
+            utilisation.add_metric([stage.name], stage.utilisation())
+            busy.add_metric([stage.name], stage.busy_seconds)
+            capacity.add_metric([stage.name], stage.capacity)
+        waiting.add_metric(["convert"], convert_stage.waiting)
+        waiting.add_metric(["transcribe"], sum(job_scheduler.waiting.values()))
+        yield from (busy, capacity, utilisation, waiting)
+        cache = CounterMetricFamily("whisper_cache_lookups", "Result cache lookups", labels=["result"])
+        cache.add_metric(["hit"], result_cache.hits)
+        cache.add_metric(["miss"], result_cache.misses)
+        yield cache
+
+
+# --- Upload limits and memory accounting ---
+
+class AudioTooLargeError(Exception):
+    """The decoded audio of a single request exceeds MAX_AUDIO_SECONDS."""
+
+
+class MemoryBudgetExceeded(Exception):
+    """In-flight requests already hold PCM_MEMORY_BUDGET bytes of decoded audio."""
+
+
+class MemoryBudget:
+    """Bytes of decoded audio held in memory by all in-flight requests, against a global limit."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        with self._lock:
+            if self.used + n > self.limit:
+                raise MemoryBudgetExceeded(f"Decoded audio buffers are full ({self.used} of {self.limit} bytes in use)")
+            self.used += n
+
+    def release(self, n):
+        with self._lock:
+            self.used -= n
+
+
+class MemoryAccount:
+    """
+    The share of a MemoryBudget held by one request; everything is returned when the request is done.
+    Work that outlives the request (a shared in-flight transcription) can hold() the account, which is then
+    only released once every holder has closed it.
+    """
+
+    def __init__(self, budget, limit):
+        self.budget = budget
+        self.limit = limit
+        self.reserved = 0
+        self._holders = 1
+
+    def add(self, n, transient=False):
+        """
+        Charge n bytes. Transient buffers (e.g. audio at its source rate, before resampling) only count against
+        the shared budget; the per-request limit is sized for 16 kHz output and the caller bounds their duration.
+        """
+        if not transient and self.reserved + n > self.limit:
+            raise AudioTooLargeError(f"Audio is longer than the maximum of {MAX_AUDIO_SECONDS:.0f}s")
+        # More than the whole budget would never fit, however long the request waited
+        if self.reserved + n > self.budget.limit:
+            raise AudioTooLargeError(f"Decoded audio needs more than PCM_MEMORY_BUDGET ({self.budget.limit} bytes)")
+        self.budget.reserve(n)
+        self.reserved += n
+
+    def release(self, n):
+        n = min(n, self.reserved)
+        self.budget.release(n)
+        self.reserved -= n
+
+    def hold(self):
+        self._holders += 1
+
+    def close(self):
+        self._holders -= 1
+        if self._holders <= 0:
+            self.release(self.reserved)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+pcm_memory_budget = MemoryBudget(PCM_MEMORY_BUDGET)
+
+
+class MaxBodySizeMiddleware:
+    """Reject request bodies larger than max_bytes with 413, counting bytes as they arrive instead of buffering them."""
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request body exceeds the maximum of {self.max_bytes} bytes"
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            REQUEST_ERRORS.labels("body_too_large").inc()
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+        started = None
+
+        async def limited_receive():
+            nonlocal received, started
+            message = await receive()
+            if message["type"] == "http.request":
+                if started is None:
+                    started = time.monotonic()
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    REQUEST_ERRORS.labels("body_too_large").inc()
+                    raise HTTPException(status_code=413, detail=detail)
+                if not message.get("more_body", False) and received:
+                    upload_seconds = time.monotonic() - started
+                    STAGE_SECONDS.labels("upload").observe(upload_seconds)
+                    scope.setdefault("state", {})["upload_seconds"] = upload_seconds
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# --- Result cache ---
+
+class ResultCache:
+    """
+    Transcription results keyed by a hash of the decoded PCM and the decode parameters.
+    Lookups go to an in-memory LRU first, then to an optional on-disk tier bounded by size and age.
+    """
+
+    def __init__(self, max_entries, directory="", max_disk_bytes=0, max_age=0):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        # Disk entries in least recently used order (key -> (mtime, size)) and their total size, so eviction
+        # doesn't have to walk the directory on every write
+        self._disk_index = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def key(samples, params):
+        """Content address of a transcription: the PCM itself plus every parameter that changes the output."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        digest.update(np.ascontiguousarray(samples, dtype=np.float32))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _load_disk_index(self):
+        """Index the entries left by previous runs, oldest first; the directory is walked only here."""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name[:-len(".json")]))
+        for mtime, size, key in sorted(entries):
+            self._disk_index[key] = (mtime, size)
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _forget_disk(self, key):
+        _, size = self._disk_index.pop(key, (0, 0))
+        self._disk_bytes -= size
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            if self.max_age and time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                with self._disk_lock:
+                    self._forget_disk(key)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            # Refresh the mtime so eviction drops the least recently used entries first
+            os.utime(path)
+            with self._disk_lock:
+                if key in self._disk_index:
+                    self._disk_index[key] = (time.time(), self._disk_index[key][1])
+                    self._disk_index.move_to_end(key)
+            return result
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write_disk(self, key, result):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._disk_lock:
+            self._forget_disk(key)
+            self._disk_index[key] = (time.time(), size)
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """Drop entries older than max_age, then the least recently used ones until the tier fits max_disk_bytes."""
+        with self._disk_lock:
+            now = time.time()
+            while self._disk_index:
+                key, (mtime, _) = next(iter(self._disk_index.items()))
+                expired = self.max_age and now - mtime > self.max_age
+                if not expired and self._disk_bytes <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+                self._forget_disk(key)
+
+    async def get(self, key):
+        result = self._memory.get(key)
+        if result is None and self.directory:
+            result = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, result)
+        return result
+
+    async def put(self, key, result):
+        self._remember(key, result)
+        if self.directory:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, result)
+            except OSError as e:
+                logging.warning(f"Failed to write cache entry {key}: {e}")
+
+
+result_cache = ResultCache(RESULT_CACHE_ENTRIES, RESULT_CACHE_DIR, RESULT_CACHE_DISK_BYTES, RESULT_CACHE_MAX_AGE)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto a single in-flight task."""
+
+    def __init__(self):
+        self._tasks = {}
+        self._waiters = Counter()
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Mark the outcome as retrieved even if every caller went away before it finished
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, factory, resource=None):
+        """
+        Await the task for key, starting it with factory() if none is running.
+        Returns (result, shared) where shared tells whether another caller had already started the task.
+        The task itself is shielded, so one caller going away doesn't cancel it for the others;
+        it is only cancelled once every caller has gone.
+        A task started by this call holds resource (e.g. the MemoryAccount of the samples it works on)
+        until it is done, since it can outlive the caller that started it.
+        """
+        task = self._tasks.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            if resource is not None:
+                resource.hold()
+                task.add_done_callback(lambda _: resource.close())
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task), shared
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+
+
+transcription_flights = SingleFlight()
+
+
+class PipelineStage:
+    """
+    Occupancy of one stage of the request pipeline, integrated over time for utilisation reporting.
+    slot() also bounds the stage to capacity jobs at once; enter()/leave() only count, for stages whose
+    concurrency is enforced elsewhere.
+    """
+
+    def __init__(self, name, capacity, window=UTILISATION_WINDOW_SECONDS):
+        self.name = name
+        self.capacity = capacity
+        self.window = window
+        self.active = 0
+        self.waiting = 0
+        self.busy_seconds = 0.0
+        self._semaphore = None
+        self._last = time.monotonic()
+        self._history = deque([(self._last, 0.0)])
+
+    def open(self):
+        """Create the slot semaphore; called from the lifespan so it belongs to the serving event loop."""
+        self._semaphore = asyncio.Semaphore(self.capacity)
+
+    def _tick(self):
+        now = time.monotonic()
+        self.busy_seconds += self.active * (now - self._last)
+        self._last = now
+        self._history.append((now, self.busy_seconds))
+        # Keep one sample at least a window old to measure from
+        while len(self._history) > 2 and now - self._history[1][0] >= self.window:
+            self._history.popleft()
+
+    def enter(self):
+        self._tick()
+        self.active += 1
+
+    def leave(self):
+        self._tick()
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.enter()
+        try:
+            yield
+        finally:
+            self.leave()
+            self._semaphore.release()
+
+    def utilisation(self):
+        """Busy fraction of the stage's capacity over roughly the last window."""
+        self._tick()
+        since, busy = self._history[0]
+        elapsed = self._last - since
+        if elapsed <= 0:
+            return self.active / self.capacity
+        return (self.busy_seconds - busy) / (self.capacity * elapsed)
+
+    def status(self):
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": self.waiting,
+            "utilisation": round(self.utilisation(), 3),
+        }
+
+
+convert_stage = PipelineStage("convert", CONVERT_WORKERS)
+transcribe_stage = PipelineStage("transcribe", TRANSCRIBE_CONCURRENCY)
+
+
+class ThreadScheduler:
+    """
+    Chooses threads and processors for each job when it is dispatched, from the available cores,
+    how many jobs are running or waiting, and the job's audio duration.
+    A lone long job gets a large share of the machine; under load every job gets an even, smaller share.
+    """
+
+    def __init__(self, cores, max_concurrency):
+        self.cores = cores
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self.waiting = 0
+
+    def plan(self, duration):
+        # Jobs that will share the cores from now on: this one, the others running,
+        # and waiting ones up to the number of slots they can actually occupy
+        sharing = max(1, min(self.max_concurrency, self.running + self.waiting))
+        n_threads = max(1, self.cores // sharing)
+        n_threads = min(n_threads, SHORT_JOB_MAX_THREADS if duration < SHORT_JOB_SECONDS else MAX_THREADS_PER_JOB)
+
+        # Spare cores beyond the per-job thread cap go to extra processors, for long jobs only
+        n_processors = 1
+        if duration >= PROCESSORS_MIN_SECONDS:
+            n_processors = max(1, min(MAX_PROCESSORS_PER_JOB, self.cores // sharing // n_threads))
+
+        logging.info(
+            f"Scheduling {duration:.1f}s job: {n_threads} threads x {n_processors} processors "
+            f"(cores={self.cores}, running={self.running}, waiting={self.waiting})"
+        )
+        return n_threads, n_processors
+
+
+thread_scheduler = ThreadScheduler(AVAILABLE_CORES, TRANSCRIBE_CONCURRENCY)
+
+
+class QueueFullError(Exception):
+    """The transcription queue already holds MAX_QUEUED_AUDIO_SECONDS of audio."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the transcription backlog in seconds of audio (queued plus running), so a burst of uploads
+    is turned away quickly instead of piling up until everything times out.
+    Wait estimates come from the measured realtime factor (processing time / audio duration).
+    """
+
+    def __init__(self, max_queued_seconds, concurrency, initial_rtf):
+        self.max_queued_seconds = max_queued_seconds
+        self.concurrency = concurrency
+        self.queued_seconds = 0.0
+        self.jobs = 0
+        self.rtf = initial_rtf
+        # Per model: smoothed core-seconds (elapsed x threads x processors) per second of audio
+        self.core_rtf = {}
+
+    def estimated_wait(self):
+        return self.queued_seconds * self.rtf / self.concurrency
+
+    def _reject(self):
+        retry_after = max(1, int(self.estimated_wait() + 0.999))
+        raise QueueFullError(
+            f"Transcription queue is full ({self.queued_seconds:.0f}s of audio queued, "
+            f"limit {self.max_queued_seconds:.0f}s)",
+            retry_after,
+        )
+
+    def check(self):
+        """Cheap early rejection before the upload is decoded."""
+        if self.queued_seconds >= self.max_queued_seconds:
+            self._reject()
+
+    def reserve(self, duration):
+        """Take duration seconds of queue capacity; every reserve() must be paired with a release()."""
+        # A job longer than the whole limit is still accepted into an empty queue, or it could never run
+        if self.jobs and self.queued_seconds + duration > self.max_queued_seconds:
+            self._reject()
+        self.queued_seconds += duration
+        self.jobs += 1
+
+    def release(self, duration):
+        self.queued_seconds -= duration
+        self.jobs -= 1
+
+    @contextmanager
+    def admit(self, duration):
+        """Hold duration seconds of queue capacity for the lifetime of a job."""
+        self.reserve(duration)
+        try:
+            yield
+        finally:
+            self.release(duration)
+
+    def observe(self, duration, elapsed, model=None, cores=1):
+        """
+        Fold a finished worker call into the exponentially weighted realtime factor, and into the
+        per-model speed normalised by the cores (threads x processors) the call ran with.
+        """
+        if duration > 0:
+            self.rtf = 0.8 * self.rtf + 0.2 * (elapsed / duration)
+            if model is not None:
+                core_rtf = elapsed * cores / duration
+                previous = self.core_rtf.get(model)
+                self.core_rtf[model] = core_rtf if previous is None else 0.8 * previous + 0.2 * core_rtf
+
+    def expected_seconds(self, model, duration, cores):
+        """Predicted duration of a worker call on model with cores; None until the model has been measured."""
+        core_rtf = self.core_rtf.get(model)
+        return None if core_rtf is None else core_rtf * duration / max(1, cores)
+
+
+admission = AdmissionController(MAX_QUEUED_AUDIO_SECONDS, TRANSCRIBE_CONCURRENCY, INITIAL_REALTIME_FACTOR)
+
+
+class JobTicket:
+    def __init__(self, duration, lane, key, seq):
+        self.duration = duration
+        self.lane = lane
+        self.key = key
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other):
+        return (self.key, self.seq) < (other.key, other.seq)
+
+
+class JobScheduler:
+    """
+    Hands out the TRANSCRIBE_CONCURRENCY worker slots shortest-job-first by audio duration.
+
+    A waiting job's effective duration drops by aging_rate seconds for every second it waits, so a
+    long upload is eventually served even under a steady stream of short ones. Because all waiting
+    jobs age at the same rate, ordering by duration + aging_rate * enqueue time is equivalent and static.
+    Long-lane jobs may only occupy the last short_reserved slots while no short job is waiting; a short
+    job arriving after that waits for the next slot to free up instead of an idle reserved one.
+    """
+
+    def __init__(self, slots, aging_rate, short_seconds, short_reserved, history=1000):
+        self.slots = slots
+        self.aging_rate = aging_rate
+        self.short_seconds = short_seconds
+        self.short_reserved = min(short_reserved, slots - 1)
+        self.busy = {"short": 0, "long": 0}
+        self.waiting = {"short": 0, "long": 0}
+        # Audio seconds of the waiting jobs
+        self.waiting_seconds = 0.0
+        self.waits = {"short": deque(maxlen=history), "long": deque(maxlen=history)}
+        self.latencies = {"short": deque(maxlen=history), "long": deque(maxlen=history)}
+        self._heap = []
+        self._seq = itertools.count()
+        self._room_waiters = []
+
+    def _can_start(self, lane):
+        if sum(self.busy.values()) >= self.slots:
+            return False
+        if lane == "short" or self.waiting["short"] == 0:
+            return True
+        return self.busy["long"] < self.slots - self.short_reserved
+
+    def _dispatch(self):
+        blocked = []
+        while self._heap and sum(self.busy.values()) < self.slots:
+            ticket = heapq.heappop(self._heap)
+            if ticket.future.cancelled():
+                continue
+            if not self._can_start(ticket.lane):
+                blocked.append(ticket)
+                continue
+            self.busy[ticket.lane] += 1
+            self._leave_queue(ticket)
+            ticket.started = time.monotonic()
+            self.waits[ticket.lane].append(ticket.started - ticket.enqueued)
+            ticket.future.set_result(None)
+        for ticket in blocked:
+            heapq.heappush(self._heap, ticket)
+        self._wake_room_waiters()
+
+    def _leave_queue(self, ticket):
+        self.waiting[ticket.lane] -= 1
+        self.waiting_seconds = self.waiting_seconds - ticket.duration if any(self.waiting.values()) else 0.0
+
+    def _wake_room_waiters(self):
+        waiters, self._room_waiters = self._room_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def wait_for_room(self, limit_seconds):
+        """
+        Backpressure for the stage that feeds us: wait while limit_seconds of audio are already waiting and every
+        slot is busy. The backlog is measured in audio rather than tickets, since one long upload queues many
+        windows; an idle slot always lets the next job through.
+        """
+        while self.waiting_seconds >= limit_seconds and sum(self.busy.values()) >= self.slots:
+            future = asyncio.get_running_loop().create_future()
+            self._room_waiters.append(future)
+            await future
+
+    async def acquire(self, duration):
+        """Wait for a worker slot; returns the ticket to hand back to release()."""
+        lane = "short" if duration < self.short_seconds else "long"
+        ticket = JobTicket(duration, lane, duration + self.aging_rate * time.monotonic(), next(self._seq))
+        self.waiting[lane] += 1
+        self.waiting_seconds += duration
+        heapq.heappush(self._heap, ticket)
+        self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.started is not None:
+                # The slot was granted just as the caller went away
+                self.release(ticket)
+            else:
+                self._leave_queue(ticket)
+                self._wake_room_waiters()
+            raise
+        return ticket
+
+    def release(self, ticket):
+        self.busy[ticket.lane] -= 1
+        self.latencies[ticket.lane].append(time.monotonic() - ticket.enqueued)
+        self._dispatch()
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return {"count": 0}
+        values = np.fromiter(values, dtype=np.float64)
+        return {
+            "count": len(values),
+            "mean": round(float(values.mean()), 3),
+            "p50": round(float(np.percentile(values, 50)), 3),
+            "p95": round(float(np.percentile(values, 95)), 3),
+            "max": round(float(values.max()), 3),
+        }
+
+    def lane_stats(self):
+        return {
+            lane: {
+                "running": self.busy[lane],
+                "waiting": self.waiting[lane],
+                "wait_seconds": self._summary(self.waits[lane]),
+                "latency_seconds": self._summary(self.latencies[lane]),
+            }
+            for lane in ("short", "long")
+        }
+
+
+job_scheduler = JobScheduler(TRANSCRIBE_CONCURRENCY, SJF_AGING_RATE, SHORT_LANE_SECONDS, SHORT_LANE_RESERVED)
+
+
+# --- Job store ---
+
+class JobStore:
+    """Journal of batch jobs in SQLite, so queued and finished work survives a restart."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    filename TEXT,
+                    input_path TEXT,
+                    options TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+
+    def create(self, job_id, filename, input_path, options):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, filename, input_path, options, created_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, filename, input_path, json.dumps(options), time.time()),
+            )
+
+    def start(self, job_id):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id, result=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                ("failed" if error else "done", json.dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+
+    def unfinished(self):
+        """Jobs that were queued or running when the service last stopped, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        del job["input_path"]
+        return job
+
+    def get_input(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT filename, input_path, options FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["filename"], row["input_path"], json.loads(row["options"])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+job_store = None
+job_queue = None
+
+
+def _finish_job(job_id, response=None, error=None):
+    """Journal the outcome of a job; blocking (SQLite, and serialising the result), so run it in an executor."""
+    job_store.finish(job_id, result=response, error=error)
+
+
+async def _retry_when_busy(job_id, deadline, attempt):
+    """
+    Await attempt(), waiting out 429/503 responses for as long as their Retry-After says: jobs wait for capacity
+    instead of being turned away, until deadline (time.monotonic()) has passed. Other failures are raised as is.
+    """
+    while True:
+        try:
+            return await attempt()
+        except HTTPException as e:
+            retry_after = (e.headers or {}).get("Retry-After")
+            if e.status_code not in (429, 503) or retry_after is None:
+                raise
+            if time.monotonic() + int(retry_after) > deadline:
+                raise HTTPException(
+                    status_code=e.status_code, detail=f"{e.detail} (still busy after {JOB_RETRY_SECONDS:.0f}s)"
+                )
+            logging.info(f"Job {job_id} retrying in {retry_after}s: {e.detail}")
+            await asyncio.sleep(int(retry_after))
+
+
+async def _run_job(job_id):
+    loop = asyncio.get_running_loop()
+    filename, input_path, options = await loop.run_in_executor(None, job_store.get_input, job_id)
+    await loop.run_in_executor(None, job_store.start, job_id)
+    logging.info(f"Running job {job_id} ({filename})")
+    deadline = time.monotonic() + JOB_RETRY_SECONDS
+
+    async def decode():
+        try:
+            with open(input_path, "rb") as f:
+                upload = UploadFile(file=f, filename=filename, size=os.path.getsize(input_path))
+                return await _decode_audio(upload, account)
+        except BaseException:
+            # Give back whatever the failed attempt had reserved before the next one
+            account.release(account.reserved)
+            raise
+
+    def transcribe():
+        return _transcribe_audio(
+            samples, account, filename, options.get("long_audio"), model=options.get("model"),
+            cascade_model=options.get("cascade_model"), short_audio_ctx=options.get("short_audio_ctx"),
+        )
+
+    try:
+        # Decoded once; only the transcription is retried while the workers are busy
+        with _memory_account() as account:
+            samples = await _retry_when_busy(job_id, deadline, decode)
+            result, _ = await _retry_when_busy(job_id, deadline, transcribe)
+        await loop.run_in_executor(None, _finish_job, job_id, _build_response(result))
+        logging.info(f"Job {job_id} done")
+    except HTTPException as e:
+        logging.error(f"Job {job_id} failed: {e.detail}")
+        await loop.run_in_executor(None, _finish_job, job_id, None, str(e.detail))
+    except OSError as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        await loop.run_in_executor(None, _finish_job, job_id, None, str(e))
+
+    shutil.rmtree(os.path.dirname(input_path), ignore_errors=True)
+
+
+async def _job_runner():
+    while True:
+        job_id = await job_queue.get()
+        try:
+            await _run_job(job_id)
+        except Exception:
+            logging.exception(f"Unexpected error while running job {job_id}")
+            await asyncio.get_running_loop().run_in_executor(None, _finish_job, job_id, None, "Internal error")
+        finally:
+            job_queue.task_done()
+
+
+model_registry = None
+
+# Stage limits are created inside the running event loop (asyncio primitives bind to it on Python 3.9)
+transcribe_executor = None
+
+
+async def _watch_workers():
+    while True:
+        await asyncio.sleep(WORKER_CHECK_SECONDS)
+        for model in list(model_registry.loaded.values()):
+            await asyncio.get_running_loop().run_in_executor(None, model.pool.replace_dead)
+
+
+async def _unload_idle_models():
+    while True:
+        await asyncio.sleep(min(60, MODEL_IDLE_SECONDS / 2))
+        await model_registry.unload_idle()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global model_registry, transcribe_executor, job_store, job_queue
+    convert_stage.open()
+    transcribe_executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_CONCURRENCY, thread_name_prefix="transcribe")
+
+    trace_handler = None
+    if TRACE_LOG_PATH:
+        os.makedirs(os.path.dirname(TRACE_LOG_PATH) or ".", exist_ok=True)
+        trace_handler = logging.handlers.RotatingFileHandler(
+            TRACE_LOG_PATH, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS
+        )
+        trace_handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_log.addHandler(trace_handler)
+        trace_log.setLevel(logging.INFO)
+        logging.info(f"Writing request traces to {TRACE_LOG_PATH}")
+
+    registry = ModelRegistry(
+        MODELS_DIR, MODEL_PATH, MODEL_MEMORY_BUDGET, MODEL_IDLE_SECONDS, WORKER_COUNT, MODEL_WORKERS
+    )
+    unloader = watcher = None
+    try:
+        await registry.load(registry.default)
+        model_registry = registry
+        logging.info(f"Models available in {MODELS_DIR}: {', '.join(sorted(registry.paths))}")
+        if VAD_DEFAULT and not os.path.exists(VAD_MODEL_PATH):
+            logging.warning(f"VAD=1 but there is no VAD model at {VAD_MODEL_PATH}; transcribing without VAD")
+        unloader = asyncio.create_task(_unload_idle_models())
+        watcher = asyncio.create_task(_watch_workers())
+    except WorkerError as e:
+        logging.error(f"Failed to start transcription workers: {e}")
+
+    job_queue = asyncio.Queue()
+    runners = []
+    try:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        job_store = JobStore(JOBS_DB_PATH)
+    except (OSError, sqlite3.Error) as e:
+        logging.error(f"Failed to open the job store at {JOBS_DB_PATH}: {e}")
+    if job_store is not None:
+        # Pick up work that was queued or interrupted by the last shutdown
+        for job_id in job_store.unfinished():
+            job_queue.put_nowait(job_id)
+        logging.info(f"Job store ready, {job_queue.qsize()} unfinished jobs resumed")
+        if model_registry is not None:
+            runners = [asyncio.create_task(_job_runner()) for _ in range(JOBS_CONCURRENCY)]
+
+    yield
+
+    for runner in runners:
+        runner.cancel()
+    for task in (unloader, watcher):
+        if task is not None:
+            task.cancel()
+    if job_store is not None:
+        job_store.close()
+        job_store = None
+    if model_registry is not None:
+        model_registry.stop()
+        model_registry = None
+    transcribe_executor.shutdown(wait=False)
+    if trace_handler is not None:
+        trace_log.removeHandler(trace_handler)
+        trace_handler.close()
+
+
+async def _run_ffmpeg(args, input_file=None, account=None, timeout=FFMPEG_TIMEOUT):
+    """
+    Run ffmpeg without blocking the event loop, at CONVERT_NICE priority.
+    Callers hold a convert_stage slot, which bounds how many run at a time.
+    If input_file is given, its contents are streamed to ffmpeg's stdin while stdout is being read.
+    If account is given, stdout is charged to it as it arrives and ffmpeg is killed once the limit is hit.
+    Returns (stdout bytes, stderr text).
+    Raises subprocess.CalledProcessError / subprocess.TimeoutExpired like subprocess.run(check=True).
+    """
+    stdout = bytearray()
+
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", *args,
+        stdin=asyncio.subprocess.PIPE if input_file is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    if CONVERT_NICE:
+        # Set from here rather than with preexec_fn, which isn't safe to run in a process that has threads
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, CONVERT_NICE)
+        except OSError as e:
+            logging.warning(f"Could not lower the priority of ffmpeg (pid {process.pid}): {e}")
+
+    async def feed_stdin():
+        try:
+            while True:
+                chunk = await input_file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg stopped reading; its exit status and stderr say why
+            pass
+        finally:
+            process.stdin.close()
+
+    async def read_stdout():
+        while True:
+            chunk = await process.stdout.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if account is not None:
+                account.add(len(chunk))
+            stdout.extend(chunk)
+
+    tasks = [read_stdout(), process.stderr.read()]
+    if input_file is not None:
+        tasks.append(feed_stdin())
+
+    pipes = asyncio.gather(*tasks)
+    try:
+        _, stderr, *_ = await asyncio.wait_for(pipes, timeout)
+        await process.wait()
+    except BaseException as e:
+        # Timed out, over the memory limit, or the caller was cancelled: don't leave ffmpeg running
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        # The pipes are closed now, so the readers finish; retrieve their outcome so it isn't logged as lost
+        await asyncio.wait([pipes])
+        if not pipes.cancelled():
+            pipes.exception()
+        if isinstance(e, asyncio.TimeoutError):
+            raise subprocess.TimeoutExpired(["ffmpeg", *args], timeout)
+        raise
+    finally:
+        if account is not None and process.returncode != 0:
+            account.release(len(stdout))
+
+    stderr = stderr.decode("utf-8", errors="replace")
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, ["ffmpeg", *args], bytes(stdout), stderr)
+    return stdout, stderr
+
+
+# --- WAV fast path ---
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+WAV_HEADER_PROBE_SIZE = 64 * 1024
+RESAMPLE_BLOCK_SIZE = 1 << 20
+RESAMPLE_FILTER_TAPS = 63
+
+WavInfo = namedtuple("WavInfo", ["format_tag", "channels", "sample_rate", "bits_per_sample", "data_offset", "data_size"])
+
+
+def _parse_wav_header(header):
+    """
+    Parse the RIFF/WAVE header at the start of an upload.
+    Returns a WavInfo for uncompressed PCM/float WAVs we can decode in-process, None for anything else.
+    """
+    if len(header) < 12 or header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(header):
+        chunk_id = header[pos:pos + 4]
+        chunk_size = struct.unpack_from("<I", header, pos + 4)[0]
+        body = pos + 8
+
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or body + 16 > len(header):
+                return None
+            format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", header, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                if chunk_size < 40 or body + 26 > len(header):
+                    return None
+                # The first two bytes of the SubFormat GUID carry the actual format tag
+                format_tag = struct.unpack_from("<H", header, body + 24)[0]
+            fmt = (format_tag, channels, sample_rate, bits_per_sample)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            format_tag, channels, sample_rate, bits_per_sample = fmt
+            supported = (
+                (format_tag == WAVE_FORMAT_PCM and bits_per_sample in (8, 16, 24, 32)) or
+                (format_tag == WAVE_FORMAT_IEEE_FLOAT and bits_per_sample == 32)
+            )
+            if not supported or channels < 1 or not 8000 <= sample_rate <= 192000:
+                return None
+            # Streamed WAVs (e.g. written by ffmpeg to a pipe) leave the size as 0 or 0xFFFFFFFF
+            data_size = None if chunk_size in (0, 0xFFFFFFFF) else chunk_size
+            return WavInfo(format_tag, channels, sample_rate, bits_per_sample, body, data_size)
+
+        pos = body + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def _wav_to_float32(data, info):
+    """Convert the interleaved WAV sample bytes to float32 frames of shape (n, channels)."""
+    sample_width = info.bits_per_sample // 8
+    frame_width = sample_width * info.channels
+    data = data[:len(data) - len(data) % frame_width]
+
+    if info.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        samples = np.frombuffer(data, dtype="<f4")
+    elif sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif sample_width == 2:
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = np.where(values & 0x800000, values - 0x1000000, values)
+        samples = values.astype(np.float32) / 8388608.0
+    else:
+        samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / 2147483648.0
+
+    return samples.reshape(-1, info.channels)
+
+
+def _lowpass(samples, cutoff):
+    """Windowed-sinc low-pass filter; cutoff is in cycles per sample (0 < cutoff < 0.5)."""
+    n = np.arange(RESAMPLE_FILTER_TAPS) - (RESAMPLE_FILTER_TAPS - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(RESAMPLE_FILTER_TAPS)
+    taps = (taps / taps.sum()).astype(np.float32)
+
+    half = RESAMPLE_FILTER_TAPS // 2
+    padded = np.pad(samples, (half, half))
+    out = np.empty_like(samples)
+    for start in range(0, len(samples), RESAMPLE_BLOCK_SIZE):
+        end = min(start + RESAMPLE_BLOCK_SIZE, len(samples))
+        out[start:end] = np.convolve(padded[start:end + 2 * half], taps, mode="valid")
+    return out
+
+
+def _resample(samples, src_rate, dst_rate=WHISPER_SAMPLE_RATE):
+    """Resample mono float32 audio with an anti-aliasing filter and linear interpolation."""
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    if src_rate > dst_rate:
+        # Keep a little headroom below the new Nyquist frequency
+        samples = _lowpass(samples, 0.45 * dst_rate / src_rate)
+
+    step = src_rate / dst_rate
+    n_out = int(len(samples) / step)
+    out = np.empty(n_out, dtype=np.float32)
+    for start in range(0, n_out, RESAMPLE_BLOCK_SIZE):
+        end = min(start + RESAMPLE_BLOCK_SIZE, n_out)
+        positions = np.arange(start, end) * step
+        index = positions.astype(np.int64)
+        frac = (positions - index).astype(np.float32)
+        nxt = np.minimum(index + 1, len(samples) - 1)
+        out[start:end] = samples[index] * (1.0 - frac) + samples[nxt] * frac
+    return out
+
+
+async def _decode_wav(file, info, account, max_seconds=None):
+    """Decode a WAV upload in-process to 16 kHz mono float32 samples, reading it in fixed-size chunks."""
+    frame_width = info.bits_per_sample // 8 * info.channels
+    # The header's size is only a claim; never reserve or allocate for more data than the upload holds
+    available = None if file.size is None else max(0, file.size - info.data_offset)
+    data_size = info.data_size
+    if data_size is None:
+        data_size = available or 0
+    elif available is not None:
+        data_size = min(data_size, available)
+    n_frames = data_size // frame_width
+    if max_seconds is not None:
+        n_frames = min(n_frames, int(max_seconds * info.sample_rate))
+    if n_frames / info.sample_rate > MAX_AUDIO_SECONDS:
+        raise AudioTooLargeError(f"Audio is longer than the maximum of {MAX_AUDIO_SECONDS:.0f}s")
+
+    # The 16 kHz output, plus the mono samples at the source rate while they are being resampled
+    account.add(int(n_frames * WHISPER_SAMPLE_RATE / info.sample_rate) * 4)
+    resampling = info.sample_rate != WHISPER_SAMPLE_RATE
+    if resampling:
+        account.add(n_frames * 4, transient=True)
+
+    mono = np.empty(n_frames, dtype=np.float32)
+    chunk_size = max(1, UPLOAD_CHUNK_SIZE // frame_width) * frame_width
+    filled = 0
+    pending = b""
+
+    await file.seek(info.data_offset)
+    while filled < n_frames:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        if pending:
+            chunk = pending + chunk
+        usable = len(chunk) - len(chunk) % frame_width
+        pending = chunk[usable:]
+
+        frames = _wav_to_float32(memoryview(chunk)[:usable], info)[:n_frames - filled]
+        if info.channels == 1:
+            mono[filled:filled + len(frames)] = frames[:, 0]
+        else:
+            mono[filled:filled + len(frames)] = frames.mean(axis=1, dtype=np.float32)
+        filled += len(frames)
+
+    samples = await asyncio.get_running_loop().run_in_executor(None, _resample, mono[:filled], info.sample_rate)
+    if resampling:
+        account.release(n_frames * 4)
+    return samples
+
+
+# Raw 16 kHz mono float32 PCM on stdout
+FFMPEG_PCM_OUTPUT_ARGS = ["-f", "f32le", "-acodec", "pcm_f32le", "-ar", str(WHISPER_SAMPLE_RATE), "-ac", "1", "pipe:1"]
+
+
+def _duration_args(max_seconds):
+    return ["-t", str(max_seconds)] if max_seconds is not None else []
+
+
+async def _decode_pipe(file, account, max_seconds=None):
+    """Stream the upload through ffmpeg's stdin and read the PCM back from its stdout; nothing touches the disk."""
+    logging.info(f"Decoding {file.filename} through an ffmpeg pipe")
+    stdout, _ = await _run_ffmpeg(
+        ["-hide_banner", "-i", "pipe:0", *_duration_args(max_seconds), *FFMPEG_PCM_OUTPUT_ARGS],
+        input_file=file, account=account,
+    )
+    return np.frombuffer(stdout, dtype="<f4")
+
+
+async def _decode_file(file, account, max_seconds=None):
+    """Save the upload to a temp file and let ffmpeg decode it from there, for inputs that need a seekable source."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        original_filepath = os.path.join(temp_dir, os.path.basename(file.filename or "upload"))
+
+        size = 0
+        with open(original_filepath, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                size += len(chunk)
+        logging.info(f"Saved {size} bytes to {original_filepath}")
+
+        logging.info(f"Converting audio with ffmpeg: {original_filepath}")
+        stdout, _ = await _run_ffmpeg(
+            ["-hide_banner", "-nostdin", "-i", original_filepath, *_duration_args(max_seconds), *FFMPEG_PCM_OUTPUT_ARGS],
+            account=account,
+        )
+    return np.frombuffer(stdout, dtype="<f4")
+
+
+async def _decode_upload(file, account, max_seconds=None):
+    """
+    Decode an upload to 16 kHz mono float32 samples, charging the decoded audio to the request's memory account.
+    Uncompressed WAVs are handled in-process; everything else goes through ffmpeg according to AUDIO_DECODE_MODE.
+    With max_seconds, only the start of the audio is decoded.
+    """
+    if WAV_FAST_PATH:
+        info = _parse_wav_header(await file.read(WAV_HEADER_PROBE_SIZE))
+        await file.seek(0)
+        if info is not None:
+            logging.info(
+                f"WAV fast path for {file.filename}: {info.sample_rate} Hz, {info.channels} channel(s), "
+                f"{info.bits_per_sample}-bit {'float' if info.format_tag == WAVE_FORMAT_IEEE_FLOAT else 'PCM'}"
+            )
+            return await _decode_wav(file, info, account, max_seconds)
+
+    if AUDIO_DECODE_MODE == "pipe":
+        # Some containers (e.g. MP4 with the index at the end) can only be demuxed from a seekable file;
+        # ffmpeg either fails or produces no audio for them when reading from a pipe
+        try:
+            samples = await _decode_pipe(file, account, max_seconds)
+            if len(samples) > 0:
+                return samples
+            logging.warning(f"Pipe decode of {file.filename} produced no audio, retrying from a temp file")
+        except subprocess.CalledProcessError as e:
+            logging.warning(f"Pipe decode of {file.filename} failed, retrying from a temp file: {e.stderr[-500:]}")
+        await file.seek(0)
+    return await _decode_file(file, account, max_seconds)
+
+
+def _transcribe_timeout(duration, model, cores):
+    """
+    How long a worker call on duration seconds of audio may take, from the measured speed of the model
+    scaled to the cores it was given. A model that hasn't finished a call yet is assumed to run in realtime.
+    """
+    expected = admission.expected_seconds(model, duration, cores)
+    timeout = max(TRANSCRIBE_TIMEOUT_MIN, TIMEOUT_RTF_FACTOR * (duration if expected is None else expected))
+    return min(timeout, TRANSCRIBE_TIMEOUT) if TRANSCRIBE_TIMEOUT else timeout
+
+
+def _audio_ctx_for(duration):
+    """
+    Encoder context for a clip of duration seconds (50 positions per second plus AUDIO_CTX_MARGIN_SECONDS),
+    rounded up to the next of AUDIO_CTX_BUCKETS. 0, the full 30 s window, if no bucket is large enough.
+    """
+    needed = math.ceil((duration + AUDIO_CTX_MARGIN_SECONDS) * 50)
+    return next((bucket for bucket in AUDIO_CTX_BUCKETS if bucket >= needed), 0)
+
+
+async def _transcribe_samples(samples, options, on_segment=None, trace=None):
+    """
+    Hand the samples to the worker pool from a thread, at most TRANSCRIBE_CONCURRENCY at a time,
+    shortest job first. Threads and processors are picked by the scheduler once the job gets its slot.
+    on_segment is called from the pool thread with each segment as it is decoded.
+    With options["short_audio_ctx"], short samples are encoded with a reduced audio context.
+    Cancelling the caller aborts the decode; the slot is held until the worker has stopped.
+    """
+    queued = time.monotonic()
+    thread_scheduler.waiting += 1
+    try:
+        ticket = await job_scheduler.acquire(len(samples) / WHISPER_SAMPLE_RATE)
+    finally:
+        thread_scheduler.waiting -= 1
+    STAGE_SECONDS.labels("queue").observe(time.monotonic() - queued)
+    if trace is not None:
+        trace.add("queue-wait", time.monotonic() - queued)
+    transcribe_stage.enter()
+
+    model = options.get("model") or model_registry.default
+    pool = None
+    thread_scheduler.running += 1
+    try:
+        pool = await model_registry.acquire(model, trace)
+        if ADAPTIVE_THREADS:
+            n_threads, n_processors = thread_scheduler.plan(len(samples) / WHISPER_SAMPLE_RATE)
+        else:
+            n_threads, n_processors = WORKER_THREADS, 1
+        if on_segment is not None:
+            # whisper_full_parallel only reports the segments of the later processors once all of them are done
+            n_processors = 1
+        options = {**options, "n_threads": n_threads, "n_processors": n_processors}
+        if options.get("short_audio_ctx"):
+            options["audio_ctx"] = _audio_ctx_for(len(samples) / WHISPER_SAMPLE_RATE)
+            if trace is not None and options["audio_ctx"]:
+                trace.info["audio_ctx"] = options["audio_ctx"]
+
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        stats = {}
+        cancel = threading.Event()
+        timeout = _transcribe_timeout(len(samples) / WHISPER_SAMPLE_RATE, model, n_threads * n_processors)
+        call = loop.run_in_executor(
+            transcribe_executor,
+            lambda: pool.transcribe(samples, options, timeout, on_segment=on_segment, stats=stats, cancel=cancel),
+        )
+        try:
+            result = await asyncio.shield(call)
+        except asyncio.CancelledError:
+            cancel.set()
+            await asyncio.wait({call})
+            if not call.cancelled() and isinstance(call.exception(), TranscriptionCancelled):
+                logging.info(f"Aborted the transcription of {len(samples) / WHISPER_SAMPLE_RATE:.1f}s of audio")
+            raise
+        for stage, seconds in stats.items():
+            if stage != "fallbacks":
+                STAGE_SECONDS.labels(stage).observe(seconds)
+        if trace is not None:
+            trace.add_engine_stats(stats)
+            trace.info.update(threads=n_threads, processors=n_processors)
+        if options.get("task", "transcribe") == "transcribe":
+            admission.observe(
+                len(samples) / WHISPER_SAMPLE_RATE, time.monotonic() - started, model, n_threads * n_processors
+            )
+        return result
+    finally:
+        if pool is not None:
+            model_registry.release(model)
+        thread_scheduler.running -= 1
+        transcribe_stage.leave()
+        job_scheduler.release(ticket)
+
+
+# --- Long audio ---
+
+SILENCE_FRAME_SAMPLES = WHISPER_SAMPLE_RATE * 30 // 1000
+
+
+def _find_cut_points(samples, chunk_seconds=CHUNK_SECONDS, search_seconds=CHUNK_SEARCH_SECONDS):
+    """
+    Pick window boundaries roughly chunk_seconds apart, each moved to the quietest 30 ms frame
+    within search_seconds of its target. Returns sample indices, starting with 0 and ending with len(samples).
+    """
+    n_frames = len(samples) // SILENCE_FRAME_SAMPLES
+    frames = samples[:n_frames * SILENCE_FRAME_SAMPLES].reshape(n_frames, SILENCE_FRAME_SAMPLES)
+    energy = np.einsum("ij,ij->i", frames, frames)
+
+    chunk = int(chunk_seconds * WHISPER_SAMPLE_RATE)
+    search = int(search_seconds * WHISPER_SAMPLE_RATE)
+    cuts = [0]
+    # Stop early enough that the last window is not a tiny leftover
+    while len(samples) - cuts[-1] > chunk * 1.5:
+        target = cuts[-1] + chunk
+        lo = max(cuts[-1] + search, target - search) // SILENCE_FRAME_SAMPLES
+        hi = min(n_frames, (target + search) // SILENCE_FRAME_SAMPLES)
+        if hi <= lo:
+            cuts.append(target)
+            continue
+        quietest = lo + int(np.argmin(energy[lo:hi]))
+        cuts.append(quietest * SILENCE_FRAME_SAMPLES + SILENCE_FRAME_SAMPLES // 2)
+    cuts.append(len(samples))
+    return cuts
+
+
+def _normalize_text(text):
+    return re.sub(r"[^\w]+", " ", text.lower()).strip()
+
+
+def _shift_segment(segment, offset_ms):
+    t0 = segment["offsets"]["from"] + offset_ms
+    t1 = segment["offsets"]["to"] + offset_ms
+    shifted = {
+        **segment,
+        "timestamps": {"from": _format_timestamp(t0 // 10), "to": _format_timestamp(t1 // 10)},
+        "offsets": {"from": t0, "to": t1},
+    }
+    if "tokens" in segment:
+        shifted["tokens"] = [_shift_segment(token, offset_ms) for token in segment["tokens"]]
+    return shifted
+
+
+def _stitch_windows(windows, results):
+    """
+    Merge per-window results back onto the original timeline.
+    Each window owns the span between its cut points; segments from the overlap are kept only by the
+    window whose span contains their midpoint, and a segment repeating the previous one's text is dropped.
+    """
+    segments = []
+    for (start, own_from, own_to, _), result in zip(windows, results):
+        offset_ms = start * 1000 // WHISPER_SAMPLE_RATE
+        own_from_ms = own_from * 1000 // WHISPER_SAMPLE_RATE
+        own_to_ms = own_to * 1000 // WHISPER_SAMPLE_RATE
+        for segment in result["transcription"]:
+            segment = _shift_segment(segment, offset_ms)
+            midpoint = (segment["offsets"]["from"] + segment["offsets"]["to"]) / 2
+            if not own_from_ms <= midpoint < own_to_ms:
+                continue
+            text = _normalize_text(segment["text"])
+            if segments and text and text == _normalize_text(segments[-1]["text"]):
+                continue
+            segments.append(segment)
+
+    languages = Counter(result["result"]["language"] for result in results)
+    return {
+        **results[0],
+        "result": {"language": languages.most_common(1)[0][0]},
+        "transcription": segments,
+        "chunks": [
+            {"from": start * 1000 // WHISPER_SAMPLE_RATE, "to": end * 1000 // WHISPER_SAMPLE_RATE}
+            for start, _, _, end in windows
+        ],
+    }
+
+
+async def _transcribe_long(samples, options, trace=None):
+    """Transcribe a long recording as overlapping windows spread over the worker pool, then stitch the segments."""
+    cuts = _find_cut_points(samples)
+    overlap = int(CHUNK_OVERLAP_SECONDS * WHISPER_SAMPLE_RATE)
+
+    # (window start, owned span start, owned span end, window end), all in samples
+    windows = []
+    for own_from, own_to in zip(cuts[:-1], cuts[1:]):
+        windows.append((max(0, own_from - overlap), own_from, own_to, min(len(samples), own_to + overlap)))
+
+    logging.info(
+        f"Splitting {len(samples) / WHISPER_SAMPLE_RATE:.1f}s of audio into {len(windows)} windows at "
+        f"{[round(cut / WHISPER_SAMPLE_RATE, 1) for cut in cuts[1:-1]]}s"
+    )
+    results = await asyncio.gather(*(
+        _transcribe_samples(samples[start:end], options, trace=trace) for start, _, _, end in windows
+    ))
+    if trace is not None:
+        trace.info["windows"] = len(windows)
+    return _stitch_windows(windows, results)
+
+
+# --- Model cascade ---
+
+def _compression_ratio(text):
+    """Bytes per zlib-compressed byte; repetitive (hallucinated) text compresses unusually well."""
+    data = text.encode("utf-8")
+    return len(data) / len(zlib.compress(data)) if data else 0.0
+
+
+def _needs_rerun(segment):
+    """Which of the cascade thresholds a first-pass segment misses (empty if it is confident enough)."""
+    confidence = segment.get("confidence", {})
+    reasons = []
+    if confidence.get("avg_token_p", 1.0) < CASCADE_MIN_TOKEN_PROB:
+        reasons.append("avg_token_p")
+    if confidence.get("no_speech_prob", 0.0) > CASCADE_MAX_NO_SPEECH_PROB:
+        reasons.append("no_speech_prob")
+    if _compression_ratio(segment["text"]) > CASCADE_MAX_COMPRESSION_RATIO:
+        reasons.append("compression_ratio")
+    return reasons
+
+
+def _rerun_regions(segments, padding_ms):
+    """
+    Group the indices of segments to re-run into regions, merging neighbours whose padded spans touch,
+    so the larger model sees a few consecutive weak segments with their shared context.
+    Returns [(first index, last index, region start ms, region end ms)].
+    """
+    regions = []
+    for i, segment in enumerate(segments):
+        if not _needs_rerun(segment):
+            continue
+        start = max(0, segment["offsets"]["from"] - padding_ms)
+        end = segment["offsets"]["to"] + padding_ms
+        if regions and regions[-1][1] == i - 1 and start <= regions[-1][3]:
+            first, _, region_start, _ = regions[-1]
+            regions[-1] = (first, i, region_start, end)
+        else:
+            regions.append((i, i, start, end))
+    return regions
+
+
+async def _cascade(samples, result, options, cascade_model, trace=None):
+    """
+    Re-run the low-confidence segments of a first-pass result on cascade_model and merge them back:
+    within each re-run region the larger model's segments replace the first pass's,
+    keeping those whose midpoint falls inside the span of the segments they replace.
+    """
+    segments = result["transcription"]
+    regions = _rerun_regions(segments, int(CASCADE_PADDING_SECONDS * 1000))
+    summary = {"model": cascade_model, "segments_rerun": 0, "regions": len(regions), "audio_seconds_rerun": 0.0}
+    if not regions:
+        return {**result, "cascade": summary}
+
+    rerun_options = {**options, "model": cascade_model}
+    results = await asyncio.gather(*(
+        _transcribe_samples(
+            samples[start * WHISPER_SAMPLE_RATE // 1000:end * WHISPER_SAMPLE_RATE // 1000], rerun_options, trace=trace
+        )
+        for _, _, start, end in regions
+    ))
+
+    merged = []
+    position = 0
+    for (first, last, start, end), rerun in zip(regions, results):
+        merged.extend(segments[position:first])
+        span_from = segments[first]["offsets"]["from"]
+        span_to = segments[last]["offsets"]["to"]
+        replacements = []
+        for segment in rerun["transcription"]:
+            segment = _shift_segment(segment, start)
+            midpoint = (segment["offsets"]["from"] + segment["offsets"]["to"]) / 2
+            if span_from <= midpoint <= span_to:
+                # Clip the padding back off so the replacements don't overlap the neighbouring segments
+                t0 = max(segment["offsets"]["from"], span_from)
+                t1 = min(segment["offsets"]["to"], span_to)
+                replacements.append({
+                    **segment,
+                    "timestamps": {"from": _format_timestamp(t0 // 10), "to": _format_timestamp(t1 // 10)},
+                    "offsets": {"from": t0, "to": t1},
+                    "model": cascade_model,
+                })
+        # If the larger model finds nothing there, keep what the first pass had rather than a gap
+        merged.extend(replacements or segments[first:last + 1])
+        position = last + 1
+        summary["segments_rerun"] += last - first + 1
+        summary["audio_seconds_rerun"] += (end - start) / 1000
+    merged.extend(segments[position:])
+
+    summary["audio_seconds_rerun"] = round(summary["audio_seconds_rerun"], 3)
+    logging.info(
+        f"Cascade re-ran {summary['segments_rerun']} of {len(segments)} segments in {len(regions)} regions "
+        f"({summary['audio_seconds_rerun']:.1f}s of audio) on {cascade_model}"
+    )
+    return {**result, "transcription": merged, "cascade": summary}
+
+
+# --- Voice activity detection ---
+
+def _compact_speech(samples, regions, gap_ms=VAD_GAP_MS):
+    """
+    Concatenate the speech regions ([from, to] in ms) of samples, gap_ms of silence apart.
+    Returns the compacted samples and the mapping of each region as (compacted from, original from, length) in ms.
+    """
+    per_ms = WHISPER_SAMPLE_RATE // 1000
+    gap = np.zeros(gap_ms * per_ms, dtype=np.float32)
+    parts, mapping = [], []
+    position = 0
+    for t0, t1 in regions:
+        t0, t1 = max(t0, 0), min(t1, len(samples) // per_ms)
+        if t1 <= t0:
+            continue
+        if parts:
+            parts.append(gap)
+            position += gap_ms
+        parts.append(samples[t0 * per_ms:t1 * per_ms])
+        mapping.append((position, t0, t1 - t0))
+        position += t1 - t0
+    return (np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)), mapping
+
+
+def _to_original(t, mapping, starts, start):
+    """Map a time (ms) on the compacted timeline back to the original; times in a gap snap to the nearer speech edge."""
+    i = max(bisect.bisect_right(starts, t) - 1, 0)
+    compacted_from, original_from, length = mapping[i]
+    if start and t - compacted_from > length and i + 1 < len(mapping):
+        # A segment starting in the gap starts with the next region's speech
+        return mapping[i + 1][1]
+    return original_from + min(max(t - compacted_from, 0), length)
+
+
+def _restore_timeline(segment, mapping, starts=None):
+    """Map a segment (and its tokens) from the compacted timeline back to the original audio."""
+    if starts is None:
+        starts = [compacted_from for compacted_from, _, _ in mapping]
+    t0 = _to_original(segment["offsets"]["from"], mapping, starts, start=True)
+    t1 = max(_to_original(segment["offsets"]["to"], mapping, starts, start=False), t0)
+    restored = {
+        **segment,
+        "timestamps": {"from": _format_timestamp(t0 // 10), "to": _format_timestamp(t1 // 10)},
+        "offsets": {"from": t0, "to": t1},
+    }
+    if "tokens" in segment:
+        restored["tokens"] = [_restore_timeline(token, mapping, starts) for token in segment["tokens"]]
+    return restored
+
+
+async def _strip_silence(samples, options, trace=None):
+    """
+    Run the VAD pre-pass on a worker and keep only the speech of samples.
+    Returns (compacted samples, mapping for _restore_timeline, summary for the response).
+    """
+    regions = await _transcribe_samples(
+        samples, {"task": "vad", "model": options["model"], "vad": options["vad"], "vad_model": VAD_MODEL_PATH},
+        trace=trace,
+    )
+    speech, mapping = _compact_speech(samples, regions)
+
+    duration = len(samples) / WHISPER_SAMPLE_RATE
+    speech_seconds = sum(length for _, _, length in mapping) / 1000
+    skipped_seconds = max(duration - speech_seconds, 0.0)
+    skipped_ratio = skipped_seconds / duration if duration else 0.0
+    VAD_AUDIO_SECONDS.labels("speech").inc(speech_seconds)
+    VAD_AUDIO_SECONDS.labels("skipped").inc(skipped_seconds)
+    VAD_SKIPPED_RATIO.observe(skipped_ratio)
+    if trace is not None:
+        trace.info["vad_skipped_ratio"] = round(skipped_ratio, 4)
+    logging.info(
+        f"VAD kept {speech_seconds:.1f}s of speech in {len(mapping)} regions, skipping {skipped_seconds:.1f}s "
+        f"({skipped_ratio:.0%}) of {duration:.1f}s"
+    )
+    return speech, mapping, {
+        "regions": len(mapping),
+        "speech_seconds": round(speech_seconds, 3),
+        "skipped_seconds": round(skipped_seconds, 3),
+        "skipped_ratio": round(skipped_ratio, 4),
+    }
+
+
+# --- Clip packing ---
+
+def _pack_clips(durations, window_seconds=PACK_WINDOW_SECONDS, gap_seconds=PACK_GAP_SECONDS,
+                max_clip_seconds=PACK_MAX_CLIP_SECONDS):
+    """
+    Group clip indices into windows of at most window_seconds, including a gap of gap_seconds between clips.
+    Longest clips are placed first (first-fit decreasing); clips above max_clip_seconds get a window of their own.
+    """
+    windows, used = [], []
+    for index in sorted(range(len(durations)), key=lambda i: durations[i], reverse=True):
+        duration = durations[index]
+        if duration > max_clip_seconds:
+            windows.append([index])
+            used.append(window_seconds)
+            continue
+        for w, window in enumerate(windows):
+            if used[w] + gap_seconds + duration <= window_seconds:
+                window.append(index)
+                used[w] += gap_seconds + duration
+                break
+        else:
+            windows.append([index])
+            used.append(duration)
+    return windows
+
+
+def _join_clips(clips, gap_seconds=PACK_GAP_SECONDS):
+    """
+    Concatenate clips with gap_seconds of silence in between.
+    Returns the samples, the (start, end) of each clip in ms, and the boundaries (ms) halfway through each gap.
+    """
+    gap = np.zeros(int(gap_seconds * WHISPER_SAMPLE_RATE), dtype=np.float32)
+    parts, spans, boundaries = [], [], []
+    position = 0
+    for i, clip in enumerate(clips):
+        if i:
+            parts.append(gap)
+            boundaries.append((position + len(gap) // 2) * 1000 // WHISPER_SAMPLE_RATE)
+            position += len(gap)
+        parts.append(clip)
+        spans.append((position * 1000 // WHISPER_SAMPLE_RATE, (position + len(clip)) * 1000 // WHISPER_SAMPLE_RATE))
+        position += len(clip)
+    return np.concatenate(parts), spans, boundaries
+
+
+def _is_text_token(token):
+    return not (token["text"].startswith("[_") and token["text"].endswith("]"))
+
+
+def _unpack_segments(segments, spans, boundaries):
+    """
+    Split the segments of a packed window into one list per clip, with clip-relative timestamps
+    clamped to the clip. A segment is assigned to the clip its midpoint falls in; one that spans a gap is cut
+    between its tokens.
+    """
+    per_clip = [[] for _ in spans]
+
+    def clamp(item, start, end):
+        t0 = min(max(item["offsets"]["from"], start), end)
+        t1 = min(max(item["offsets"]["to"], t0), end)
+        return {**item, "offsets": {"from": t0, "to": t1}}
+
+    def add(clip, segment):
+        start, end = spans[clip]
+        clamped = clamp(segment, start, end)
+        if "tokens" in segment:
+            clamped["tokens"] = [clamp(token, start, end) for token in segment["tokens"]]
+        per_clip[clip].append(_shift_segment(clamped, -start))
+
+    for segment in segments:
+        t0, t1 = segment["offsets"]["from"], segment["offsets"]["to"]
+        first = bisect.bisect_right(boundaries, t0)
+        last = bisect.bisect_right(boundaries, max(t0, t1 - 1))
+        tokens = [token for token in segment.get("tokens", []) if _is_text_token(token)]
+        if first == last or not tokens:
+            add(bisect.bisect_right(boundaries, (t0 + t1) / 2), segment)
+            continue
+
+        groups = {}
+        for token in tokens:
+            midpoint = (token["offsets"]["from"] + token["offsets"]["to"]) / 2
+            groups.setdefault(bisect.bisect_right(boundaries, midpoint), []).append(token)
+        for clip, group in sorted(groups.items()):
+            text = "".join(token["text"] for token in group)
+            if not text.strip():
+                continue
+            add(clip, {
+                **segment,
+                "offsets": {"from": group[0]["offsets"]["from"], "to": group[-1]["offsets"]["to"]},
+                "text": text,
+                "tokens": group,
+            })
+    return per_clip
+
+
+# --- Live streaming ---
+
+class LiveTranscriber:
+    """
+    Sliding-window decoding of a live 16 kHz PCM stream, following examples/stream.
+    Every step_ms of new audio is decoded together with the tail of the previous window (up to length_ms in total)
+    and reported as a partial hypothesis. Every length_ms / step_ms - 1 steps the hypothesis is final and
+    only keep_ms of audio is carried over into the next window.
+    """
+
+    def __init__(self, options, step_ms=LIVE_STEP_MS, length_ms=LIVE_LENGTH_MS, keep_ms=LIVE_KEEP_MS,
+                 max_backlog_ms=LIVE_MAX_BACKLOG_MS, sample_format="s16le"):
+        keep_ms = min(keep_ms, step_ms)
+        length_ms = max(length_ms, step_ms)
+
+        self.options = {**options, "single_segment": True, "no_timestamps": True, "no_context": True}
+        self.n_samples_step = step_ms * WHISPER_SAMPLE_RATE // 1000
+        self.n_samples_len = length_ms * WHISPER_SAMPLE_RATE // 1000
+        self.n_samples_keep = keep_ms * WHISPER_SAMPLE_RATE // 1000
+        self.n_samples_backlog = max(max_backlog_ms * WHISPER_SAMPLE_RATE // 1000, self.n_samples_step)
+        self.n_new_line = max(1, length_ms // step_ms - 1)
+        self.dtype = np.int16 if sample_format == "s16le" else np.float32
+
+        self.remainder = b""
+        self.pending = []
+        self.n_pending = 0
+        self.old = np.zeros(0, dtype=np.float32)
+        self.n_iter = 0
+        self.position = 0  # samples taken into a window so far
+        self.dropped = 0
+        self.unreported_drops = 0
+        self.last = None
+
+    def feed(self, data):
+        """Add a frame of raw PCM, dropping the oldest pending audio beyond the backlog."""
+        data = self.remainder + data
+        n_bytes = len(data) - len(data) % np.dtype(self.dtype).itemsize
+        self.remainder = data[n_bytes:]
+        samples = np.frombuffer(data[:n_bytes], dtype=self.dtype)
+        if self.dtype == np.int16:
+            samples = samples.astype(np.float32) / 32768.0
+        self.pending.append(samples)
+        self.n_pending += len(samples)
+
+        dropped = max(0, self.n_pending - self.n_samples_backlog)
+        if dropped:
+            pending = np.concatenate(self.pending)[dropped:]
+            self.pending = [pending]
+            self.n_pending = len(pending)
+            self.position += dropped
+            self.dropped += dropped
+            self.unreported_drops += dropped
+
+    def ready(self):
+        return self.n_pending >= self.n_samples_step
+
+    async def step(self, final=False):
+        """Decode all pending audio with the carried-over context; returns the hypothesis message."""
+        new = np.concatenate(self.pending) if self.pending else np.zeros(0, dtype=np.float32)
+        self.pending = []
+        self.n_pending = 0
+
+        # take up to length_ms of audio from the previous iteration
+        n_take = min(len(self.old), max(0, self.n_samples_keep + self.n_samples_len - len(new)))
+        window = np.concatenate([self.old[len(self.old) - n_take:], new])
+        self.position += len(new)
+
+        result = await _transcribe_samples(window, self.options)
+        text = "".join(segment["text"] for segment in result["transcription"]).strip()
+
+        self.n_iter += 1
+        final = final or self.n_iter % self.n_new_line == 0
+        if final:
+            # keep part of the audio for the next iteration to mitigate word boundary issues
+            self.old = window[len(window) - self.n_samples_keep:] if self.n_samples_keep else window[:0]
+        else:
+            self.old = window
+
+        self.last = {
+            "type": "final" if final else "partial",
+            "text": text,
+            "start": (self.position - len(window)) * 1000 // WHISPER_SAMPLE_RATE,
+            "end": self.position * 1000 // WHISPER_SAMPLE_RATE,
+        }
+        return self.last
+
+    async def finish(self):
+        """Finalize the stream: decode what is left, or promote the last partial hypothesis to final."""
+        if self.n_pending:
+            return await self.step(final=True)
+        if self.last is not None and self.last["type"] == "partial":
+            self.last = {**self.last, "type": "final"}
+            return self.last
+        return None
+
+    def drop_warning(self):
+        """A warning message for audio dropped since the last call, if any."""
+        if not self.unreported_drops:
+            return None
+        dropped_ms = self.unreported_drops * 1000 // WHISPER_SAMPLE_RATE
+        self.unreported_drops = 0
+        return {"type": "warning", "detail": f"Cannot decode fast enough, dropped {dropped_ms}ms of audio"}
+
+
+live_streams = 0
+
+# Registered last: the registry calls collect() right away to learn the metric names
+REGISTRY.register(_ServiceCollector())
 
-# Define paths for the model and binary
-MODEL_PATH = "/app/models/ggml-base.bin"
-WHISPER_BINARY_PATH = "/app/whisper.cpp/build/bin/whisper-cli"
 
 app = FastAPI(
     title="Whisper.cpp API",
     description="A simple API to run transcriptions using whisper.cpp",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
+app.add_middleware(MaxBodySizeMiddleware, max_bytes=MAX_UPLOAD_BYTES)
 
 @app.get("/", tags=["General"])
 async def root():
     """Root endpoint to check if the API is running."""
     return {"message": "Whisper.cpp API is running. Use the /transcribe endpoint to process files."}
 
+@app.get("/metrics", tags=["General"])
+async def metrics():
+    """Prometheus metrics: per-stage latency histograms, realtime factor, queue depth, workers, cache and errors."""
+    return Response(generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
 @app.get("/health", tags=["General"])
 async def health_check():
-    """Check if the model and binary are available."""
+    """Check if the default model and library are available and its workers are up; list the loaded models."""
     is_model_ok = os.path.exists(MODEL_PATH)
-    is_binary_ok = os.path.exists(WHISPER_BINARY_PATH) and os.access(WHISPER_BINARY_PATH, os.X_OK)
-    
-    logging.info(f"Health check - Model exists: {is_model_ok}, Binary executable: {is_binary_ok}")
+    is_library_ok = os.path.exists(WHISPER_LIBRARY_PATH)
+    default = model_registry.loaded.get(model_registry.default) if model_registry is not None else None
+    ready_workers = default.pool.ready_workers if default is not None else 0
+
+    logging.info(f"Health check - Model exists: {is_model_ok}, Library exists: {is_library_ok}, Workers ready: {ready_workers}")
     logging.info(f"Model path: {MODEL_PATH}")
-    logging.info(f"Binary path: {WHISPER_BINARY_PATH}")
-    
-    if is_model_ok and is_binary_ok:
-        return {"status": "healthy"}
-    
+    logging.info(f"Library path: {WHISPER_LIBRARY_PATH}")
+
+    if is_model_ok and is_library_ok and ready_workers > 0:
+        return {"status": "healthy", "workers": ready_workers, "models": model_registry.status()}
+
     raise HTTPException(
         status_code=503,
         detail={
             "status": "unhealthy",
             "checks": {
                 "model_found": is_model_ok,
-                "binary_executable": is_binary_ok,
+                "library_found": is_library_ok,
+                "workers_ready": ready_workers,
                 "model_path": MODEL_PATH,
-                "binary_path": WHISPER_BINARY_PATH
+                "library_path": WHISPER_LIBRARY_PATH
             }
         }
     )
 
+@app.get("/queue", tags=["General"])
+async def queue_status():
+    """
+    Report the transcription backlog, the current wait estimate, per-lane latencies and the occupancy
+    and utilisation of each pipeline stage.
+    """
+    return {
+        "queued_audio_seconds": round(admission.queued_seconds, 1),
+        "max_queued_audio_seconds": admission.max_queued_seconds,
+        "jobs": admission.jobs,
+        "running": thread_scheduler.running,
+        "waiting": thread_scheduler.waiting,
+        "realtime_factor": round(admission.rtf, 3),
+        "core_realtime_factor": {model: round(value, 3) for model, value in admission.core_rtf.items()},
+        "estimated_wait_seconds": round(admission.estimated_wait(), 1),
+        "lanes": job_scheduler.lane_stats(),
+        "pipeline": {
+            "convert": convert_stage.status(),
+            "queue": {
+                "waiting": sum(job_scheduler.waiting.values()),
+                "waiting_seconds": round(job_scheduler.waiting_seconds, 1),
+                "limit_seconds": PIPELINE_QUEUE_SECONDS,
+            },
+            "transcribe": transcribe_stage.status(),
+        },
+    }
+
+def _memory_account():
+    return MemoryAccount(pcm_memory_budget, int(MAX_AUDIO_SECONDS * WHISPER_SAMPLE_RATE * 4))
+
+
+async def _decode_audio(file, account, trace=None, max_seconds=None):
+    """
+    Decode an upload to 16 kHz mono PCM in the conversion stage, raising failures as HTTPException.
+    Decoding waits while PIPELINE_QUEUE_SECONDS of decoded audio is already waiting for a transcription slot,
+    unless the upload is small enough (PIPELINE_BYPASS_BYTES) to be decoded right away.
+    """
+    queued = time.monotonic()
+    try:
+        if file.size is None or file.size > PIPELINE_BYPASS_BYTES:
+            await job_scheduler.wait_for_room(PIPELINE_QUEUE_SECONDS)
+        async with convert_stage.slot():
+            started = time.monotonic()
+            if trace is not None:
+                trace.add("convert-wait", started - queued)
+            samples = await _decode_upload(file, account, max_seconds)
+        logging.info(f"Audio decoding successful: {len(samples)} samples ({account.reserved} bytes held)")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"FFmpeg conversion failed: {e.stderr}")
+        REQUEST_ERRORS.labels("conversion_failed").inc()
+        raise HTTPException(status_code=400, detail=f"Audio conversion failed: {e.stderr}")
+    except subprocess.TimeoutExpired:
+        logging.error("FFmpeg conversion timed out.")
+        REQUEST_ERRORS.labels("conversion_timeout").inc()
+        raise HTTPException(status_code=504, detail="Audio conversion timed out.")
+    except AudioTooLargeError as e:
+        logging.error(f"Rejecting {file.filename}: {e}")
+        REQUEST_ERRORS.labels("audio_too_long").inc()
+        raise HTTPException(status_code=413, detail=str(e))
+    except MemoryBudgetExceeded as e:
+        logging.error(f"Rejecting {file.filename}: {e}")
+        REQUEST_ERRORS.labels("memory_budget").inc()
+        # Buffers are given back as the transcriptions ahead finish
+        retry_after = max(1, math.ceil(admission.estimated_wait()))
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(retry_after)})
+    STAGE_SECONDS.labels("convert").observe(time.monotonic() - started)
+    if trace is not None:
+        trace.add("convert", time.monotonic() - started)
+
+    if len(samples) == 0:
+        REQUEST_ERRORS.labels("no_audio").inc()
+        raise HTTPException(status_code=400, detail="No audio found in the uploaded file.")
+    return samples
+
+
+def _resolve_model(name):
+    """Map the `model` request parameter to a registered model, raising a 400 that lists the available ones."""
+    try:
+        return model_registry.resolve(name)
+    except KeyError:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown model {name!r}; available: {', '.join(sorted(model_registry.paths))}"
+        )
+
+
+async def _cancel_on_disconnect(request, coro):
+    """
+    Await coro, but cancel it as soon as the client disconnects, so that its transcription is aborted
+    instead of running for nobody. The client is gone by then, so the 499 is only for the logs and traces.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                break
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+
+    logging.info(f"Client disconnected, cancelled {request.method} {request.url.path}")
+    REQUEST_ERRORS.labels("client_disconnected").inc()
+    raise HTTPException(status_code=499, detail="Client disconnected")
+
+
+@contextmanager
+def _transcription_errors(subject, model):
+    """Turn the failures of a transcription into the matching HTTPException; subject names the upload in the log."""
+    try:
+        yield
+    except TimeoutError:
+        logging.error("Whisper.cpp transcription timed out.")
+        REQUEST_ERRORS.labels("transcription_timeout").inc()
+        raise HTTPException(status_code=504, detail="Transcription timed out.")
+    except WorkerError as e:
+        logging.error(f"Whisper.cpp transcription failed: {e}")
+        REQUEST_ERRORS.labels("transcription_failed").inc()
+        raise HTTPException(status_code=500, detail=f"Transcription failed: {e}")
+    except QueueFullError as e:
+        logging.warning(f"Rejecting {subject}: {e}")
+        REQUEST_ERRORS.labels("queue_full").inc()
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except ModelTooLargeError as e:
+        # Waiting won't help, so no Retry-After
+        logging.warning(f"Cannot load model {model} for {subject}: {e}")
+        REQUEST_ERRORS.labels("model_unavailable").inc()
+        raise HTTPException(status_code=507, detail=str(e))
+    except ModelUnavailableError as e:
+        logging.warning(f"Cannot load model {model} for {subject}: {e}")
+        REQUEST_ERRORS.labels("model_unavailable").inc()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+
+async def _process_upload(
+    file, long_audio=None, trace=None, tokens=False, model=None, cascade_model=None, short_audio_ctx=None, vad=None
+):
+    """
+    Decode an upload and transcribe it with a registered model (the default if None), going through the
+    result cache and joining identical in-flight jobs.
+    With cascade_model, low-confidence segments are then re-run on that model.
+    Returns (raw result, cache status). Failures are raised as HTTPException.
+    Stage timings are added to trace, if given. With tokens, segments also list their tokens.
+    short_audio_ctx (SHORT_AUDIO_CTX if None) encodes short clips with a reduced audio context.
+    With vad (the VAD thresholds), only the speech found by the VAD pre-pass is transcribed.
+    """
+    with _memory_account() as account:
+        samples = await _decode_audio(file, account, trace)
+        return await _transcribe_audio(
+            samples, account, file.filename, long_audio, trace, tokens, model, cascade_model, short_audio_ctx, vad
+        )
+
+
+async def _transcribe_audio(
+    samples, account, subject, long_audio=None, trace=None, tokens=False, model=None, cascade_model=None,
+    short_audio_ctx=None, vad=None,
+):
+    """
+    The transcription half of _process_upload, for samples already decoded into account; subject names them
+    in the log. A shared transcription keeps account held until it is done, even if this caller goes away.
+    """
+    model = model or model_registry.default
+    options = {"language": "auto", "model": model}
+    if tokens:
+        options["tokens"] = True
+    if cascade_model:
+        options["confidence"] = True
+    if SHORT_AUDIO_CTX if short_audio_ctx is None else short_audio_ctx:
+        options["short_audio_ctx"] = True
+    if vad:
+        options["vad"] = vad
+
+    duration = len(samples) / WHISPER_SAMPLE_RATE
+    if trace is not None:
+        trace.info.update(audio_seconds=round(duration, 3), model=model)
+    if long_audio is None:
+        long_audio = duration > LONG_AUDIO_SECONDS
+
+    # Identical audio with identical decode parameters gives an identical result
+    cache_params = {**options, "model": model_registry.paths[model]}
+    if long_audio:
+        cache_params["chunking"] = [CHUNK_SECONDS, CHUNK_OVERLAP_SECONDS, CHUNK_SEARCH_SECONDS]
+    if options.get("short_audio_ctx"):
+        cache_params["audio_ctx_buckets"] = [AUDIO_CTX_BUCKETS, AUDIO_CTX_MARGIN_SECONDS]
+    if vad:
+        cache_params["vad_model"] = [VAD_MODEL_PATH, VAD_GAP_MS]
+    if cascade_model:
+        cache_params["cascade"] = [
+            model_registry.paths[cascade_model], CASCADE_MIN_TOKEN_PROB, CASCADE_MAX_NO_SPEECH_PROB,
+            CASCADE_MAX_COMPRESSION_RATIO, CASCADE_PADDING_SECONDS,
+        ]
+    cache_key = await asyncio.get_running_loop().run_in_executor(None, ResultCache.key, samples, cache_params)
+    result = await result_cache.get(cache_key)
+
+    if result is not None:
+        logging.info(f"Cache hit for {subject} ({cache_key[:12]})")
+        return result, "HIT"
+
+    async def run_transcription():
+        with admission.admit(duration):
+            logging.info(f"Transcribing {duration:.1f}s of audio with options {options}")
+            speech, mapping = samples, None
+            if vad:
+                speech, mapping, vad_summary = await _strip_silence(samples, options, trace)
+            if not len(speech):
+                result = {
+                    "params": {"model": model_registry.paths[model], "language": options["language"], "translate": False},
+                    "result": {"language": "unknown" if options["language"] == "auto" else options["language"]},
+                    "transcription": [],
+                }
+            elif long_audio:
+                result = await _transcribe_long(speech, options, trace)
+            else:
+                result = await _transcribe_samples(speech, options, trace=trace)
+            if cascade_model and result["transcription"]:
+                result = await _cascade(speech, result, options, cascade_model, trace)
+            if vad:
+                result = {
+                    **result,
+                    "transcription": [_restore_timeline(segment, mapping) for segment in result["transcription"]],
+                    "vad": vad_summary,
+                }
+        logging.info(f"Whisper transcription successful: {len(result['transcription'])} segments")
+        await result_cache.put(cache_key, result)
+        return result
+
+    # Run whisper transcription on an idle worker, or join an identical job that is already running
+    with _transcription_errors(subject, model):
+        result, shared = await transcription_flights.run(cache_key, run_transcription, account)
+
+    if shared:
+        logging.info(f"Joined in-flight transcription for {subject} ({cache_key[:12]})")
+    return result, "COALESCED" if shared else "MISS"
+
+
+RESPONSE_FIELDS = ("text", "segments", "raw", "tokens")
+DEFAULT_RESPONSE_FIELDS = ("text", "segments", "raw")
+
+
+def _parse_fields(fields):
+    """Parse the comma-separated `fields` query parameter."""
+    selected = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = [field for field in selected if field not in RESPONSE_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields {unknown}; choose from {', '.join(RESPONSE_FIELDS)}"
+        )
+    return selected
+
+
+def _build_response(result, fields=DEFAULT_RESPONSE_FIELDS):
+    """
+    Shape a raw transcription result into the /transcribe response body, keeping only the requested fields.
+    The language is always included; tokens are part of the segments.
+    """
+    # Extract transcription text
+    if "transcription" in result and result["transcription"]:
+        full_text = " ".join(seg.get("text", "").strip() for seg in result.get("transcription", []))
+    else:
+        # Alternative: try to get text from different possible structures
+        full_text = result.get("text", "")
+        if not full_text and "segments" in result:
+            full_text = " ".join(seg.get("text", "").strip() for seg in result.get("segments", []))
+
+    body = {"language": result.get("result", {}).get("language", "unknown")}
+    if "text" in fields:
+        body["full_text"] = full_text
+    if "segments" in fields or "tokens" in fields:
+        body["segments"] = result.get("transcription", result.get("segments", []))
+    if "raw" in fields:
+        body["raw_result"] = result  # Include raw result for debugging
+    return body
+
+
+def _compress(body, accept_encoding):
+    """Compress a response body with the best encoding the client accepts. Returns (body, encoding or None)."""
+    if not RESPONSE_COMPRESSION or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.partition(";")
+        q = params.replace(" ", "").partition("q=")[2]
+        try:
+            if q and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip())
+
+    if zstandard is not None and "zstd" in accepted:
+        return zstandard.ZstdCompressor(level=3).compress(body), "zstd"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+
 @app.post("/transcribe", tags=["Transcription"])
-async def transcribe_audio(file: UploadFile = File(...)):
+async def transcribe_audio(
+    request: Request,
+    file: UploadFile = File(...),
+    long_audio: Optional[bool] = Query(None, description="Split into parallel windows; by default only above LONG_AUDIO_SECONDS"),
+    fields: str = Query(",".join(DEFAULT_RESPONSE_FIELDS), description="Comma-separated subset of text, segments, raw, tokens"),
+    model: Optional[str] = Query(None, description="Model name from /health (e.g. base, large-v3-turbo); the default model if omitted"),
+    cascade_model: Optional[str] = Query(None, description="Re-run low-confidence segments on this (larger) model"),
+    short_audio_ctx: Optional[bool] = Query(None, description="Encode clips shorter than 30 s with a reduced audio context (faster, may cost accuracy); SHORT_AUDIO_CTX if omitted"),
+    vad: Optional[bool] = Query(None, description="Only transcribe the speech found by a Silero VAD pre-pass; VAD if omitted"),
+    vad_threshold: float = Query(VAD_THRESHOLD, ge=0, le=1, description="Speech probability above which a frame counts as speech"),
+    vad_min_speech_ms: int = Query(VAD_MIN_SPEECH_MS, ge=0, description="Shorter bursts of speech are ignored"),
+    vad_min_silence_ms: int = Query(VAD_MIN_SILENCE_MS, ge=0, description="Shorter pauses do not end a speech region"),
+    vad_speech_pad_ms: int = Query(VAD_SPEECH_PAD_MS, ge=0, description="Audio kept before and after each speech region"),
+):
     """
     Transcribe an audio or video file.
-    The file is first converted to a standard WAV format before processing.
+    The file is first decoded to 16 kHz mono PCM (with ffmpeg unless it is a plain WAV) before processing.
+    Long recordings are split into overlapping windows that are transcribed in parallel.
+    With cascade_model, segments the first model is unsure about are transcribed again with the larger model.
+    With short_audio_ctx, short clips skip encoding the silence that pads them to 30 s.
+    With vad, silence is cut out before transcribing; timestamps still refer to the original audio.
+    The Server-Timing header breaks down where the time went.
+    Large responses are compressed with zstd or gzip if the client accepts them.
     """
     logging.info(f"Processing file: {file.filename}, content type: {file.content_type}")
-    
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Save uploaded file
-        original_filepath = os.path.join(temp_dir, file.filename)
-        
-        with open(original_filepath, "wb") as f:
-            content = await file.read()
-            f.write(content)
-            logging.info(f"Saved {len(content)} bytes to {original_filepath}")
-            
-        wav_filepath = os.path.join(temp_dir, "input.wav")
+    selected = _parse_fields(fields)
+    trace = RequestTrace("/transcribe", file.filename, getattr(request.state, "upload_seconds", 0.0))
+
+    try:
+        if model_registry is None:
+            raise HTTPException(status_code=503, detail="Transcription workers are not available.")
+        model = _resolve_model(model)
+        cascade_model = _resolve_model(cascade_model) if cascade_model else None
+        vad_params = None
+        if vad is None:
+            vad = VAD_DEFAULT and os.path.exists(VAD_MODEL_PATH)
+        if vad:
+            if not os.path.exists(VAD_MODEL_PATH):
+                raise HTTPException(status_code=400, detail=f"VAD is not available: no VAD model at {VAD_MODEL_PATH}")
+            vad_params = {
+                "threshold": vad_threshold, "min_speech_ms": vad_min_speech_ms,
+                "min_silence_ms": vad_min_silence_ms, "speech_pad_ms": vad_speech_pad_ms,
+            }
+
+        with _transcription_errors(file.filename, model):
+            admission.check()
+
+        result, cache_status = await _cancel_on_disconnect(request, _process_upload(
+            file, long_audio, trace, tokens="tokens" in selected, model=model, cascade_model=cascade_model,
+            short_audio_ctx=short_audio_ctx, vad=vad_params,
+        ))
+    except HTTPException as e:
+        # Failed requests get their timing breakdown too: where did a 504 spend its time?
+        trace.write(e.status_code)
+        e.headers = {**(e.headers or {}), "Server-Timing": trace.server_timing()}
+        raise
+    trace.info["cache"] = cache_status
+
+    started = time.monotonic()
+    body = orjson.dumps(_build_response(result, selected))
+    trace.add("serialize", time.monotonic() - started)
+
+    headers = {
+        "X-Cache": cache_status,
+        "X-Cache-Hits": str(result_cache.hits),
+        "X-Cache-Misses": str(result_cache.misses),
+        "Vary": "Accept-Encoding",
+    }
+    started = time.monotonic()
+    body, encoding = await asyncio.get_running_loop().run_in_executor(
+        None, _compress, body, request.headers.get("accept-encoding", "")
+    )
+    if encoding:
+        trace.add("compress", time.monotonic() - started)
+        trace.info["encoding"] = encoding
+        headers["Content-Encoding"] = encoding
+    trace.write(200)
+
+    headers["Server-Timing"] = trace.server_timing()
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _segment_events(segments, task, subject, model):
+    """
+    Yield each segment as an SSE event while the transcription runs, then a final done or error event.
+    The status is already sent by then, so failures are reported in the error event's status_code.
+    """
+    try:
+        while not task.done():
+            get = asyncio.ensure_future(segments.get())
+            await asyncio.wait({get, task}, return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                break
+            yield _sse("segment", get.result())
+        # Segments are queued before the task finishes, so anything left is still in order
+        while not segments.empty():
+            yield _sse("segment", segments.get_nowait())
 
-        # Convert audio to WAV format
         try:
-            logging.info(f"Converting audio with ffmpeg: {original_filepath} -> {wav_filepath}")
-            result = subprocess.run(
-                [
-                    "ffmpeg", "-y", "-i", original_filepath,
-                    "-ar", "16000", "-ac", "1", "-c:a", "pcm_s16le",
-                    wav_filepath
-                ],
-                check=True, capture_output=True, text=True, timeout=180
-            )
-            logging.info(f"FFmpeg conversion successful. Output: {result.stdout}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"FFmpeg conversion failed: {e.stderr}")
-            raise HTTPException(status_code=400, detail=f"Audio conversion failed: {e.stderr}")
-        except subprocess.TimeoutExpired:
-            logging.error("FFmpeg conversion timed out.")
-            raise HTTPException(status_code=504, detail="Audio conversion timed out.")
-
-        # Check if WAV file was created
-        if not os.path.exists(wav_filepath):
-            raise HTTPException(status_code=500, detail="WAV file was not created by ffmpeg")
-
-        # Run whisper transcription
-        json_output_base = os.path.join(temp_dir, "output")
-        
-        cmd = [
-            WHISPER_BINARY_PATH,
-            "-f", wav_filepath,
-            "-m", MODEL_PATH,
-            "-oj",
-            "-of", json_output_base,
-            "-t", "4",  # Use 4 threads instead of auto
-            "-l", "auto",
-        ]
+            with _transcription_errors(subject, model):
+                response = _build_response(task.result())
+        except HTTPException as e:
+            yield _sse("error", {"status_code": e.status_code, "detail": e.detail})
+            return
+        except Exception:
+            logging.exception(f"Streaming transcription of {subject} failed")
+            REQUEST_ERRORS.labels("internal_error").inc()
+            yield _sse("error", {"status_code": 500, "detail": "Internal error"})
+            return
+        yield _sse("done", response)
+    finally:
+        # The client went away: abort the transcription rather than finish it for nobody
+        if not task.done():
+            logging.info("Stream client disconnected before the transcription finished, cancelling it")
+            REQUEST_ERRORS.labels("client_disconnected").inc()
+            task.cancel()
+
+
+@app.post("/transcribe/stream", tags=["Transcription"])
+async def transcribe_audio_stream(
+    file: UploadFile = File(...),
+    model: Optional[str] = Query(None, description="Model name from /health (e.g. base, large-v3-turbo); the default model if omitted"),
+    short_audio_ctx: Optional[bool] = Query(None, description="Encode clips shorter than 30 s with a reduced audio context; SHORT_AUDIO_CTX if omitted"),
+):
+    """
+    Transcribe an audio or video file and stream the segments as Server-Sent Events as soon as they are decoded.
+    Each `segment` event carries one segment; the final `done` event carries the same body as /transcribe,
+    or an `error` event is sent if the transcription fails. The file is transcribed in a single pass.
+    """
+    logging.info(f"Streaming file: {file.filename}, content type: {file.content_type}")
+
+    if model_registry is None:
+        raise HTTPException(status_code=503, detail="Transcription workers are not available.")
+    model = _resolve_model(model)
+
+    with _transcription_errors(file.filename, model):
+        admission.check()
+
+    loop = asyncio.get_running_loop()
+    segments = asyncio.Queue()
+    account = _memory_account()
+    try:
+        samples = await _decode_audio(file, account)
+        duration = len(samples) / WHISPER_SAMPLE_RATE
+        options = {"language": "auto", "model": model}
+        cache_params = {**options, "model": model_registry.paths[model]}
+        if SHORT_AUDIO_CTX if short_audio_ctx is None else short_audio_ctx:
+            options["short_audio_ctx"] = True
+            cache_params.update(short_audio_ctx=True, audio_ctx_buckets=[AUDIO_CTX_BUCKETS, AUDIO_CTX_MARGIN_SECONDS])
+        cache_key = await loop.run_in_executor(None, ResultCache.key, samples, cache_params)
+        result = await result_cache.get(cache_key)
+        if result is None:
+            with _transcription_errors(file.filename, model):
+                admission.reserve(duration)
+    except BaseException:
+        account.close()
+        raise
+
+    if result is not None:
+        account.close()
+        logging.info(f"Cache hit for {file.filename} ({cache_key[:12]})")
+        for segment in result["transcription"]:
+            segments.put_nowait(segment)
+        task = loop.create_future()
+        task.set_result(result)
+        cache_status = "HIT"
+    else:
+        # Not joined with identical in-flight jobs: a follower would only see the segments after the leader is done
+        async def run_transcription():
+            try:
+                logging.info(f"Streaming transcription of {duration:.1f}s of audio with options {options}")
+                result = await _transcribe_samples(
+                    samples, options, on_segment=lambda segment: loop.call_soon_threadsafe(segments.put_nowait, segment)
+                )
+                logging.info(f"Whisper transcription successful: {len(result['transcription'])} segments")
+                await result_cache.put(cache_key, result)
+                return result
+            finally:
+                admission.release(duration)
+                account.close()
+
+        task = asyncio.ensure_future(run_transcription())
+        cache_status = "MISS"
+
+    return StreamingResponse(
+        _segment_events(segments, task, file.filename, model),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": cache_status},
+    )
+
+
+@app.websocket("/transcribe/live")
+async def transcribe_live(
+    websocket: WebSocket,
+    step_ms: int = Query(LIVE_STEP_MS, ge=100, description="Decode every step_ms of new audio"),
+    length_ms: int = Query(LIVE_LENGTH_MS, ge=100, le=30000, description="Audio decoded per step, including carried-over context"),
+    keep_ms: int = Query(LIVE_KEEP_MS, ge=0, description="Audio carried over after a final hypothesis"),
+    max_backlog_ms: int = Query(LIVE_MAX_BACKLOG_MS, ge=100, description="Undecoded audio kept before the oldest is dropped"),
+    sample_format: str = Query("s16le", pattern="^(s16le|f32le)$"),
+    language: str = Query("auto"),
+    model: Optional[str] = Query(None, description="Model name from /health (e.g. base, large-v3-turbo); the default model if omitted"),
+    short_audio_ctx: Optional[bool] = Query(None, description="Encode each window with a reduced audio context; SHORT_AUDIO_CTX if omitted"),
+):
+    """
+    Live transcription of raw 16 kHz mono PCM sent as binary frames.
+    Replies with JSON `partial` and `final` hypotheses; send the text message `end` to flush the last audio
+    and close the stream.
+    """
+    global live_streams
 
+    await websocket.accept()
+    if model_registry is None:
+        await websocket.close(code=1013, reason="Transcription workers are not available.")
+        return
+    try:
+        model = model_registry.resolve(model)
+    except KeyError:
+        await websocket.close(code=1008, reason=f"Unknown model {model!r}")
+        return
+    if live_streams >= MAX_LIVE_STREAMS:
+        REQUEST_ERRORS.labels("too_many_streams").inc()
+        logging.warning(f"Rejecting live stream: {live_streams} streams already open")
+        await websocket.close(code=1013, reason=f"Too many live streams (limit {MAX_LIVE_STREAMS})")
+        return
+
+    live_streams += 1
+    options = {"language": language, "model": model}
+    if SHORT_AUDIO_CTX if short_audio_ctx is None else short_audio_ctx:
+        options["short_audio_ctx"] = True
+    stream = LiveTranscriber(
+        options, step_ms, length_ms, keep_ms, max_backlog_ms, sample_format
+    )
+    logging.info(
+        f"Live stream opened: step {step_ms}ms, length {length_ms}ms, keep {keep_ms}ms, {sample_format} "
+        f"({live_streams} open)"
+    )
+
+    wake = asyncio.Event()
+    ended = False
+
+    async def receive():
+        nonlocal ended
         try:
-            logging.info(f"Executing whisper command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=1200)
-            logging.info(f"Whisper transcription successful. Output: {result.stdout}")
-            if result.stderr:
-                logging.warning(f"Whisper stderr: {result.stderr}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Whisper.cpp failed with return code {e.returncode}")
-            logging.error(f"Whisper stdout: {e.stdout}")
-            logging.error(f"Whisper stderr: {e.stderr}")
-            raise HTTPException(status_code=500, detail=f"Transcription failed: {e.stderr}")
-        except subprocess.TimeoutExpired:
-            logging.error("Whisper.cpp transcription timed out.")
-            raise HTTPException(status_code=504, detail="Transcription timed out.")
-
-        # Read the JSON output
-        json_filepath = json_output_base + ".json"
-        if not os.path.exists(json_filepath):
-            # List files in temp directory for debugging
-            files_in_temp = os.listdir(temp_dir)
-            logging.error(f"JSON output file not found. Files in temp dir: {files_in_temp}")
-            raise HTTPException(status_code=500, detail="Transcription finished but output file was not found.")
-
-        try:
-            with open(json_filepath, 'r', encoding='utf-8') as f:
-                result = json.load(f)
-                logging.info(f"Successfully loaded JSON result with keys: {result.keys()}")
-        except json.JSONDecodeError as e:
-            logging.error(f"Failed to parse JSON output: {e}")
-            # Try to read the file content for debugging
-            with open(json_filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-                logging.error(f"JSON file content: {content[:1000]}...")
-            raise HTTPException(status_code=500, detail="Failed to parse transcription output")
-
-        # Extract transcription text
-        if "transcription" in result and result["transcription"]:
-            full_text = " ".join(seg.get("text", "").strip() for seg in result.get("transcription", []))
-        else:
-            # Alternative: try to get text from different possible structures
-            full_text = result.get("text", "")
-            if not full_text and "segments" in result:
-                full_text = " ".join(seg.get("text", "").strip() for seg in result.get("segments", []))
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return False
+                if message.get("bytes"):
+                    stream.feed(message["bytes"])
+                    wake.set()
+                elif message.get("text") == "end":
+                    return True
+        finally:
+            ended = True
+            wake.set()
+
+    def disconnected():
+        return receiver.done() and (receiver.cancelled() or receiver.exception() is not None or not receiver.result())
+
+    async def decode(step):
+        """Await a decode step, aborting its transcription if the client disconnects meanwhile (returns None)."""
+        task = asyncio.ensure_future(step)
+        try:
+            await asyncio.wait({task, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done() and disconnected():
+                logging.info("Live client disconnected, aborting the decode in progress")
+                REQUEST_ERRORS.labels("client_disconnected").inc()
+                return None
+            return await task
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+
+    receiver = asyncio.ensure_future(receive())
+    try:
+        while not ended:
+            await wake.wait()
+            wake.clear()
+            while stream.ready() and not disconnected():
+                hypothesis = await decode(stream.step())
+                if hypothesis is None:
+                    break
+                warning = stream.drop_warning()
+                if warning:
+                    await websocket.send_json(warning)
+                await websocket.send_json(hypothesis)
+
+        if await receiver:
+            # The client asked for the end of the stream: decode what is left and say goodbye
+            hypothesis = await decode(stream.finish())
+            warning = stream.drop_warning()
+            if warning:
+                await websocket.send_json(warning)
+            if hypothesis:
+                await websocket.send_json(hypothesis)
+            await websocket.close()
+    except (TimeoutError, WorkerError, ModelUnavailableError) as e:
+        logging.error(f"Live transcription failed: {e}")
+        REQUEST_ERRORS.labels("transcription_failed").inc()
+        await websocket.send_json({"type": "error", "detail": f"Transcription failed: {e}"})
+        await websocket.close(code=1011)
+    except Exception as e:
+        # Sending to a client that has gone away
+        logging.info(f"Live stream closed: {e!r}")
+    finally:
+        receiver.cancel()
+        live_streams -= 1
+        logging.info(
+            f"Live stream closed after {stream.position / WHISPER_SAMPLE_RATE:.1f}s of audio, "
+            f"{stream.dropped / WHISPER_SAMPLE_RATE:.1f}s dropped ({live_streams} open)"
+        )
+
+
+async def _detect_language(file, seconds, top_k, model):
+    """Language of one uploaded clip; failures are reported in the item instead of failing the whole batch."""
+    started = time.monotonic()
+    try:
+        with _memory_account() as account:
+            samples = await _decode_audio(file, account, max_seconds=seconds)
+            detection = await _transcribe_samples(samples, {"task": "detect_language", "model": model})
+    except HTTPException as e:
+        return {"filename": file.filename, "status_code": e.status_code, "error": e.detail}
+    except (TimeoutError, WorkerError, ModelUnavailableError) as e:
+        logging.error(f"Language detection failed for {file.filename}: {e}")
+        REQUEST_ERRORS.labels("detection_failed").inc()
+        return {"filename": file.filename, "status_code": 500, "error": str(e)}
+
+    return {
+        "filename": file.filename,
+        "language": detection["language"],
+        "probabilities": detection["probabilities"][:top_k],
+        "audio_seconds": round(len(samples) / WHISPER_SAMPLE_RATE, 3),
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+    }
+
+
+@app.post("/detect-language", tags=["Transcription"])
+async def detect_language(
+    files: List[UploadFile] = File(...),
+    seconds: float = Query(LANGUAGE_DETECT_SECONDS, gt=0, le=30, description="Only the first seconds of each clip are used"),
+    top_k: int = Query(5, ge=1, le=100, description="Number of ranked languages to return per clip"),
+    model: Optional[str] = Query(None, description="Model name from /health; must be multilingual"),
+):
+    """
+    Detect the spoken language of one or more clips without transcribing them.
+    Only the start of each clip is decoded, and the model runs just the encoder and the language-ID step.
+    The clips of a batch are spread over the warm workers in parallel.
+    """
+    if model_registry is None:
+        raise HTTPException(status_code=503, detail="Transcription workers are not available.")
+    model = _resolve_model(model)
+    if model.endswith(".en") or ".en-" in model:
+        raise HTTPException(status_code=400, detail=f"{model} is an English-only model and cannot detect languages")
+
+    with _transcription_errors(f"language detection of {len(files)} files", model):
+        admission.check()
+
+    results = await asyncio.gather(*(_detect_language(file, seconds, top_k, model) for file in files))
+    return {"model": model, "results": results}
+
+
+@app.post("/transcribe/batch", tags=["Transcription"])
+async def transcribe_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    language: str = Query("auto", description="Language of the clips; with auto it is detected once per packed window"),
+    model: Optional[str] = Query(None, description="Model name from /health (e.g. base, large-v3-turbo); the default model if omitted"),
+    tokens: bool = Query(False, description="Include the tokens of each segment"),
+):
+    """
+    Transcribe many short clips (e.g. voicemails) in one request.
+    The clips are packed, separated by short silences, into shared 30 s windows that each take a single
+    encoder pass, and the segments are split back to their clips by their timestamps.
+    Every segment names the index of its clip, with timestamps relative to the start of that clip.
+    """
+    logging.info(f"Processing batch of {len(files)} clips")
+    trace = RequestTrace("/transcribe/batch", f"{len(files)} files", getattr(request.state, "upload_seconds", 0.0))
+
+    if model_registry is None:
+        raise HTTPException(status_code=503, detail="Transcription workers are not available.")
+    model = _resolve_model(model)
+
+    with _transcription_errors(f"batch of {len(files)} clips", model):
+        admission.check()
+
+    # Token timestamps are needed to cut a segment that runs across the gap between two clips
+    options = {"language": language, "model": model, "tokens": True}
+    if SHORT_AUDIO_CTX:
+        options["short_audio_ctx"] = True
+
+    try:
+        with _memory_account() as account:
+            clips = [await _decode_audio(file, account, trace) for file in files]
+            durations = [len(clip) / WHISPER_SAMPLE_RATE for clip in clips]
+            windows = _pack_clips(durations)
+            total = sum(durations)
+            trace.info.update(audio_seconds=round(total, 3), model=model, clips=len(clips), packed_windows=len(windows))
+
+            async def run_window(window):
+                samples, spans, boundaries = _join_clips([clips[i] for i in window])
+                if len(window) == 1 and durations[window[0]] > LONG_AUDIO_SECONDS:
+                    result = await _transcribe_long(samples, options, trace)
+                else:
+                    result = await _transcribe_samples(samples, options, trace=trace)
+                return result, _unpack_segments(result["transcription"], spans, boundaries)
+
+            with _transcription_errors(f"a batch of {len(clips)} clips", model), admission.admit(total):
+                logging.info(f"Transcribing {len(clips)} clips ({total:.1f}s of audio) in {len(windows)} windows")
+                results = await _cancel_on_disconnect(
+                    request, asyncio.gather(*(run_window(window) for window in windows))
+                )
+    except HTTPException as e:
+        trace.write(e.status_code)
+        e.headers = {**(e.headers or {}), "Server-Timing": trace.server_timing()}
+        raise
+
+    started = time.monotonic()
+    items = [None] * len(clips)
+    for window, (result, per_clip) in zip(windows, results):
+        for index, segments in zip(window, per_clip):
+            segments = [{**segment, "clip": index} for segment in segments]
+            if not tokens:
+                segments = [{k: v for k, v in segment.items() if k != "tokens"} for segment in segments]
+            items[index] = {
+                "clip": index,
+                "filename": files[index].filename,
+                "duration": round(durations[index], 3),
+                "language": result["result"]["language"],
+                "full_text": " ".join(segment["text"].strip() for segment in segments),
+                "segments": segments,
+            }
+    body = orjson.dumps({"model": model, "windows": len(windows), "clips": items})
+    trace.add("serialize", time.monotonic() - started)
+    logging.info(f"Batch of {len(clips)} clips done in {len(windows)} windows")
+    trace.write(200)
+
+    return Response(body, media_type="application/json", headers={"Server-Timing": trace.server_timing()})
+
+
+# --- Batch jobs ---
+
+def _store_job(job_id, file, options):
+    """Copy an upload into its job directory and journal the job; blocking, so run it in an executor."""
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(job_dir)
+    input_path = os.path.join(job_dir, os.path.basename(file.filename or "upload"))
+    file.file.seek(0)
+    with open(input_path, "wb") as f:
+        shutil.copyfileobj(file.file, f, UPLOAD_CHUNK_SIZE)
+        size = f.tell()
+    job_store.create(job_id, file.filename, input_path, options)
+    return size
+
+
+@app.post("/jobs", tags=["Jobs"], status_code=202)
+async def create_jobs(
+    files: List[UploadFile] = File(...),
+    long_audio: Optional[bool] = Query(None, description="Split into parallel windows; by default only above LONG_AUDIO_SECONDS"),
+    model: Optional[str] = Query(None, description="Model name from /health (e.g. base, large-v3-turbo); the default model if omitted"),
+    cascade_model: Optional[str] = Query(None, description="Re-run low-confidence segments on this (larger) model"),
+    short_audio_ctx: Optional[bool] = Query(None, description="Encode clips shorter than 30 s with a reduced audio context (faster, may cost accuracy); SHORT_AUDIO_CTX if omitted"),
+):
+    """
+    Queue one or more files for transcription and return their job IDs immediately.
+    Poll GET /jobs/{job_id} for status and results.
+    """
+    if job_store is None:
+        raise HTTPException(status_code=503, detail="The job store is not available.")
+    if model_registry is not None:
+        model = _resolve_model(model)
+        cascade_model = _resolve_model(cascade_model) if cascade_model else None
+
+    options = {
+        "long_audio": long_audio, "model": model, "cascade_model": cascade_model, "short_audio_ctx": short_audio_ctx,
+    }
+    loop = asyncio.get_running_loop()
+    jobs = []
+    for file in files:
+        job_id = uuid.uuid4().hex
+        size = await loop.run_in_executor(None, _store_job, job_id, file, options)
+        await job_queue.put(job_id)
+        logging.info(f"Queued job {job_id} for {file.filename} ({size} bytes)")
+        jobs.append({"id": job_id, "filename": file.filename, "status": "queued"})
+
+    return {"jobs": jobs}
+
+
+@app.get("/jobs/{job_id}", tags=["Jobs"])
+async def get_job(job_id: str):
+    """Return the status of a batch job, with its transcription once it has finished."""
+    job = None
+    if job_store is not None:
+        job = await asyncio.get_running_loop().run_in_executor(None, job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
-        return {
-            "language": result.get("language", {}).get("language", "unknown") if isinstance(result.get("language"), dict) else result.get("language", "unknown"),
-            "full_text": full_text,
-            "segments": result.get("transcription", result.get("segments", [])),
-            "raw_result": result  # Include raw result for debugging
-        }
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
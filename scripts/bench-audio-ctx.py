@@ -0,0 +1,131 @@
+"""
+Compare latency and accuracy of the full 30 s audio context against the reduced context the service picks
+for short clips (SHORT_AUDIO_CTX / short_audio_ctx).
+
+Each sample is cut into clips of the given lengths and transcribed in-process with main.WhisperEngine, once with
+the full context and once with the bucketed one. The reduced transcript is scored against the full one by word
+error rate, so no reference transcripts are needed.
+
+    python scripts/bench-audio-ctx.py -m models/ggml-base.en.bin -f samples/jfk.wav -l 2,4,6,8,11
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import WHISPER_SAMPLE_RATE, WhisperEngine, _audio_ctx_for  # noqa: E402
+
+
+# Custom action to handle comma-separated list
+class ListAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, [float(val) for val in values.split(",")])
+
+
+parser = argparse.ArgumentParser(description="Benchmark the reduced audio context for short clips")
+parser.add_argument(
+    "-m",
+    "--model",
+    default=os.environ.get("WHISPER_MODEL_PATH", "models/ggml-base.en.bin"),
+    help="Model to benchmark (default: $WHISPER_MODEL_PATH or models/ggml-base.en.bin)",
+)
+parser.add_argument(
+    "--library",
+    default=os.environ.get("WHISPER_LIBRARY_PATH", "build/src/libwhisper.so"),
+    help="Path of libwhisper.so (default: $WHISPER_LIBRARY_PATH or build/src/libwhisper.so)",
+)
+parser.add_argument(
+    "-f",
+    "--filename",
+    dest="filenames",
+    action="append",
+    help="Audio file to cut clips from; may be repeated (default: samples/jfk.wav and samples/jfk.mp3)",
+)
+parser.add_argument(
+    "-l",
+    "--lengths",
+    action=ListAction,
+    default=[2, 4, 6, 8, 11],
+    help="Clip lengths in seconds (comma-separated, default: 2,4,6,8,11)",
+)
+parser.add_argument("-t", "--threads", type=int, default=4, help="Threads per transcription (default: 4)")
+parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per configuration; the median is reported (default: 3)")
+args = parser.parse_args()
+
+
+def load_audio(path):
+    """Decode any ffmpeg-readable file to 16 kHz mono float32."""
+    out = subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-i", path, "-f", "f32le", "-ac", "1", "-ar", str(WHISPER_SAMPLE_RATE), "pipe:1"],
+        check=True,
+        capture_output=True,
+    ).stdout
+    return np.frombuffer(out, dtype=np.float32)
+
+
+def words(result):
+    text = " ".join(segment["text"] for segment in result["transcription"])
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_error_rate(reference, hypothesis):
+    """Word-level Levenshtein distance divided by the reference length."""
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref in enumerate(reference, 1):
+        current = [i]
+        for j, hyp in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref != hyp)))
+        previous = current
+    return previous[-1] / max(len(reference), 1)
+
+
+def run(engine, samples, audio_ctx):
+    options = {"language": "en", "n_threads": args.threads, "audio_ctx": audio_ctx}
+    engine.transcribe(samples, options)  # warm-up, also allocates the encoder graph for this context size
+    wall, encode = [], []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        result = engine.transcribe(samples, options)
+        wall.append(time.perf_counter() - started)
+        encode.append(engine.timings().get("encode", 0.0))
+    return result, statistics.median(wall), statistics.median(encode)
+
+
+engine = WhisperEngine(args.library, args.model)
+filenames = args.filenames or ["samples/jfk.wav", "samples/jfk.mp3"]
+
+print(f"Model: {args.model}, threads: {args.threads}, runs: {args.repeat}")
+print()
+print("| Sample | Clip (s) | audio_ctx | Full (ms) | Reduced (ms) | Speedup | Encode full (ms) | Encode reduced (ms) | WER vs full |")
+print("| --- | --- | --- | --- | --- | --- | --- | --- | --- |")
+
+for filename in filenames:
+    audio = load_audio(filename)
+    for length in args.lengths:
+        samples = audio[: int(length * WHISPER_SAMPLE_RATE)]
+        duration = len(samples) / WHISPER_SAMPLE_RATE
+        if length > duration + 0.5:
+            continue
+        audio_ctx = _audio_ctx_for(duration)
+        if not audio_ctx:
+            print(f"| {os.path.basename(filename)} | {duration:.1f} | full | | | | | | |")
+            continue
+
+        full, full_wall, full_encode = run(engine, samples, 0)
+        reduced, reduced_wall, reduced_encode = run(engine, samples, audio_ctx)
+        wer = word_error_rate(words(full), words(reduced))
+        print(
+            f"| {os.path.basename(filename)} | {duration:.1f} | {audio_ctx} "
+            f"| {full_wall * 1000:.0f} | {reduced_wall * 1000:.0f} | {full_wall / reduced_wall:.2f}x "
+            f"| {full_encode * 1000:.0f} | {reduced_encode * 1000:.0f} | {wer:.1%} |"
+        )
+
+engine.close()
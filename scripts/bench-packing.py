@@ -0,0 +1,124 @@
+"""
+Throughput of /transcribe/batch (short clips packed into shared 30 s windows) against one /transcribe call per clip,
+measured against a running server.
+
+Short clips are cut from the bundled samples at random offsets. A little noise is mixed in so that every clip is
+unique and the result cache does not skew the comparison.
+
+    python scripts/bench-packing.py --url http://localhost:8000 -n 200 -c 4 -b 50
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import subprocess
+import time
+import urllib.request
+import uuid
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+parser = argparse.ArgumentParser(description="Benchmark clip packing against one clip per call")
+parser.add_argument("--url", default="http://localhost:8000", help="Server base URL (default: http://localhost:8000)")
+parser.add_argument(
+    "-f",
+    "--filename",
+    dest="filenames",
+    action="append",
+    help="Audio file to cut clips from; may be repeated (default: samples/jfk.wav)",
+)
+parser.add_argument("-n", "--clips", type=int, default=100, help="Number of clips (default: 100)")
+parser.add_argument("--min-seconds", type=float, default=2, help="Shortest clip (default: 2)")
+parser.add_argument("--max-seconds", type=float, default=5, help="Longest clip (default: 5)")
+parser.add_argument("-c", "--concurrency", type=int, default=4, help="Parallel requests in both modes (default: 4)")
+parser.add_argument("-b", "--batch-size", type=int, default=50, help="Clips per /transcribe/batch request (default: 50)")
+parser.add_argument("--seed", type=int, default=0, help="Random seed for the clip offsets (default: 0)")
+args = parser.parse_args()
+
+
+def load_audio(path):
+    """Decode any ffmpeg-readable file to 16 kHz mono float32."""
+    out = subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-i", path, "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+        check=True,
+        capture_output=True,
+    ).stdout
+    return np.frombuffer(out, dtype=np.float32)
+
+
+def to_wav(samples):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def post(path, files):
+    """POST files ([(field, filename, bytes)]) as multipart/form-data and return the decoded JSON body."""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for field, filename, data in files:
+        body.write(f"--{boundary}\r\n".encode())
+        body.write(f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'.encode())
+        body.write(b"Content-Type: audio/wav\r\n\r\n")
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    request = urllib.request.Request(
+        args.url + path, data=body.getvalue(), headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    )
+    with urllib.request.urlopen(request, timeout=3600) as response:
+        return json.loads(response.read())
+
+
+def run(name, calls):
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda call: call(), calls))
+        elapsed = time.perf_counter() - started
+    print(
+        f"| {name} | {len(calls)} | {elapsed:.2f} | {len(clips) / elapsed:.2f} | {audio_seconds / elapsed:.1f} |"
+    )
+    return results
+
+
+rng = np.random.default_rng(args.seed)
+sources = [load_audio(path) for path in args.filenames or ["samples/jfk.wav"]]
+clips = []
+for i in range(args.clips):
+    source = sources[i % len(sources)]
+    length = int(rng.uniform(args.min_seconds, args.max_seconds) * SAMPLE_RATE)
+    start = int(rng.integers(0, max(1, len(source) - length)))
+    clip = source[start:start + length] + rng.normal(0, 1e-4, min(length, len(source))).astype(np.float32)
+    clips.append((f"clip-{i}.wav", to_wav(clip), len(clip) / SAMPLE_RATE))
+audio_seconds = sum(duration for _, _, duration in clips)
+
+print(f"{len(clips)} clips, {audio_seconds:.1f}s of audio, concurrency {args.concurrency}")
+print()
+print("| Mode | Requests | Seconds | Clips/s | Audio s/s |")
+print("| --- | --- | --- | --- | --- |")
+
+single = run(
+    "one clip per call",
+    [lambda clip=clip: post("/transcribe", [("file", clip[0], clip[1])]) for clip in clips],
+)
+batches = [clips[i:i + args.batch_size] for i in range(0, len(clips), args.batch_size)]
+packed = run(
+    f"batch of {args.batch_size}",
+    [lambda batch=batch: post("/transcribe/batch", [("files", name, data) for name, data, _ in batch]) for batch in batches],
+)
+
+windows = sum(result["windows"] for result in packed)
+differ = sum(
+    single[i]["full_text"].strip() != clip["full_text"].strip()
+    for i, clip in enumerate(item for result in packed for item in result["clips"])
+)
+print()
+print(f"{windows} packed windows for {len(clips)} clips; {differ} clips transcribed differently when packed")
@@ -0,0 +1,873 @@
+"""
+Unit tests for the pure helpers of the transcription service (main.py); none of them needs libwhisper or a model.
+
+    python -m pytest tests/test_main.py
+"""
+
+import asyncio
+import gzip
+import io
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+def make_token(text, t0, t1):
+    return {
+        "text": text,
+        "timestamps": {"from": main._format_timestamp(t0 // 10), "to": main._format_timestamp(t1 // 10)},
+        "offsets": {"from": t0, "to": t1},
+    }
+
+
+def make_segment(text, t0, t1, tokens=None):
+    segment = {
+        "timestamps": {"from": main._format_timestamp(t0 // 10), "to": main._format_timestamp(t1 // 10)},
+        "offsets": {"from": t0, "to": t1},
+        "text": text,
+    }
+    if tokens is not None:
+        segment["tokens"] = tokens
+    return segment
+
+
+# --- Clip packing ---
+
+def test_unpack_segments_clamps_token_offsets_to_the_clip():
+    # Clip 1 spans 3000-5000 ms; the decoder put the [_BEG_] token and the first word before it
+    spans, boundaries = [(0, 2000), (3000, 5000)], [2500]
+    tokens = [make_token("[_BEG_]", 2600, 2600), make_token(" hello", 2900, 3400), make_token(" there", 3400, 5200)]
+    per_clip = main._unpack_segments([make_segment(" hello there", 2600, 5200, tokens)], spans, boundaries)
+
+    assert per_clip[0] == []
+    (segment,) = per_clip[1]
+    assert segment["offsets"] == {"from": 0, "to": 2000}
+    for token in segment["tokens"]:
+        assert 0 <= token["offsets"]["from"] <= token["offsets"]["to"] <= 2000
+        assert not token["timestamps"]["from"].startswith("-")
+    assert [token["offsets"] for token in segment["tokens"]] == [
+        {"from": 0, "to": 0}, {"from": 0, "to": 400}, {"from": 400, "to": 2000},
+    ]
+
+
+def test_pack_clips_first_fit_decreasing():
+    windows = main._pack_clips([10, 3, 20, 8, 16], window_seconds=30, gap_seconds=1, max_clip_seconds=15)
+    # Clips above max_clip_seconds get a window of their own; the rest share one, longest first
+    assert windows == [[2], [4], [0, 3, 1]]
+
+
+def test_pack_clips_respects_the_window_length():
+    durations = [5.5, 9, 2, 14, 7.25, 3, 11, 6, 1, 12.5]
+    windows = main._pack_clips(durations, window_seconds=30, gap_seconds=1, max_clip_seconds=15)
+    assert sorted(i for window in windows for i in window) == list(range(len(durations)))
+    for window in windows:
+        assert sum(durations[i] for i in window) + (len(window) - 1) <= 30
+
+
+def test_join_clips_spans_and_boundaries():
+    rate = main.WHISPER_SAMPLE_RATE
+    samples, spans, boundaries = main._join_clips([np.ones(2 * rate), np.ones(3 * rate)], gap_seconds=1)
+    assert len(samples) == 6 * rate
+    assert spans == [(0, 2000), (3000, 6000)]
+    assert boundaries == [2500]
+
+
+def test_unpack_segments_assigns_by_midpoint_and_shifts_to_the_clip():
+    spans, boundaries = [(0, 2000), (3000, 6000)], [2500]
+    per_clip = main._unpack_segments(
+        [make_segment(" one", 100, 1900), make_segment(" two", 3200, 5800)], spans, boundaries
+    )
+    assert [[s["text"] for s in clip] for clip in per_clip] == [[" one"], [" two"]]
+    assert per_clip[1][0]["offsets"] == {"from": 200, "to": 2800}
+    assert per_clip[1][0]["timestamps"] == {"from": "00:00:00,200", "to": "00:00:02,800"}
+
+
+def test_unpack_segments_cuts_a_segment_across_the_gap_between_its_tokens():
+    spans, boundaries = [(0, 2000), (3000, 6000)], [2500]
+    tokens = [
+        make_token("[_BEG_]", 1000, 1000), make_token(" end", 1000, 1900),
+        make_token(" start", 3100, 3600), make_token(" again", 3600, 4000),
+    ]
+    per_clip = main._unpack_segments([make_segment(" end start again", 1000, 4000, tokens)], spans, boundaries)
+
+    (first,), (second,) = per_clip
+    assert first["text"] == " end"
+    assert first["offsets"] == {"from": 1000, "to": 1900}
+    assert second["text"] == " start again"
+    assert second["offsets"] == {"from": 100, "to": 1000}
+    assert [token["text"] for token in second["tokens"]] == [" start", " again"]
+
+
+# --- Voice activity detection ---
+
+def test_restore_timeline_maps_compacted_times_back():
+    rate_ms = main.WHISPER_SAMPLE_RATE // 1000
+    samples = np.ones(7000 * rate_ms, dtype=np.float32)
+    speech, mapping = main._compact_speech(samples, [(1000, 2000), (5000, 6000)], gap_ms=200)
+    assert len(speech) == 2200 * rate_ms
+    assert mapping == [(0, 1000, 1000), (1200, 5000, 1000)]
+
+    segment = main._restore_timeline(make_segment(" a", 100, 900, [make_token(" a", 100, 900)]), mapping)
+    assert segment["offsets"] == {"from": 1100, "to": 1900}
+    assert segment["timestamps"] == {"from": "00:00:01,100", "to": "00:00:01,900"}
+    assert segment["tokens"][0]["offsets"] == {"from": 1100, "to": 1900}
+
+    # Crossing the gap: the end lands in the second region
+    assert main._restore_timeline(make_segment(" b", 500, 1500), mapping)["offsets"] == {"from": 1500, "to": 5300}
+
+
+def test_restore_timeline_snaps_times_in_a_gap_to_speech():
+    mapping = [(0, 1000, 1000), (1200, 5000, 1000)]
+    # A segment starting in the gap starts with the next region; one ending in it ends with the previous one
+    assert main._restore_timeline(make_segment(" c", 1100, 1500), mapping)["offsets"] == {"from": 5000, "to": 5300}
+    assert main._restore_timeline(make_segment(" d", 800, 1100), mapping)["offsets"] == {"from": 1800, "to": 2000}
+
+
+# --- Timeouts ---
+
+def test_transcribe_timeout_follows_the_measured_model_speed(monkeypatch):
+    monkeypatch.setattr(main, "admission", main.AdmissionController(100, 1, 1.0))
+    monkeypatch.setattr(main, "TRANSCRIBE_TIMEOUT_MIN", 60)
+    monkeypatch.setattr(main, "TIMEOUT_RTF_FACTOR", 5)
+    monkeypatch.setattr(main, "TRANSCRIBE_TIMEOUT", 0)
+
+    # Unmeasured models are assumed to run in realtime
+    assert main._transcribe_timeout(5, "large", cores=4) == 60
+    assert main._transcribe_timeout(100, "large", cores=4) == 500
+
+    # 2 core-seconds per second of audio: 100 s on 8 cores takes 25 s
+    main.admission.observe(100, 50, model="large", cores=4)
+    assert main._transcribe_timeout(100, "large", cores=8) == pytest.approx(125)
+    assert main._transcribe_timeout(100, "large", cores=1) == pytest.approx(1000)
+    assert main._transcribe_timeout(100, "base", cores=8) == 500
+
+    monkeypatch.setattr(main, "TRANSCRIBE_TIMEOUT", 300)
+    assert main._transcribe_timeout(100, "large", cores=1) == 300
+
+
+# --- Short audio context ---
+
+def test_audio_ctx_rounds_up_to_a_bucket(monkeypatch):
+    monkeypatch.setattr(main, "AUDIO_CTX_BUCKETS", [256, 384, 512, 768, 1024])
+    monkeypatch.setattr(main, "AUDIO_CTX_MARGIN_SECONDS", 1)
+    # 50 encoder positions per second, plus a second of margin
+    assert [main._audio_ctx_for(seconds) for seconds in (0, 3, 4.12, 4.2, 14.36, 19.48)] == [
+        256, 256, 256, 384, 768, 1024,
+    ]
+    # Beyond the largest bucket the full 30 s context is used
+    assert main._audio_ctx_for(19.5) == 0
+    assert main._audio_ctx_for(29) == 0
+
+def test_stitch_windows_keeps_each_segment_once():
+    rate = main.WHISPER_SAMPLE_RATE
+    # (window start, owned span start, owned span end, window end) in samples
+    windows = [(0, 0, 20 * rate, 22 * rate), (18 * rate, 20 * rate, 40 * rate, 40 * rate)]
+    results = [
+        {
+            "result": {"language": "en"},
+            "transcription": [make_segment(" a", 0, 5000), make_segment(" overlap", 19000, 21500)],
+        },
+        {
+            "result": {"language": "en"},
+            "transcription": [make_segment(" overlap", 1000, 3500), make_segment(" b", 5000, 8000)],
+        },
+    ]
+    stitched = main._stitch_windows(windows, results)
+
+    assert [s["text"] for s in stitched["transcription"]] == [" a", " overlap", " b"]
+    # The overlapping segment comes from the window owning its midpoint, shifted to the original timeline
+    assert [s["offsets"] for s in stitched["transcription"]] == [
+        {"from": 0, "to": 5000}, {"from": 19000, "to": 21500}, {"from": 23000, "to": 26000},
+    ]
+    assert stitched["chunks"] == [{"from": 0, "to": 22000}, {"from": 18000, "to": 40000}]
+    assert stitched["result"] == {"language": "en"}
+
+
+def test_stitch_windows_drops_a_repeated_segment():
+    rate = main.WHISPER_SAMPLE_RATE
+    windows = [(0, 0, 10 * rate, 12 * rate), (8 * rate, 10 * rate, 20 * rate, 20 * rate)]
+    results = [
+        {"result": {"language": "en"}, "transcription": [make_segment(" Hello there.", 7000, 9500)]},
+        {"result": {"language": "de"}, "transcription": [make_segment(" hello there", 2000, 4000)]},
+    ]
+    stitched = main._stitch_windows(windows, results)
+    assert [s["text"] for s in stitched["transcription"]] == [" Hello there."]
+
+
+# --- Model cascade ---
+
+def scored_segment(text, t0, t1, avg_token_p=0.9, no_speech_prob=0.1):
+    return {**make_segment(text, t0, t1), "confidence": {"avg_token_p": avg_token_p, "no_speech_prob": no_speech_prob}}
+
+
+def test_rerun_regions_merge_neighbouring_weak_segments():
+    segments = [
+        scored_segment(" fine", 0, 2000),
+        scored_segment(" mumble", 2000, 3000, avg_token_p=0.2),
+        scored_segment(" noise", 3200, 4000, no_speech_prob=0.9),
+        scored_segment(" fine", 4000, 9000),
+        scored_segment(" again" * 20, 9000, 12000),  # repetitive: compresses too well
+        scored_segment(" fine", 12000, 13000),
+    ]
+    assert main._rerun_regions(segments, padding_ms=500) == [(1, 2, 1500, 4500), (4, 4, 8500, 12500)]
+    # Without padding the gap between the first two weak segments keeps them apart
+    assert main._rerun_regions(segments, padding_ms=0) == [(1, 1, 2000, 3000), (2, 2, 3200, 4000), (4, 4, 9000, 12000)]
+
+
+def test_cascade_replaces_weak_segments_within_their_span(monkeypatch):
+    monkeypatch.setattr(main, "CASCADE_PADDING_SECONDS", 0.5)
+    segments = [
+        scored_segment(" one", 0, 2000),
+        scored_segment(" tw", 2000, 4000, avg_token_p=0.2),
+        scored_segment(" three", 4000, 6000),
+        scored_segment(" for", 6000, 8000, avg_token_p=0.2),
+        scored_segment(" five", 8000, 10000),
+    ]
+    # Times relative to each region, which starts 500 ms before the weak segment
+    reruns = iter([
+        [make_segment(" one", 0, 600), make_segment(" two", 500, 2800)],
+        [],
+    ])
+    calls = []
+
+    async def transcribe(samples, options, trace=None):
+        calls.append((len(samples), options["model"]))
+        return {"transcription": next(reruns)}
+
+    monkeypatch.setattr(main, "_transcribe_samples", transcribe)
+    samples = np.zeros(10 * main.WHISPER_SAMPLE_RATE, dtype=np.float32)
+    result = asyncio.run(main._cascade(samples, {"transcription": segments}, {"model": "base"}, "large"))
+
+    assert calls == [(3 * main.WHISPER_SAMPLE_RATE, "large")] * 2
+    merged = result["transcription"]
+    assert [segment["text"] for segment in merged] == [" one", " two", " three", " for", " five"]
+    # The padding picked up the end of " one", which is dropped; " two" is clipped to the span it replaces
+    assert merged[1]["offsets"] == {"from": 2000, "to": 4000} and merged[1]["model"] == "large"
+    # The larger model found nothing in the second region, so the first pass stays
+    assert merged[3] is segments[3]
+    assert result["cascade"] == {"model": "large", "segments_rerun": 2, "regions": 2, "audio_seconds_rerun": 6.0}
+
+
+# --- WAV parsing ---
+
+def wav_header(format_tag=main.WAVE_FORMAT_PCM, channels=1, sample_rate=16000, bits=16, data_size=32000,
+               extra_chunks=b"", extensible=False):
+    block_align = channels * bits // 8
+    if extensible:
+        fmt = struct.pack(
+            "<HHIIHHHHI", main.WAVE_FORMAT_EXTENSIBLE, channels, sample_rate, sample_rate * block_align, block_align,
+            bits, 22, bits, 0,
+        ) + struct.pack("<H", format_tag) + b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+    else:
+        fmt = struct.pack("<HHIIHH", format_tag, channels, sample_rate, sample_rate * block_align, block_align, bits)
+    body = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt + extra_chunks + b"data" + struct.pack("<I", data_size)
+    return b"RIFF" + struct.pack("<I", min(len(body) + data_size, 0xFFFFFFFF)) + body
+
+
+def test_parse_wav_header_pcm():
+    header = wav_header(channels=2, sample_rate=44100, data_size=1000)
+    assert main._parse_wav_header(header) == main.WavInfo(main.WAVE_FORMAT_PCM, 2, 44100, 16, len(header), 1000)
+
+
+def test_parse_wav_header_skips_other_chunks():
+    info = main._parse_wav_header(wav_header(extra_chunks=b"LIST" + struct.pack("<I", 5) + b"abcde\x00"))
+    assert info.data_offset == 12 + 8 + 16 + 8 + 6 + 8
+
+
+def test_parse_wav_header_extensible_float():
+    info = main._parse_wav_header(wav_header(main.WAVE_FORMAT_IEEE_FLOAT, bits=32, extensible=True))
+    assert (info.format_tag, info.bits_per_sample) == (main.WAVE_FORMAT_IEEE_FLOAT, 32)
+
+
+def test_parse_wav_header_streamed_size_is_unknown():
+    assert main._parse_wav_header(wav_header(data_size=0xFFFFFFFF)).data_size is None
+    assert main._parse_wav_header(wav_header(data_size=0)).data_size is None
+
+
+def test_parse_wav_header_rejects_what_it_cannot_decode():
+    assert main._parse_wav_header(b"ID3\x04" + bytes(60)) is None
+    assert main._parse_wav_header(wav_header(format_tag=0x0055)) is None  # MPEG layer 3 in a WAV container
+    assert main._parse_wav_header(wav_header(bits=12)) is None
+    assert main._parse_wav_header(wav_header(sample_rate=4000)) is None
+    assert main._parse_wav_header(wav_header()[:30]) is None  # truncated before the data chunk
+
+
+def wav_upload(seconds, sample_rate):
+    data = np.zeros(int(seconds * sample_rate), dtype="<i2").tobytes()
+    content = wav_header(sample_rate=sample_rate, data_size=len(data)) + data
+    return main.UploadFile(file=io.BytesIO(content), filename="clip.wav", size=len(content))
+
+
+def decode_wav(upload, account):
+    async def decode():
+        info = main._parse_wav_header(await upload.read(main.WAV_HEADER_PROBE_SIZE))
+        return await main._decode_wav(upload, info, account)
+    return asyncio.run(decode())
+
+
+def test_decode_wav_limits_duration_not_source_rate_bytes(monkeypatch):
+    monkeypatch.setattr(main, "MAX_AUDIO_SECONDS", 20)
+    budget = main.MemoryBudget(1 << 30)
+    with main.MemoryAccount(budget, 20 * main.WHISPER_SAMPLE_RATE * 4) as account:
+        # 15 s at 48 kHz holds more source samples than the limit allows at 16 kHz, but only while resampling
+        samples = decode_wav(wav_upload(15, 48000), account)
+        assert len(samples) == 15 * main.WHISPER_SAMPLE_RATE
+        assert account.reserved == budget.used == 15 * main.WHISPER_SAMPLE_RATE * 4
+    assert budget.used == 0
+
+    with main.MemoryAccount(budget, 20 * main.WHISPER_SAMPLE_RATE * 4) as account:
+        with pytest.raises(main.AudioTooLargeError):
+            decode_wav(wav_upload(25, 48000), account)
+        assert budget.used == 0
+
+
+# --- Scheduling ---
+
+def run_scheduler(scenario, slots=3, aging_rate=10, short_seconds=30, short_reserved=1):
+    async def run():
+        return await scenario(main.JobScheduler(slots, aging_rate, short_seconds, short_reserved))
+    return asyncio.run(run())
+
+
+async def enqueue(scheduler, duration):
+    task = asyncio.ensure_future(scheduler.acquire(duration))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_scheduler_serves_shortest_job_first():
+    async def scenario(scheduler):
+        running = [await scheduler.acquire(100) for _ in range(3)]
+        order = []
+        for duration in (300, 200, 5):
+            job = await enqueue(scheduler, duration)
+            job.add_done_callback(lambda _, duration=duration: order.append(duration))
+        for ticket in running:
+            scheduler.release(ticket)
+            await asyncio.sleep(0)
+        return order
+
+    assert run_scheduler(scenario) == [5, 200, 300]
+
+
+def test_scheduler_ages_waiting_jobs(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+
+    async def scenario(scheduler):
+        running = await scheduler.acquire(100)
+        long_job = await enqueue(scheduler, 100)
+        # 10 s later a 5 s job arrives: the long one has aged by 100 s and is served first
+        clock[0] += 10
+        short_job = await enqueue(scheduler, 5)
+        scheduler.release(running)
+        await asyncio.sleep(0)
+        return long_job.done(), short_job.done()
+
+    assert run_scheduler(scenario, slots=1, short_reserved=0) == (True, False)
+
+
+def test_scheduler_reserves_slots_for_waiting_short_jobs():
+    async def scenario(scheduler):
+        running = [await scheduler.acquire(100) for _ in range(3)]
+        short_job = await enqueue(scheduler, 5)
+        long_job = await enqueue(scheduler, 50)
+        scheduler.release(running[0])
+        await asyncio.sleep(0)
+        assert short_job.done() and not long_job.done()
+        scheduler.release(running[1])
+        await asyncio.sleep(0)
+        return long_job.done(), dict(scheduler.busy)
+
+    assert run_scheduler(scenario) == (True, {"short": 1, "long": 2})
+
+
+def test_scheduler_lets_long_jobs_borrow_reserved_slots():
+    async def scenario(scheduler):
+        # No short job is waiting, so the reserved slot doesn't sit idle
+        jobs = [await enqueue(scheduler, 100) for _ in range(3)]
+        return [job.done() for job in jobs], dict(scheduler.busy)
+
+    assert run_scheduler(scenario) == ([True, True, True], {"short": 0, "long": 3})
+
+
+def test_scheduler_holds_the_reserved_slot_only_while_short_jobs_wait():
+    async def scenario(scheduler):
+        running = [await scheduler.acquire(100) for _ in range(2)]
+        short_job = await enqueue(scheduler, 5)
+        long_job = await enqueue(scheduler, 100)
+        # short_job took the third slot; once it is done, the next long job may use it
+        assert short_job.done() and not long_job.done()
+        scheduler.release(short_job.result())
+        await asyncio.sleep(0)
+        done = long_job.done()
+        scheduler.release(long_job.result())
+        for ticket in running:
+            scheduler.release(ticket)
+        return done
+
+    assert run_scheduler(scenario)
+
+
+def test_scheduler_tracks_waiting_audio_seconds():
+    async def scenario(scheduler):
+        running = await scheduler.acquire(100)
+        waiting = [await enqueue(scheduler, d) for d in (30, 12.5)]
+        before = scheduler.waiting_seconds
+        waiting[0].cancel()
+        await asyncio.sleep(0)
+        after_cancel = scheduler.waiting_seconds
+        scheduler.release(running)
+        await asyncio.sleep(0)
+        return before, after_cancel, scheduler.waiting_seconds
+
+    assert run_scheduler(scenario, slots=1, short_reserved=0) == (42.5, 12.5, 0.0)
+
+
+def test_scheduler_holds_back_decoding_while_enough_audio_waits():
+    async def scenario(scheduler):
+        running = await scheduler.acquire(100)
+        # An idle slot always lets the next job through
+        await asyncio.wait_for(scheduler.wait_for_room(10), 1)
+        queued = await enqueue(scheduler, 20)
+        room = asyncio.ensure_future(scheduler.wait_for_room(10))
+        await asyncio.sleep(0)
+        blocked = not room.done()
+        # Dispatching the waiting job takes its audio off the backlog
+        scheduler.release(running)
+        await asyncio.wait_for(room, 1)
+        return blocked, queued.done()
+
+    assert run_scheduler(scenario, slots=1, short_reserved=0) == (True, True)
+
+
+# --- Pipeline stages ---
+
+def test_pipeline_stage_utilisation_over_the_window(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    stage = main.PipelineStage("convert", capacity=2, window=10)
+
+    stage.enter()
+    clock[0] = 4
+    stage.enter()
+    clock[0] = 6
+    # 4 s with one slot busy, then 2 s with both: 8 of 12 slot-seconds
+    assert stage.utilisation() == pytest.approx(8 / 12)
+    assert stage.status() == {"capacity": 2, "active": 2, "waiting": 0, "utilisation": 0.667}
+    stage.leave()
+    stage.leave()
+    clock[0] = 30
+    assert stage.utilisation() == 0
+
+
+def test_pipeline_stage_slot_bounds_concurrency():
+    async def scenario():
+        stage = main.PipelineStage("convert", capacity=1)
+        stage.open()
+        release = asyncio.Event()
+
+        async def job():
+            async with stage.slot():
+                await release.wait()
+
+        jobs = [asyncio.ensure_future(job()) for _ in range(2)]
+        await asyncio.sleep(0)
+        counts = (stage.active, stage.waiting)
+        release.set()
+        await asyncio.gather(*jobs)
+        return counts, (stage.active, stage.waiting)
+
+    assert asyncio.run(scenario()) == ((1, 1), (0, 0))
+
+
+# --- Result cache ---
+
+def cache_files(directory):
+    return sorted(name[:-len(".json")] for _, _, files in os.walk(directory) for name in files)
+
+
+def test_result_cache_evicts_least_recently_used_from_memory():
+    async def scenario():
+        cache = main.ResultCache(max_entries=2)
+        await cache.put("a", {"text": "a"})
+        await cache.put("b", {"text": "b"})
+        assert await cache.get("a") == {"text": "a"}
+        await cache.put("c", {"text": "c"})
+        return [await cache.get(key) for key in "abc"], cache.hits, cache.misses
+
+    results, hits, misses = asyncio.run(scenario())
+    assert results == [{"text": "a"}, None, {"text": "c"}]
+    assert (hits, misses) == (3, 1)
+
+
+def test_result_cache_evicts_least_recently_used_from_disk(tmp_path):
+    entry = {"text": "x" * 100}
+    size = len(json.dumps(entry))
+
+    async def scenario():
+        # No memory tier, so every lookup goes to disk
+        cache = main.ResultCache(0, str(tmp_path), max_disk_bytes=2 * size)
+        await cache.put("aa1", entry)
+        await cache.put("bb2", entry)
+        assert await cache.get("aa1") == entry
+        await cache.put("cc3", entry)
+        return cache, await cache.get("bb2")
+
+    cache, evicted = asyncio.run(scenario())
+    assert evicted is None
+    assert cache_files(tmp_path) == ["aa1", "cc3"]
+    assert cache._disk_bytes == 2 * size
+
+
+def test_result_cache_expires_old_disk_entries(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+
+    async def scenario():
+        cache = main.ResultCache(0, str(tmp_path), max_disk_bytes=1 << 20, max_age=60)
+        await cache.put("aa1", {"text": "a"})
+        now[0] += 30
+        await cache.put("bb2", {"text": "b"})
+        now[0] += 40
+        await cache.put("cc3", {"text": "c"})
+
+    asyncio.run(scenario())
+    assert cache_files(tmp_path) == ["bb2", "cc3"]
+
+
+def test_result_cache_indexes_entries_left_on_disk(tmp_path):
+    entry = {"text": "x" * 100}
+    size = len(json.dumps(entry))
+
+    async def fill():
+        cache = main.ResultCache(0, str(tmp_path), max_disk_bytes=3 * size)
+        for key in ("aa1", "bb2", "cc3"):
+            await cache.put(key, entry)
+
+    asyncio.run(fill())
+    for age, key in enumerate(("cc3", "aa1", "bb2")):
+        path = os.path.join(tmp_path, key[:2], key + ".json")
+        os.utime(path, (1000 + age, 1000 + age))
+
+    # A smaller tier at startup drops the least recently used entry left by the previous run
+    cache = main.ResultCache(0, str(tmp_path), max_disk_bytes=2 * size)
+    assert list(cache._disk_index) == ["aa1", "bb2"]
+    assert cache_files(tmp_path) == ["aa1", "bb2"]
+    assert asyncio.run(cache.get("bb2")) == entry
+
+
+# --- Request coalescing ---
+
+def test_single_flight_coalesces_identical_calls():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def scenario():
+        flights = main.SingleFlight()
+        return await asyncio.gather(flights.run("key", work), flights.run("key", work))
+
+    assert asyncio.run(scenario()) == [("result", False), ("result", True)]
+    assert len(calls) == 1
+
+
+def test_single_flight_keeps_running_when_the_leader_leaves():
+    async def work():
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def scenario():
+        flights = main.SingleFlight()
+        leader = asyncio.ensure_future(flights.run("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.run("key", work))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(scenario()) == ("result", True)
+
+
+def test_single_flight_cancels_the_task_when_every_caller_leaves():
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def scenario():
+        flights = main.SingleFlight()
+        callers = [asyncio.ensure_future(flights.run("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.wait(callers)
+        await asyncio.sleep(0)
+        return flights._tasks
+
+    assert asyncio.run(scenario()) == {}
+    assert cancelled == [1]
+
+
+def test_single_flight_holds_the_leaders_memory_until_the_task_is_done():
+    budget = main.MemoryBudget(1 << 20)
+    finish = []
+
+    async def work():
+        while not finish:
+            await asyncio.sleep(0.001)
+        return "result"
+
+    async def scenario():
+        flights = main.SingleFlight()
+
+        async def leader():
+            with main.MemoryAccount(budget, 1 << 20) as account:
+                account.add(1000)
+                return await flights.run("key", work, account)
+
+        leading = asyncio.ensure_future(leader())
+        await asyncio.sleep(0)
+        following = asyncio.ensure_future(flights.run("key", work))
+        await asyncio.sleep(0.01)
+        leading.cancel()
+        await asyncio.wait({leading})
+        # The follower still waits on the samples the leader decoded
+        held = budget.used
+        finish.append(1)
+        return held, await following
+
+    assert asyncio.run(scenario()) == (1000, ("result", True))
+    assert budget.used == 0
+
+
+# --- Model registry ---
+
+def make_registry(tmp_path, budget, models, pool_size=2, other_pool_size=None):
+    """A registry over fake model files of the given sizes; base is the default model."""
+    for name, size in models.items():
+        (tmp_path / f"ggml-{name}.bin").write_bytes(bytes(size))
+    return main.ModelRegistry(str(tmp_path), str(tmp_path / "ggml-base.bin"), budget, 900, pool_size, other_pool_size)
+
+
+def load(registry, *names):
+    for name in names:
+        # The pool is only a label here: _make_room returns the pools to stop
+        registry.loaded[name] = main._LoadedModel(name, registry._estimate_memory(name))
+
+
+def test_make_room_unloads_idle_models_least_recently_used_first(tmp_path):
+    registry = make_registry(tmp_path, 800, {"base": 100, "small": 100, "medium": 100, "large": 200})
+    load(registry, "base", "small", "medium")
+    registry.loaded["medium"].users = 1
+    # 600 bytes loaded; large needs 400, so the idle small goes but the busy medium stays
+    assert registry._make_room(registry._estimate_memory("large")) == ["small"]
+    assert list(registry.loaded) == ["base", "medium"]
+
+
+def test_make_room_waits_for_models_in_use(tmp_path):
+    registry = make_registry(tmp_path, 900, {"base": 100, "medium": 200, "large": 200})
+    load(registry, "base", "medium")
+    registry.loaded["medium"].users = 1
+    with pytest.raises(main.ModelUnavailableError) as unavailable:
+        registry._make_room(registry._estimate_memory("large"))
+    assert not isinstance(unavailable.value, main.ModelTooLargeError)
+
+
+def test_make_room_rejects_a_model_that_never_fits_beside_the_default(tmp_path):
+    registry = make_registry(tmp_path, 1000, {"base": 200, "large": 400})
+    load(registry, "base")
+    with pytest.raises(main.ModelTooLargeError):
+        registry._make_room(registry._estimate_memory("large"))
+    with pytest.raises(main.HTTPException) as rejected:
+        with main._transcription_errors("clip.wav", "large"):
+            registry._make_room(registry._estimate_memory("large"))
+    assert rejected.value.status_code == 507 and not rejected.value.headers
+
+    # With a single worker per extra model, it fits
+    registry = make_registry(tmp_path, 1000, {"base": 200, "large": 400}, other_pool_size=1)
+    load(registry, "base")
+    assert registry._estimate_memory("large") == 400
+    assert registry._make_room(400) == []
+
+
+# --- Admission control ---
+
+def test_admission_rejects_a_full_queue_with_the_expected_wait():
+    admission = main.AdmissionController(max_queued_seconds=100, concurrency=2, initial_rtf=0.5)
+    admission.reserve(60)
+    admission.reserve(30)
+    admission.check()
+    with pytest.raises(main.QueueFullError) as rejected:
+        admission.reserve(20)
+    # 90 s queued at half realtime over 2 slots drains in 22.5 s
+    assert rejected.value.retry_after == 23
+
+    admission.reserve(10)
+    with pytest.raises(main.QueueFullError):
+        admission.check()
+    for duration in (60, 30, 10):
+        admission.release(duration)
+    assert (admission.queued_seconds, admission.jobs) == (0, 0)
+
+
+def test_admission_retry_after_is_at_least_a_second():
+    admission = main.AdmissionController(max_queued_seconds=1, concurrency=4, initial_rtf=0.01)
+    admission.reserve(1)
+    with pytest.raises(main.QueueFullError) as rejected:
+        admission.check()
+    assert rejected.value.retry_after == 1
+
+
+def test_admission_accepts_an_oversize_job_into_an_empty_queue():
+    admission = main.AdmissionController(max_queued_seconds=100, concurrency=1, initial_rtf=0.5)
+    with admission.admit(500):
+        assert admission.queued_seconds == 500
+        with pytest.raises(main.QueueFullError):
+            admission.reserve(1)
+    assert (admission.queued_seconds, admission.jobs) == (0, 0)
+
+
+def test_admission_learns_the_realtime_factor_per_model():
+    admission = main.AdmissionController(max_queued_seconds=100, concurrency=1, initial_rtf=1.0)
+    assert admission.expected_seconds("base", 10, cores=4) is None
+
+    admission.observe(10, 2, model="base", cores=4)
+    assert admission.rtf == pytest.approx(0.8 + 0.2 * 0.2)
+    assert admission.core_rtf == {"base": pytest.approx(0.8)}
+    admission.observe(10, 1, model="base", cores=4)
+    assert admission.core_rtf["base"] == pytest.approx(0.8 * 0.8 + 0.2 * 0.4)
+    assert admission.expected_seconds("base", 30, cores=8) == pytest.approx(admission.core_rtf["base"] * 30 / 8)
+
+
+def test_transcription_errors_turn_a_full_queue_into_429():
+    with pytest.raises(main.HTTPException) as rejected:
+        with main._transcription_errors("clip.wav", "base"):
+            raise main.QueueFullError("Transcription queue is full", 7)
+    assert rejected.value.status_code == 429
+    assert rejected.value.headers == {"Retry-After": "7"}
+
+
+# --- Responses ---
+
+def test_parse_fields():
+    assert main._parse_fields(" text, tokens ,") == ("text", "tokens")
+    with pytest.raises(main.HTTPException) as rejected:
+        main._parse_fields("text,words")
+    assert rejected.value.status_code == 400 and "['words']" in rejected.value.detail
+
+
+def test_build_response_keeps_the_requested_fields():
+    result = {"result": {"language": "en"}, "transcription": [make_segment(" hello ", 0, 100)]}
+    assert main._build_response(result, ("text",)) == {"language": "en", "full_text": "hello"}
+    assert set(main._build_response(result)) == {"language", "full_text", "segments", "raw_result"}
+
+
+def test_compress_picks_the_best_accepted_encoding(monkeypatch):
+    body = b'{"text": "hello"}' * 100
+    if main.zstandard is not None:
+        compressed, encoding = main._compress(body, "gzip, zstd;q=0.5")
+        assert encoding == "zstd" and main.zstandard.ZstdDecompressor().decompress(compressed) == body
+
+    monkeypatch.setattr(main, "zstandard", None)
+    compressed, encoding = main._compress(body, "gzip, zstd")
+    assert encoding == "gzip" and gzip.decompress(compressed) == body
+
+
+def test_compress_leaves_refused_and_small_bodies_alone():
+    body = b'{"text": "hello"}' * 100
+    assert main._compress(body, "gzip;q=0, zstd; q=0") == (body, None)
+    assert main._compress(body, "br, identity") == (body, None)
+    assert main._compress(body, "gzip;q=high") == (body, None)
+    assert main._compress(b"{}", "gzip, zstd") == (b"{}", None)
+
+def stream_events(outcome):
+    async def scenario():
+        segments = asyncio.Queue()
+
+        async def transcribe():
+            segments.put_nowait({"text": " hello"})
+            await asyncio.sleep(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        task = asyncio.ensure_future(transcribe())
+        return [event async for event in main._segment_events(segments, task, "clip.wav", "base")]
+
+    return [
+        (event.split("\n")[0][len("event: "):], json.loads(event.split("\n")[1][len("data: "):]))
+        for event in asyncio.run(scenario())
+    ]
+
+
+def test_segment_events_end_with_the_response():
+    result = {"result": {"language": "en"}, "transcription": [make_segment(" hello", 0, 100)]}
+    events = stream_events(result)
+    assert [event for event, _ in events] == ["segment", "done"]
+    assert events[1][1]["full_text"] == "hello"
+
+
+def test_segment_events_report_any_failure():
+    for error, status in ((TimeoutError(), 504), (main.WorkerError("crashed"), 500), (KeyError("text"), 500)):
+        events = stream_events(error)
+        assert events[0] == ("segment", {"text": " hello"})
+        assert events[-1][0] == "error" and events[-1][1]["status_code"] == status
+
+def busy(retry_after=5):
+    return main.HTTPException(status_code=503, detail="busy", headers={"Retry-After": str(retry_after)})
+
+
+def retry_job(monkeypatch, outcomes, retry_seconds=60):
+    now = [0.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+
+    async def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    attempts = []
+
+    async def attempt():
+        outcome = outcomes[len(attempts)]
+        attempts.append(now[0])
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    try:
+        return asyncio.run(main._retry_when_busy("job", retry_seconds, attempt)), attempts
+    except main.HTTPException as e:
+        return e, attempts
+
+
+def test_job_retries_while_busy(monkeypatch):
+    assert retry_job(monkeypatch, [busy(5), busy(10), "result"]) == ("result", [0, 5, 15])
+
+
+def test_job_gives_up_at_the_deadline(monkeypatch):
+    error, attempts = retry_job(monkeypatch, [busy(30), busy(30), busy(30)])
+    assert attempts == [0, 30, 60]
+    assert error.status_code == 503 and not error.headers
+
+
+def test_job_fails_at_once_on_errors_waiting_cannot_fix(monkeypatch):
+    unavailable = main.HTTPException(status_code=503, detail="Transcription workers are not available.")
+    for outcome in (main.HTTPException(status_code=400, detail="bad audio"), unavailable):
+        error, attempts = retry_job(monkeypatch, [outcome])
+        assert error is outcome and attempts == [0]